@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a commandline application to manage RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Benchmark sorting (epoch, version, release) tuples using the precomputed
+keys of repo_manager.evr_key against a cmp-based sort on rpm.labelCompare.
+"""
+
+from __future__ import print_function
+
+import argparse
+import functools
+import random
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import rpm
+
+import repo_manager.repo_manager as repomgr
+
+
+def generate_corpus(size, seed=0):
+    ''' Return a list of ``size`` random (epoch, version, release) tuples
+    looking like the ones found in real repositories.
+    '''
+    randgen = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        epoch = randgen.choice([None, None, None, '0', '1', '2'])
+        version = '.'.join(
+            str(randgen.randint(0, 20))
+            for _ in range(randgen.randint(1, 4)))
+        if randgen.random() < 0.1:
+            version += randgen.choice(['~rc1', '~beta2', 'a', 'git1234'])
+        release = '%s.el%s' % (randgen.randint(1, 15), randgen.randint(5, 7))
+        corpus.append((epoch, version, release))
+    return corpus
+
+
+def _timeit(function, corpus, repeat):
+    ''' Return the best time out of ``repeat`` runs of function(corpus). '''
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function(corpus)
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def sort_cmp(corpus):
+    ''' Sort the corpus calling rpm.labelCompare for each comparison. '''
+    return sorted(corpus, key=functools.cmp_to_key(rpm.labelCompare))
+
+
+def sort_key(corpus):
+    ''' Sort the corpus using the precomputed repo_manager.evr_key. '''
+    return sorted(corpus, key=lambda evr: repomgr.evr_key(*evr))
+
+
+def main():
+    ''' Run the benchmark. '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes', default='1000,10000,100000',
+        help="Comma separated list of corpus sizes")
+    parser.add_argument(
+        '--repeat', default=3, type=int,
+        help="Number of runs per measure, the best one is kept")
+    args = parser.parse_args()
+
+    print('%10s %12s %12s %8s' % ('size', 'labelCompare', 'evr_key', 'ratio'))
+    for size in args.sizes.split(','):
+        corpus = generate_corpus(int(size))
+        if [list(evr) for evr in sort_cmp(corpus)] \
+                != [list(evr) for evr in sort_key(corpus)]:
+            print('Orders differ for size %s' % size)
+            return 1
+        cmp_time = _timeit(sort_cmp, corpus, args.repeat)
+        key_time = _timeit(sort_key, corpus, args.repeat)
+        print('%10s %11.3fs %11.3fs %7.1fx' % (
+            size, cmp_time, key_time, cmp_time / key_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a commandline application to manage RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Benchmark the cost of mirroring a repository to a local folder (see
+repo_manager.mirror): the first, full, pass, then a pass when nothing
+changed and one after a few RPMs changed, compared with ``cp -a`` of the
+whole repository.
+
+By default a repository of copies of the RPMs of the tests is created in
+the temporary directory, with the mirror next to it.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import repo_manager.mirror as mirror
+
+TEST_RPMS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'repo')
+
+
+def generate_repo(folder, count):
+    ''' Fill the folder with ``count`` copies of the RPMs of the tests and
+    a repodata.
+    '''
+    rpms = sorted(os.listdir(TEST_RPMS))
+    for cnt in range(count):
+        source = rpms[cnt % len(rpms)]
+        shutil.copyfile(
+            os.path.join(TEST_RPMS, source),
+            os.path.join(folder, '%06d-%s' % (cnt, source)))
+    os.mkdir(os.path.join(folder, 'repodata'))
+    stream = open(os.path.join(folder, 'repodata', 'repomd.xml'), 'w')
+    try:
+        stream.write('<repomd/>\n')
+    finally:
+        stream.close()
+
+
+def touch_rpms(folder, count):
+    ''' Rewrite, as new files with a new mtime, ``count`` RPMs of the
+    folder and its repodata.
+    '''
+    rpms = sorted(
+        filename for filename in os.listdir(folder)
+        if filename.endswith('.rpm'))
+    later = time.time() + 10
+    for filename in rpms[:count] + [os.path.join('repodata', 'repomd.xml')]:
+        path = os.path.join(folder, filename)
+        shutil.copyfile(path, path + '.new')
+        os.utime(path + '.new', (later, later))
+        os.rename(path + '.new', path)
+
+
+def measure(folder, target, runs, **kwargs):
+    ''' Return the best time taken by mirror_repo and its statistics. '''
+    best = None
+    for _ in range(runs):
+        stats = mirror.mirror_repo(folder, target, **kwargs)
+        if best is None or stats['duration'] < best[0]:
+            best = (stats['duration'], stats)
+    return best
+
+
+def main():
+    ''' Run the benchmark. '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--folder', default=None,
+        help="Repository to mirror, copies of the RPMs of the tests by "
+        "default")
+    parser.add_argument(
+        '--count', default=5000, type=int,
+        help="Number of RPMs of the repository generated")
+    parser.add_argument(
+        '--changed', default=10, type=int,
+        help="Number of RPMs changed before the last pass")
+    parser.add_argument(
+        '--workers', default=mirror.WORKERS, type=int,
+        help="Number of RPMs copied in parallel")
+    parser.add_argument(
+        '--hardlink', default=False, action='store_true',
+        help="Hardlink the files instead of copying them")
+    parser.add_argument(
+        '--repeat', default=3, type=int,
+        help="Number of runs of the unchanged pass, the best one is kept")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='repo_manager-mirror-')
+    folder = args.folder
+    if not folder:
+        folder = os.path.join(workdir, 'repo')
+        os.mkdir(folder)
+        generate_repo(folder, args.count)
+    target = os.path.join(workdir, 'mirror')
+    options = {'workers': args.workers, 'hardlink': args.hardlink}
+    try:
+        start = time.time()
+        subprocess.check_call(
+            ['cp', '-a', folder, os.path.join(workdir, 'cp')])
+        copy = time.time() - start
+
+        print('%-24s %10s %8s %8s' % ('pass', 'runtime', 'copied', 'RPMs'))
+        print('%-24s %9.3fs %8s %8s' % ('cp -a', copy, '-', '-'))
+        for label, runs in [('full', 1), ('unchanged', args.repeat)]:
+            duration, stats = measure(folder, target, runs, **options)
+            print('%-24s %9.3fs %8s %8s' % (
+                label, duration, stats['copied'] + stats['linked'],
+                stats['copied'] + stats['linked'] + stats['unchanged']))
+        if not args.folder:
+            touch_rpms(folder, args.changed)
+            duration, stats = measure(folder, target, 1, **options)
+            print('%-24s %9.3fs %8s %8s' % (
+                '%s changed' % args.changed, duration,
+                stats['copied'] + stats['linked'],
+                stats['copied'] + stats['linked'] + stats['unchanged']))
+    finally:
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
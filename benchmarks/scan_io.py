@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a commandline application to manage RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Benchmark the time taken to read the headers of all the RPMs of a folder
+with a cold page cache, comparing librpm reading the files in directory
+order with the I/O-scheduled scan (see repo_manager.scan) keeping more or
+fewer files in flight.
+
+Run it against a folder on the storage to measure (NFS, spinning disk...),
+by default a folder of copies of the RPMs of the tests is created in the
+temporary directory. The files are evicted from the page cache before each
+run using posix_fadvise (Python 3) or, as root, /proc/sys/vm/drop_caches.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import repo_manager.repo_manager as repomgr
+
+TEST_RPMS = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'repo')
+
+
+def generate_folder(count):
+    ''' Return a temporary folder with ``count`` copies of the RPMs of the
+    tests.
+    '''
+    folder = tempfile.mkdtemp(prefix='repo_manager-scan-')
+    rpms = sorted(os.listdir(TEST_RPMS))
+    for cnt in range(count):
+        source = rpms[cnt % len(rpms)]
+        shutil.copyfile(
+            os.path.join(TEST_RPMS, source),
+            os.path.join(folder, '%06d-%s' % (cnt, source)))
+    return folder
+
+
+def evict(folder):
+    ''' Drop the files of the folder from the page cache, return False if
+    it could not be done.
+    '''
+    if hasattr(os, 'posix_fadvise'):
+        for filename in os.listdir(folder):
+            fd = os.open(os.path.join(folder, filename), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+        return True
+    try:
+        subprocess.call(['sync'])
+        stream = open('/proc/sys/vm/drop_caches', 'w')
+        try:
+            stream.write('3\n')
+        finally:
+            stream.close()
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def measure(folder, in_flight, runs):
+    ''' Return the best time taken to read the headers of the RPMs of the
+    folder, using librpm if ``in_flight`` is 0.
+    '''
+    repomgr.SCHEDULED_SCAN.clear()
+    if in_flight:
+        repomgr.SCHEDULED_SCAN[os.path.normpath(folder)] = in_flight
+    best = None
+    for _ in range(runs):
+        evict(folder)
+        start = time.time()
+        for _ in repomgr.iter_rpm_entries(folder):
+            pass
+        duration = time.time() - start
+        if best is None or duration < best:
+            best = duration
+    return best
+
+
+def main():
+    ''' Run the benchmark. '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--folder', default=None,
+        help="Folder of RPMs to scan, copies of the RPMs of the tests by "
+        "default")
+    parser.add_argument(
+        '--count', default=2000, type=int,
+        help="Number of RPMs of the folder generated")
+    parser.add_argument(
+        '--in-flight', default='1,8,32',
+        help="Comma separated numbers of files read at the same time")
+    parser.add_argument(
+        '--repeat', default=3, type=int,
+        help="Number of runs per measure, the best one is kept")
+    args = parser.parse_args()
+
+    folder = args.folder
+    if not folder:
+        folder = generate_folder(args.count)
+    try:
+        if not evict(folder):
+            print('Cannot evict the files from the page cache, measuring '
+                  'with a warm cache')
+        count = len([
+            filename for filename in os.listdir(folder)
+            if filename.endswith('.rpm')])
+        print('%-20s %10s %12s' % ('scan', 'runtime', 'RPMs/s'))
+        for in_flight in [0] + [
+                int(value) for value in args.in_flight.split(',')]:
+            duration = measure(folder, in_flight, args.repeat)
+            label = 'librpm, listdir'
+            if in_flight:
+                label = 'scheduled, %s' % in_flight
+            print('%-20s %9.3fs %12.0f' % (label, duration, count / duration))
+    finally:
+        if not args.folder:
+            shutil.rmtree(folder)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
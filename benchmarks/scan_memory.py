@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a commandline application to manage RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Benchmark the runtime and peak memory (RSS) used to find the duplicated
+RPMs of a repository, comparing the original dict of lists of dicts with
+the RpmEntry records grouped in memory and grouped on disk.
+
+The headers are not read, synthetic entries are generated instead so that
+only the cost of the representation is measured. Each measure is run in
+its own process so that the peak RSS of one does not hide the other.
+"""
+
+from __future__ import print_function
+
+import argparse
+import resource
+import subprocess
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..'))
+
+import repo_manager.repo_manager as repomgr
+
+FOLDER = '/srv/mirrors/repositories/production/el6/x86_64/packages'
+MODES = ['dicts', 'slots', 'external']
+
+
+def generate_entries(count):
+    ''' Yield ``count`` synthetic (name, epoch, version, release, arch,
+    filename) tuples, each application having up to 5 versions.
+    '''
+    for cnt in range(count):
+        name = 'application-%s' % (cnt // 5)
+        version = '%s.%s' % (cnt % 5, cnt % 3)
+        release = '1.el6'
+        yield (name, None, version, release, 'x86_64',
+               '%s-%s-%s.x86_64.rpm' % (name, version, release))
+
+
+def run_dicts(count):
+    ''' Find the duplicates the way get_duplicated_rpms used to. '''
+    seen = {}
+    for name, _, version, release, _, filename in generate_entries(count):
+        entry = {
+            'version': '%s-%s' % (version, release),
+            'filename': os.path.join(FOLDER, filename),
+        }
+        if name in seen:
+            seen[name].append(entry)
+        else:
+            seen[name] = [entry]
+    dups = 0
+    for name in sorted(seen):
+        if len(seen[name]) > 1:
+            dups += 1
+    return dups
+
+
+def run_entries(count, external_sort):
+    ''' Find the duplicates using RpmEntry and group_rpm_entries. '''
+    entries = (
+        repomgr.RpmEntry(
+            name, epoch, version, release, arch, FOLDER, filename)
+        for name, epoch, version, release, arch, filename
+        in generate_entries(count)
+    )
+    dups = 0
+    for _, group in repomgr.group_rpm_entries(
+            entries, external_sort=external_sort):
+        if len(group) > 1:
+            dups += 1
+    return dups
+
+
+def measure(mode, count):
+    ''' Run a single measure and print its runtime and peak RSS. '''
+    start = time.time()
+    if mode == 'dicts':
+        run_dicts(count)
+    else:
+        run_entries(count, external_sort=(mode == 'external'))
+    duration = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%s %s' % (duration, peak))
+
+
+def main():
+    ''' Run the benchmark. '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--sizes', default='10000,100000,500000',
+        help="Comma separated list of number of packages")
+    parser.add_argument('--measure', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        mode, count = args.measure.split(':')
+        measure(mode, int(count))
+        return 0
+
+    print('%10s %10s %10s %14s' % ('packages', 'mode', 'runtime', 'peak RSS'))
+    for size in args.sizes.split(','):
+        for mode in MODES:
+            proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__),
+                 '--measure', '%s:%s' % (mode, size)],
+                stdout=subprocess.PIPE, universal_newlines=True)
+            output = proc.communicate()[0]
+            duration, peak = output.split()
+            print('%10s %10s %9.2fs %11.1f MB' % (
+                size, mode, float(duration), int(peak) / 1024.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
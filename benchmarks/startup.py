@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a commandline application to manage RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Benchmark the startup time of the repo-manager command line: running
+``repo-manager --version`` and an invalid invocation, with the lazy loading
+of the rpm bindings and with the bindings loaded and the transaction set
+created before parsing the arguments, as it used to be done on import.
+"""
+
+from __future__ import print_function
+
+import argparse
+import subprocess
+import sys
+import os
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+LAZY = 'import sys; sys.path.insert(0, %r); ' \
+    'import repo_manager; sys.exit(repo_manager.main())' % ROOT
+EAGER = 'import sys; sys.path.insert(0, %r); ' \
+    'import repo_manager; ' \
+    'repo_manager.repo_manager.get_transaction_set(); ' \
+    'repo_manager.repo_manager.setup_logging(); ' \
+    'sys.exit(repo_manager.main())' % ROOT
+
+
+def _run(code, args, runs):
+    ''' Return the list of durations of ``runs`` invocations. '''
+    durations = []
+    devnull = open(os.devnull, 'w')
+    try:
+        for _ in range(runs):
+            start = time.time()
+            subprocess.call(
+                [sys.executable, '-c', code] + args,
+                stdout=devnull, stderr=devnull)
+            durations.append(time.time() - start)
+    finally:
+        devnull.close()
+    return sorted(durations)
+
+
+def main():
+    ''' Run the benchmark. '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--runs', default=30, type=int,
+        help="Number of invocations per measure")
+    args = parser.parse_args()
+
+    print('%-28s %10s %10s' % ('invocation', 'median', 'p90'))
+    for label, cli_args in [
+            ('--version', ['--version']),
+            ('argparse error', ['unknown-action'])]:
+        for mode, code in [('eager', EAGER), ('lazy', LAZY)]:
+            durations = _run(code, cli_args, args.runs)
+            print('%-28s %8.1fms %8.1fms' % (
+                '%s (%s)' % (label, mode),
+                durations[len(durations) // 2] * 1000,
+                durations[int(len(durations) * 0.9)] * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
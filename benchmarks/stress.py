@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a commandline application to manage RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Stress test of concurrent repo_manager invocations on shared repositories.
+
+``--workers`` workers each run ``--ops`` repo_manager commands (add,
+delete or clean, picked according to ``--mix``) against ``--repos``
+synthetic repositories, at the same time, as happens when several
+``repo_manager`` processes are started on the same folders. createrepo is
+replaced by a stub taking ``--createrepo-delay`` seconds which, as
+createrepo does, fails if another run is writing the repodata of the same
+folder.
+
+The latency percentiles and the failures of each operation are reported,
+as well as the number of runs of createrepo that failed, then the
+repositories are checked:
+
+* lost files: RPMs a worker added and did not delete that are missing (or
+  the other way round), each worker only adding and deleting its own
+  files, the RPMs that clean may remove being ignored,
+* stale repodata: RPMs of the folder not listed in its repodata, or
+  listed but missing,
+* leftovers: temporary files or folders left in the repositories.
+
+The exit code is 1 if any inconsistency is found.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import repo_manager.repo_manager as repomgr
+
+TEST_RPMS = os.path.join(ROOT, 'tests', 'repo')
+CLI = 'import sys; sys.path.insert(0, %r); ' \
+    'import repo_manager; sys.exit(repo_manager.main())' % ROOT
+KEEP = 3
+
+# Writes the list of the RPMs, as the primary metadata would, in
+# .repodata and swaps it in place, failing if .repodata exists like
+# createrepo does
+CREATEREPO_STUB = '''#!/bin/sh
+mkdir .repodata 2>/dev/null || {
+    echo "Error: .repodata already exists" >&2
+    exit 1
+}
+sleep %(delay)s
+ls -1 | grep '\\.rpm$' > .repodata/filelist
+echo '<repomd/>' > .repodata/repomd.xml
+rm -rf .repodata.old
+[ -d repodata ] && mv repodata .repodata.old
+mv .repodata repodata
+rm -rf .repodata.old
+'''
+
+
+def parse_mix(value):
+    ''' Return the list of (operation, weight) of the given mix. '''
+    mix = []
+    for item in value.split(','):
+        operation, weight = item.split('=')
+        if operation not in ('add', 'delete', 'clean'):
+            raise argparse.ArgumentTypeError(
+                'Unknown operation: %s' % operation)
+        mix.append((operation, float(weight)))
+    return mix
+
+
+def percentile(values, fraction):
+    ''' Return the given percentile of the sorted list of values. '''
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Stress(object):
+    ''' Synthetic repositories, workers and the outcome of their runs. '''
+
+    def __init__(self, workdir, repos, workers, files, delay):
+        self.workdir = workdir
+        self.repos = [
+            os.path.join(workdir, 'repo%s' % cnt) for cnt in range(repos)]
+        self.config = os.path.join(workdir, 'repo_manager.cfg')
+        self.sources = os.path.join(workdir, 'sources')
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.failures = {}
+        self.createrepo_failures = {}
+        # (worker, repo, file name) -> expected to be in the repo
+        self.expected = {}
+        # File name -> may be removed by clean
+        self.cleanable = {}
+
+        createrepo = os.path.join(workdir, 'createrepo')
+        stream = open(createrepo, 'w')
+        try:
+            stream.write(CREATEREPO_STUB % {'delay': delay})
+        finally:
+            stream.close()
+        os.chmod(createrepo, 0o755)
+
+        stream = open(self.config, 'w')
+        try:
+            stream.write(
+                '[main]\ncreaterepo = %s\njournal = %s\nlog_file = %s\n'
+                'unique_log = True\n' % (
+                    createrepo, os.path.join(workdir, 'journal'),
+                    os.path.join(workdir, 'repo_manager.log')))
+            for repo in self.repos:
+                stream.write('[%s]\nfolder = %s\n' % (
+                    os.path.basename(repo), repo))
+        finally:
+            stream.close()
+
+        # Each worker adds and deletes its own copies of the RPMs of the
+        # tests, the repos are seeded with another set of copies
+        rpms = sorted(os.listdir(TEST_RPMS))
+        newest = set()
+        for _, group in repomgr.group_rpm_entries(
+                repomgr.iter_rpm_entries(TEST_RPMS)):
+            newest.update(
+                entry.basename
+                for entry in repomgr.split_duplicates(group, KEEP)[0])
+        os.mkdir(self.sources)
+        self.files = {}
+        for worker in range(workers):
+            self.files[worker] = []
+            for cnt in range(files):
+                source = rpms[cnt % len(rpms)]
+                filename = 'w%s-%s-%s' % (worker, cnt, source)
+                shutil.copy2(
+                    os.path.join(TEST_RPMS, source),
+                    os.path.join(self.sources, filename))
+                self.files[worker].append(filename)
+                self.cleanable[filename] = source not in newest
+        for repo in self.repos:
+            os.mkdir(repo)
+            for source in rpms:
+                shutil.copy2(
+                    os.path.join(TEST_RPMS, source),
+                    os.path.join(repo, 'seed-' + source))
+                self.cleanable['seed-' + source] = source not in newest
+
+    def run_cli(self, operation, args):
+        ''' Run repo_manager with the given arguments, record its latency
+        and return whether it succeeded.
+        '''
+        start = time.time()
+        proc = subprocess.Popen(
+            [sys.executable, '-c', CLI, '--config', self.config] + args,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        output = proc.communicate()[0]
+        duration = time.time() - start
+        failed = proc.returncode or 'Traceback' in output \
+            or 'cannot be found' in output
+        with self.lock:
+            self.latencies.setdefault(operation, []).append(duration)
+            if failed:
+                self.failures.setdefault(operation, []).append(
+                    (output.strip().splitlines() or [proc.returncode])[-1])
+            elif 'failed (exit code' in output:
+                # The RPMs were changed but not the repodata
+                self.createrepo_failures[operation] = \
+                    self.createrepo_failures.get(operation, 0) + 1
+        return not failed
+
+    def worker(self, worker, ops, mix, seed):
+        ''' Run ``ops`` operations picked at random according to mix. '''
+        rand = random.Random(seed + worker)
+        operations = [operation for operation, _ in mix]
+        total = sum(weight for _, weight in mix)
+        for _ in range(ops):
+            pick = rand.uniform(0, total)
+            for operation, weight in mix:
+                pick -= weight
+                if pick <= 0:
+                    break
+            repo = rand.choice(self.repos)
+            section = os.path.basename(repo)
+            for filename in self.files[worker]:
+                if self.cleanable[filename] and not os.path.exists(
+                        os.path.join(repo, filename)):
+                    # Removed by a clean
+                    self.expected[(worker, repo, filename)] = False
+            present = [
+                filename for filename in self.files[worker]
+                if self.expected.get((worker, repo, filename))]
+            absent = [
+                filename for filename in self.files[worker]
+                if not self.expected.get((worker, repo, filename))]
+            if operation == 'add' and not absent \
+                    or operation == 'delete' and not present:
+                operation = 'clean' if 'clean' in operations else None
+            if operation == 'add':
+                filename = rand.choice(absent)
+                if self.run_cli('add', [
+                        'add', os.path.join(self.sources, filename),
+                        '--repos', section]):
+                    self.expected[(worker, repo, filename)] = True
+            elif operation == 'delete':
+                filename = rand.choice(present)
+                if self.run_cli('delete', [
+                        'delete', filename, '--repos', section]):
+                    self.expected[(worker, repo, filename)] = False
+            elif operation == 'clean':
+                self.run_cli('clean', [
+                    'clean', section, '--keep', str(KEEP)])
+
+    def check(self):
+        ''' Return the list of inconsistencies found in the repos. '''
+        problems = []
+        for (_, repo, filename), present in sorted(self.expected.items()):
+            exists = os.path.exists(os.path.join(repo, filename))
+            if present and not exists and not self.cleanable[filename]:
+                problems.append('lost: %s/%s' % (
+                    os.path.basename(repo), filename))
+            elif not present and exists:
+                problems.append('not deleted: %s/%s' % (
+                    os.path.basename(repo), filename))
+
+        for repo in self.repos:
+            name = os.path.basename(repo)
+            rpms = set(
+                filename for filename in os.listdir(repo)
+                if filename.endswith('.rpm'))
+            listed = set()
+            filelist = os.path.join(repo, 'repodata', 'filelist')
+            if os.path.exists(filelist):
+                stream = open(filelist)
+                try:
+                    listed = set(stream.read().split())
+                finally:
+                    stream.close()
+            else:
+                problems.append('no repodata: %s' % name)
+            for filename in sorted(rpms - listed):
+                problems.append('not in the repodata: %s/%s' % (
+                    name, filename))
+            for filename in sorted(listed - rpms):
+                problems.append('in the repodata but missing: %s/%s' % (
+                    name, filename))
+            for filename in sorted(os.listdir(repo)):
+                if filename.startswith('.') \
+                        and filename != repomgr.STATE_DIR:
+                    problems.append('leftover: %s/%s' % (name, filename))
+        return problems
+
+
+def main():
+    ''' Run the stress test. '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers', default=8, type=int,
+        help="Number of concurrent workers")
+    parser.add_argument(
+        '--ops', default=20, type=int,
+        help="Number of operations per worker")
+    parser.add_argument(
+        '--mix', default='add=4,delete=3,clean=1', type=parse_mix,
+        help="Weights of the operations, as op=weight,...")
+    parser.add_argument(
+        '--repos', default=2, type=int,
+        help="Number of repositories shared by the workers")
+    parser.add_argument(
+        '--files', default=8, type=int,
+        help="Number of RPMs of each worker")
+    parser.add_argument(
+        '--createrepo-delay', default=0.2, type=float,
+        help="Time, in seconds, taken by the createrepo stub")
+    parser.add_argument(
+        '--seed', default=0, type=int,
+        help="Seed of the random choice of the operations")
+    parser.add_argument(
+        '--keep-workdir', default=False, action='store_true',
+        help="Do not remove the repositories at the end")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='repo_manager-stress-')
+    problems = []
+    try:
+        stress = Stress(
+            workdir, args.repos, args.workers, args.files,
+            args.createrepo_delay)
+        threads = [
+            threading.Thread(
+                target=stress.worker,
+                args=(worker, args.ops, args.mix, args.seed))
+            for worker in range(args.workers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        duration = time.time() - start
+
+        total = sum(len(values) for values in stress.latencies.values())
+        print('%s workers, %s operations in %.1fs, %.1f ops/s' % (
+            args.workers, total, duration, total / duration))
+        print('%-8s %6s %8s %8s %8s %8s %7s %11s' % (
+            'op', 'count', 'p50', 'p90', 'p99', 'max', 'failed',
+            'createrepo'))
+        for operation in sorted(stress.latencies):
+            values = sorted(stress.latencies[operation])
+            print('%-8s %6s %7.3fs %7.3fs %7.3fs %7.3fs %7s %11s' % (
+                operation, len(values), percentile(values, 0.5),
+                percentile(values, 0.9), percentile(values, 0.99),
+                values[-1], len(stress.failures.get(operation, [])),
+                stress.createrepo_failures.get(operation, 0)))
+        for operation in sorted(stress.failures):
+            for failure in stress.failures[operation][:5]:
+                print('  %s failed: %s' % (operation, failure))
+
+        problems = stress.check()
+        print('%s inconsistencies' % len(problems))
+        for problem in problems:
+            print('  %s' % problem)
+    finally:
+        if args.keep_workdir:
+            print('Repositories kept in %s' % workdir)
+        else:
+            shutil.rmtree(workdir)
+    if problems:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -33,6 +33,7 @@ the user).
 %setup -q
 
 %build
+# repo_manager/aio.py is Python 3 only, setup.py leaves it out on Python 2
 %{__python} setup.py build
 
 %install
@@ -42,12 +43,19 @@ the user).
 mkdir -p %{buildroot}/%{_sysconfdir}/%{name}/
 install repo_manager.cfg.sample %{buildroot}/%{_sysconfdir}/%{name}/
 
+# Install the bash completion
+mkdir -p %{buildroot}/%{_sysconfdir}/bash_completion.d/
+PYTHONPATH=%{buildroot}/%{python_sitelib} %{__python} -c \
+    'import sys, repo_manager; sys.argv[1:] = ["completion", "bash"]; repo_manager.main()' \
+    > %{buildroot}/%{_sysconfdir}/bash_completion.d/%{name}
+
 %check
 %{__python} setup.py test
 
 %files
 %doc README.rst LICENSE repo_manager.cfg.sample
 %{_sysconfdir}/%{name}/
+%{_sysconfdir}/bash_completion.d/%{name}
 %{python_sitelib}/%{name}
 %{python_sitelib}/%{name}*.egg-info/
 %{_bindir}/%{name}
@@ -14,19 +14,36 @@
 # license.
 """
 
-import ConfigParser
+from __future__ import absolute_import, print_function
+
 import argparse
 import itertools
+import json
 import logging
 import os
+import re
+import sys
+import time
+
+try:
+    import ConfigParser as configparser
+except ImportError:  # Python 3
+    import configparser
 
-import repo_manager
+# The modules only needed by some actions (batch, mirror, verify) are
+# imported by these actions, keeping the start-up, and the completion,
+# fast
+from . import completion
+from . import journal
+from . import repo_manager
+from . import scan
+from . import snapshot
 
 
 __version__ = '0.1.0'
-logging.basicConfig()
 LOG = logging.getLogger("repo-manager")
-CONFIG = ConfigParser.ConfigParser()
+CONFIG = configparser.ConfigParser()
+EVR_SELECTOR = re.compile(r'^\s*(<=|>=|==|!=|<|>|=)\s*(\S+)\s*$')
 
 
 def _get_repos(args):
@@ -54,6 +71,32 @@ def _get_repos(args):
     return repos
 
 
+def _get_folder(repo):
+    ''' Return the folder of the specified repo, either its name in the
+    configuration or its folder.
+    '''
+    if repo and CONFIG.has_section(repo) and \
+            CONFIG.has_option(repo, 'folder'):
+        return CONFIG.get(repo, 'folder')
+    return repo
+
+
+def _get_mirrors(folder):
+    ''' Return the mirrors of the specified repo set in the configuration.
+    '''
+    folder = os.path.normpath(os.path.expanduser(folder))
+    for section in CONFIG.sections():
+        if CONFIG.has_option(section, 'folder') \
+                and CONFIG.has_option(section, 'mirrors') \
+                and os.path.normpath(os.path.expanduser(
+                    CONFIG.get(section, 'folder'))) == folder:
+            return [
+                target.strip()
+                for target in CONFIG.get(section, 'mirrors').split(',')
+                if target.strip()]
+    return []
+
+
 def _get_no_createrepo(args):
     ''' Return the no-createrepo seeting, either via the CLI argument or the
     configuration.
@@ -68,6 +111,20 @@ def _get_no_createrepo(args):
     return no_createrepo
 
 
+def _get_trash(args):
+    ''' Return the trash setting, either via the CLI argument or the
+    configuration.
+    '''
+    trash = args.trash
+    if not trash:
+        if CONFIG.has_section('main') and \
+                CONFIG.has_option('main', 'trash'):
+            trash = CONFIG.getboolean('main', 'trash')
+        else:
+            trash = False
+    return trash
+
+
 def _get_createrepo_cmd():
     ''' Return the createrepo command to use if one is set in the
     configuration.
@@ -97,6 +154,15 @@ def _get_keep(args):
     return keeps
 
 
+def _get_reporter(args):
+    ''' Return the repo_manager.Reporter for the --format argument.
+
+    With the machine readable formats, the records are written to stdout
+    and info_repo/clean_repo, given the reporter, print nothing else there.
+    '''
+    return repo_manager.Reporter(args.format, sys.stdout)
+
+
 def do_info(args):
     ''' Return information about a repo. '''
     LOG.debug("Info")
@@ -107,27 +173,36 @@ def do_info(args):
     keeps = _get_keep(args)
     if keeps:
         keeps = keeps[0]
+    report = _get_reporter(args)
     for repo in repos:
-        repo_manager.info_repo(repo, keeps)
+        repo_manager.info_repo(
+            repo, keeps, external_sort=args.external_sort,
+            report=report if args.format != 'text' else None)
+    report.close()
 
 
 def do_add(args):
     ''' Add a rpm to a repository. '''
     LOG.debug("Add")
     LOG.debug("rpms    : {0}".format(args.rpms))
-    LOG.debug("repo    : {0}".format(args.repo))
+    LOG.debug("repos   : {0}".format(args.repos))
     LOG.debug("config  : {0}".format(args.configfile))
     LOG.debug("no createrepo  : {0}".format(args.no_createrepo))
     repos = _get_repos(args)
     no_createrepo = _get_no_createrepo(args)
     createrepo_cmd = _get_createrepo_cmd()
+    return_code = 0
     for rpm, repo in itertools.product(args.rpms, repos):
-        repo_manager.add_rpm(
+        status = repo_manager.add_rpm(
             rpm, repo,
             no_createrepo=no_createrepo,
             createrepo_cmd=createrepo_cmd,
             message=args.message,
+            force_createrepo=args.force_createrepo,
         )
+        if status == repo_manager.CONFLICT:
+            return_code = 1
+    return return_code
 
 
 def do_clean(args):
@@ -137,21 +212,61 @@ def do_clean(args):
     LOG.debug("keep       : {0}".format(args.keep))
     LOG.debug("clean_srpm : {0}".format(args.clean_srpm))
     LOG.debug("dry_run    : {0}".format(args.dry_run))
+    LOG.debug("plan_out   : {0}".format(args.plan_out))
+    LOG.debug("apply      : {0}".format(args.apply))
     LOG.debug("config     : {0}".format(args.configfile))
     LOG.debug("no createrepo  : {0}".format(args.no_createrepo))
-    repos = _get_repos(args)
-    keeps = _get_keep(args)
     no_createrepo = _get_no_createrepo(args)
     createrepo_cmd = _get_createrepo_cmd()
+
+    if args.apply:
+        stream = open(args.apply)
+        try:
+            plan = json.load(stream)
+        finally:
+            stream.close()
+        refused = repo_manager.apply_clean_plan(
+            plan['files'],
+            no_createrepo=no_createrepo,
+            createrepo_cmd=createrepo_cmd,
+            trash=_get_trash(args),
+            force_createrepo=args.force_createrepo,
+        )
+        if refused:
+            return 1
+        return
+
+    repos = _get_repos(args)
+    keeps = _get_keep(args)
+    plan = None
+    if args.plan_out:
+        plan = []
+    report = _get_reporter(args)
     for repo, keep in itertools.product(repos, keeps):
         repo_manager.clean_repo(
             repo,
             keep=keep,
             srpm=args.clean_srpm,
-            dry_run=args.dry_run,
+            dry_run=args.dry_run or plan is not None,
             no_createrepo=no_createrepo,
             createrepo_cmd=createrepo_cmd,
+            external_sort=args.external_sort,
+            trash=_get_trash(args),
+            check_deps=args.check_deps,
+            force_createrepo=args.force_createrepo,
+            plan=plan,
+            report=report if args.format != 'text' else None,
         )
+    report.close()
+
+    if args.plan_out:
+        stream = open(args.plan_out, 'w')
+        try:
+            json.dump(
+                {'created': time.time(), 'files': plan},
+                stream, indent=2, sort_keys=True)
+        finally:
+            stream.close()
 
 
 def do_delete(args):
@@ -159,59 +274,407 @@ def do_delete(args):
     LOG.debug("Delete")
     LOG.debug("rpms    : {0}".format(args.rpms))
     LOG.debug("repo    : {0}".format(args.repos))
+    LOG.debug("name    : {0}".format(args.name))
+    LOG.debug("evr     : {0}".format(args.evr))
+    LOG.debug("arch    : {0}".format(args.arch))
+    LOG.debug("older_than : {0}".format(args.older_than))
+    LOG.debug("dry_run : {0}".format(args.dry_run))
     LOG.debug("config  : {0}".format(args.configfile))
     LOG.debug("no createrepo  : {0}".format(args.no_createrepo))
+    selectors = [args.name, args.evr, args.arch, args.older_than]
+    if args.rpms and any(selector is not None for selector in selectors):
+        print('Specify either RPMs or selectors (--name, --evr, --arch, '\
+            '--older-than), not both')
+        return 2
+    elif not args.rpms and all(selector is None for selector in selectors):
+        print('Specify the RPMs to delete or selectors (--name, --evr, '\
+            '--arch, --older-than)')
+        return 2
+    elif args.rpms and args.dry_run:
+        print('--dry-run is only supported with selectors')
+        return 2
+
     repos = _get_repos(args)
     no_createrepo = _get_no_createrepo(args)
     createrepo_cmd = _get_createrepo_cmd()
-    for rpm, repo in itertools.product(args.rpms, repos):
-        repo_manager.delete_rpm(
-            rpm,
+    # One batch per repo: its dependencies are checked for all the RPMs
+    # at once and createrepo is run once
+    for repo in repos:
+        repo_manager.delete_rpms(
             repo,
+            name=args.name,
+            evr=args.evr,
+            arch=args.arch,
+            older_than=args.older_than,
+            dry_run=args.dry_run,
             no_createrepo=no_createrepo,
             createrepo_cmd=createrepo_cmd,
             message=args.message,
+            trash=_get_trash(args),
+            check_deps=args.check_deps,
+            force_createrepo=args.force_createrepo,
+            rpms=args.rpms or None,
         )
 
 
+def do_undo(args):
+    ''' Restore the files removed by the last clean or delete. '''
+    LOG.debug("Undo")
+    LOG.debug("repos   : {0}".format(args.repos))
+    LOG.debug("config  : {0}".format(args.configfile))
+    repos = _get_repos(args)
+    no_createrepo = _get_no_createrepo(args)
+    createrepo_cmd = _get_createrepo_cmd()
+    for repo in repos:
+        repo_manager.undo_trash(
+            repo,
+            no_createrepo=no_createrepo,
+            createrepo_cmd=createrepo_cmd,
+            force_createrepo=args.force_createrepo,
+        )
+
+
+def do_purge(args):
+    ''' Remove for good the files in the trash of a repository. '''
+    LOG.debug("Purge")
+    LOG.debug("repos      : {0}".format(args.repos))
+    LOG.debug("older_than : {0}".format(args.older_than))
+    LOG.debug("config     : {0}".format(args.configfile))
+    repos = _get_repos(args)
+    for repo in repos:
+        repo_manager.purge_trash(repo, older_than=args.older_than)
+
+
+def _get_snapshots_keep(args):
+    ''' Return the number of snapshots to keep, either via the CLI argument
+    or the configuration, None to keep them all.
+    '''
+    keep = args.keep
+    if keep is None and CONFIG.has_section('main') and \
+            CONFIG.has_option('main', 'snapshots_keep'):
+        keep = CONFIG.getint('main', 'snapshots_keep')
+    return keep
+
+
+def do_snapshot(args):
+    ''' Take a snapshot of a repository. '''
+    LOG.debug("Snapshot")
+    LOG.debug("repos   : {0}".format(args.repos))
+    LOG.debug("label   : {0}".format(args.label))
+    LOG.debug("keep    : {0}".format(args.keep))
+    LOG.debug("list    : {0}".format(args.list))
+    LOG.debug("config  : {0}".format(args.configfile))
+    repos = _get_repos(args)
+    for repo in repos:
+        if args.list:
+            print(repo)
+            for name in snapshot.list_snapshots(os.path.expanduser(repo)):
+                print('  %s' % name)
+            continue
+        snapshot.snapshot_repo(
+            repo, label=args.label, keep=_get_snapshots_keep(args))
+
+
+def do_rollback(args):
+    ''' Restore a repository from one of its snapshots. '''
+    LOG.debug("Rollback")
+    LOG.debug("repos    : {0}".format(args.repos))
+    LOG.debug("snapshot : {0}".format(args.snapshot))
+    LOG.debug("config   : {0}".format(args.configfile))
+    repos = _get_repos(args)
+    return_code = 0
+    for repo in repos:
+        if not snapshot.rollback_repo(
+                repo, name=args.snapshot, trash=_get_trash(args)):
+            return_code = 1
+    return return_code
+
+
 def do_upgrade(args):
     ''' Update/Copy rpms from a repository into others. '''
     LOG.debug("Update")
     LOG.debug("rpms    : {0}".format(args.rpms))
     LOG.debug("repo    : {0}".format(args.repo_from))
-    LOG.debug("repo    : {0}".format(args.repo))
+    LOG.debug("repos   : {0}".format(args.repos))
     LOG.debug("config  : {0}".format(args.configfile))
     LOG.debug("no createrepo  : {0}".format(args.no_createrepo))
     repos = _get_repos(args)
     no_createrepo = _get_no_createrepo(args)
     createrepo_cmd = _get_createrepo_cmd()
+    return_code = 0
     for rpm, repo in itertools.product(args.rpms, repos):
-        repo_manager.ugrade_rpm(
+        status = repo_manager.ugrade_rpm(
             rpm,
-            repo_from=args.repo_from,
+            folder_from=args.repo_from,
             folder_to=repo,
             no_createrepo=no_createrepo,
             createrepo_cmd=createrepo_cmd,
             message=args.message,
+            force_createrepo=args.force_createrepo,
         )
+        if status == repo_manager.CONFLICT:
+            return_code = 1
+    return return_code
 
 
 def do_replace(args):
-    ''' Repleace a rpm of a repository. '''
-    LOG.debug("Repleace")
+    ''' Replace a rpm of a repository by a rebuilt one. '''
+    LOG.debug("Replace")
     LOG.debug("rpms    : {0}".format(args.rpms))
-    LOG.debug("repo    : {0}".format(args.repo))
+    LOG.debug("repos   : {0}".format(args.repos))
     LOG.debug("config  : {0}".format(args.configfile))
     LOG.debug("no createrepo  : {0}".format(args.no_createrepo))
+    repos = _get_repos(args)
     no_createrepo = _get_no_createrepo(args)
     createrepo_cmd = _get_createrepo_cmd()
-    for rpm in args.rpms:
-        repo_manager.replace_rpm(
-            rpm, args.repo,
+    return_code = 0
+    for rpm, repo in itertools.product(args.rpms, repos):
+        status = repo_manager.replace_rpm(
+            rpm, repo,
             no_createrepo=no_createrepo,
             createrepo_cmd=createrepo_cmd,
             message=args.message,
+            force_createrepo=args.force_createrepo,
         )
+        if status not in (repo_manager.REPLACED,
+                          repo_manager.ALREADY_PRESENT):
+            return_code = 1
+    return return_code
+
+
+def do_apply(args):
+    ''' Apply the operations of a manifest to the repositories. '''
+    LOG.debug("Apply")
+    LOG.debug("manifest   : {0}".format(args.manifest))
+    LOG.debug("workers    : {0}".format(args.workers))
+    LOG.debug("dry_run    : {0}".format(args.dry_run))
+    LOG.debug("rollback   : {0}".format(args.rollback))
+    LOG.debug("config     : {0}".format(args.configfile))
+    LOG.debug("no createrepo  : {0}".format(args.no_createrepo))
+    from . import batch
+    try:
+        items, message = batch.load_manifest(args.manifest)
+    except (IOError, ValueError) as err:
+        print('Cannot read the manifest: %s' % err)
+        return 1
+    operations = [
+        batch.Operation(
+            item.get('op'), item.get('rpm'), _get_folder(item.get('repo')),
+            source=_get_folder(item.get('from')))
+        for item in items]
+
+    report = _get_reporter(args)
+    success = batch.apply_operations(
+        operations,
+        workers=args.workers or batch.WORKERS,
+        dry_run=args.dry_run,
+        rollback=args.rollback,
+        no_createrepo=_get_no_createrepo(args),
+        createrepo_cmd=_get_createrepo_cmd(),
+        message=args.message or message,
+        trash=_get_trash(args),
+        force_createrepo=args.force_createrepo,
+        report=report if args.format != 'text' else None,
+    )
+    report.close()
+    if not success:
+        return 1
+
+
+def do_mirror(args):
+    ''' Replicate repositories to their mirror folders. '''
+    LOG.debug("Mirror")
+    LOG.debug("repos      : {0}".format(args.repos))
+    LOG.debug("targets    : {0}".format(args.targets))
+    LOG.debug("workers    : {0}".format(args.workers))
+    LOG.debug("hardlink   : {0}".format(args.hardlink))
+    LOG.debug("dry_run    : {0}".format(args.dry_run))
+    LOG.debug("config     : {0}".format(args.configfile))
+    from . import mirror
+    return_code = 0
+    for repo in _get_repos(args):
+        targets = args.targets or _get_mirrors(repo)
+        if not targets:
+            print('No mirror configured for %s' % repo)
+            return_code = 1
+        for target in targets:
+            stats = mirror.mirror_repo(
+                repo, target,
+                workers=args.workers or mirror.WORKERS,
+                hardlink=args.hardlink,
+                dry_run=args.dry_run,
+            )
+            if stats is None:
+                return_code = 1
+                continue
+            print('%s -> %s' % (stats['folder'], stats['target']))
+            print('  %s RPMs copied, %s hardlinked, %s unchanged, '
+                  '%s removed' % (
+                      stats['copied'], stats['linked'], stats['unchanged'],
+                      stats['removed']))
+            print('  repodata %s in %.3fs' % (
+                'published' if stats['repodata'] else 'unchanged',
+                stats['duration']))
+    return return_code
+
+
+def do_verify(args):
+    ''' Verify the integrity of the RPMs of a repository. '''
+    LOG.debug("Verify")
+    LOG.debug("repos      : {0}".format(args.repos))
+    LOG.debug("workers    : {0}".format(args.workers))
+    LOG.debug("signatures : {0}".format(args.signatures))
+    LOG.debug("full       : {0}".format(args.full))
+    LOG.debug("config     : {0}".format(args.configfile))
+    from . import verify
+    repos = _get_repos(args)
+    results = []
+    for repo in repos:
+        stats = verify.verify_repo(
+            repo,
+            workers=args.workers,
+            signatures=args.signatures,
+            full=args.full,
+        )
+        results.append(stats)
+        print(stats['folder'])
+        print('  %s RPMs verified, %s unchanged RPMs skipped' % (
+            stats['verified'], stats['skipped']))
+        if stats['duration']:
+            print('  %.1f RPMs/s, %.1f MB/s' % (
+                stats['verified'] / stats['duration'],
+                stats['bytes'] / stats['duration'] / 1024 / 1024))
+        print('  %s failures' % len(stats['failures']))
+        for failure in stats['failures']:
+            print('    %s: %s' % (
+                failure['file'], ', '.join(failure['errors'])))
+
+    if args.failures_out:
+        stream = open(args.failures_out, 'w')
+        try:
+            json.dump(results, stream, indent=2, sort_keys=True)
+        finally:
+            stream.close()
+
+    for stats in results:
+        if stats['failures']:
+            return 1
+
+
+def _parse_date(value):
+    ''' Return the timestamp of the given date, either YYYY-MM-DD or
+    YYYY-MM-DD HH:MM:SS.
+    '''
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError(
+        'Invalid date %r, use YYYY-MM-DD [HH:MM:SS]' % value)
+
+
+def _parse_evr(value):
+    ''' Return a tuple (operator, EVR) from a selector such as ``<0.6`` or
+    ``>= 1:2.0-3``.
+    '''
+    match = EVR_SELECTOR.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError(
+            'Invalid EVR selector %r, use for example "<0.6" or '
+            '">=1:2.0-3"' % value)
+    return (match.group(1), match.group(2))
+
+
+def _parse_arch(value):
+    ''' Return the list of architectures of a comma separated list. '''
+    return [arch.strip() for arch in value.split(',') if arch.strip()]
+
+
+def _get_journal():
+    ''' Return the path to the journal, either the one set in the
+    configuration or the default one.
+    '''
+    path = journal.DEFAULT_JOURNAL
+    if CONFIG.has_section('main') and \
+            CONFIG.has_option('main', 'journal'):
+        path = CONFIG.get('main', 'journal')
+    return path
+
+
+def do_history(args):
+    ''' Show the actions recorded in the journal. '''
+    LOG.debug("History")
+    LOG.debug("name    : {0}".format(args.name))
+    LOG.debug("since   : {0}".format(args.since))
+    LOG.debug("until   : {0}".format(args.until))
+    LOG.debug("config  : {0}".format(args.configfile))
+    for entry in repo_manager.JOURNAL.history(
+            args.name, since=args.since, until=args.until):
+        print('{0} {1} {2:<8} {3} {4} [{5}]{6}'.format(
+            time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(entry['timestamp'])),
+            entry['user'],
+            entry['action'],
+            entry['nevra'] or entry['file'],
+            entry['repo'],
+            entry['batch'],
+            ' - %s' % entry['message'] if entry['message'] else '',
+        ))
+
+
+def do_completion(args):
+    ''' Print the shell completion script. '''
+    LOG.debug("Completion")
+    LOG.debug("shell   : {0}".format(args.shell))
+    print(completion.generate(setup_parser(), shell=args.shell))
+
+
+def _read_config(configfile=None):
+    ''' Read the specified configuration file or the default one. '''
+    if configfile:
+        CONFIG.read(configfile)
+    elif os.path.exists('/etc/repo_manager.cfg'):
+        CONFIG.read('/etc/repo_manager.cfg')
+
+
+def _setup_scan():
+    ''' Read the headers of the repos configured with ``scan = scheduled``
+    using the I/O-scheduled scan.
+    '''
+    for section in CONFIG.sections():
+        if not CONFIG.has_option(section, 'folder') \
+                or not CONFIG.has_option(section, 'scan'):
+            continue
+        mode = CONFIG.get(section, 'scan')
+        if mode != 'scheduled':
+            if mode != 'librpm':
+                LOG.warning('Unknown scan mode "%s" for %s', mode, section)
+            continue
+        in_flight = scan.IN_FLIGHT
+        if CONFIG.has_option(section, 'scan_in_flight'):
+            in_flight = CONFIG.getint(section, 'scan_in_flight')
+        folder = os.path.normpath(
+            os.path.expanduser(CONFIG.get(section, 'folder')))
+        repo_manager.SCHEDULED_SCAN[folder] = in_flight
+
+
+def _complete(argv):
+    ''' Print the completions requested by the completion script, argv
+    being ``[kind, prefix, words...]``.
+
+    This is called before anything else is set up, to answer quickly.
+    '''
+    if len(argv) < 2:
+        return 2
+    kind, prefix, words = argv[0], argv[1], argv[2:]
+    configfile = None
+    if '--config' in words[:-1]:
+        configfile = words[words.index('--config') + 1]
+    _read_config(configfile)
+    for value in completion.complete(kind, prefix, words, CONFIG):
+        print(value)
+    return 0
 
 
 def setup_parser():
@@ -227,6 +690,14 @@ def setup_parser():
     parser.add_argument(
         '--no-createrepo', default=False, action='store_true',
         help="Do not run createrepo on the repo")
+    parser.add_argument(
+        '--force-createrepo', default=False, action='store_true',
+        help="Run createrepo even if the RPMs of the repo did not change "
+        "since its last run")
+    parser.add_argument(
+        '--trash', default=False, action='store_true',
+        help="Move the files removed by clean and delete to the trash of "
+        "the repo instead of deleting them")
     parser.add_argument(
         '--debug', action='store_true',
         help="Outputs bunches of debugging info")
@@ -246,6 +717,14 @@ def setup_parser():
     parser_acl.add_argument(
         '--keep', default=3, type=int,
         help="Number of RPMs of an application to keep")
+    parser_acl.add_argument(
+        '--external-sort', default=False, action='store_true',
+        help="Group the RPMs by name on disk to keep the memory usage low "
+        "on very large repositories")
+    parser_acl.add_argument(
+        '--format', default='text', choices=['text', 'json', 'ndjson'],
+        help="Output format, json and ndjson stream one record per "
+        "package and a summary record, implies --external-sort")
     parser_acl.set_defaults(func=do_info)
 
     # ADD
@@ -273,13 +752,40 @@ def setup_parser():
     parser_acl.add_argument(
         '--keep', default=3, type=int,
         help="Number of RPMs of an application to keep")
-    parser_acl.add_argument(
+    srpm_group = parser_acl.add_mutually_exclusive_group()
+    srpm_group.add_argument(
         '--clean-srpm', default=False, action='store_true',
         help="Clean source rpm from this repository")
+    srpm_group.add_argument(
+        '--orphan-srpm', dest='clean_srpm', action='store_const',
+        const='orphans',
+        help="Only clean the source rpm no remaining rpm was built from "
+        "and, for the source rpm without rpm, apply --keep")
     parser_acl.add_argument(
         '--dry-run', default=False, action='store_true',
         help="Does a dry-run, does not delete anything but outputs what it "
         "would do.")
+    parser_acl.add_argument(
+        '--external-sort', default=False, action='store_true',
+        help="Group the RPMs by name on disk to keep the memory usage low "
+        "on very large repositories")
+    parser_acl.add_argument(
+        '--check-deps', default=None, choices=['warn', 'skip'],
+        help="Report (warn) or do not remove (skip) the RPMs whose removal "
+        "would leave requirements of the remaining RPMs unresolved")
+    parser_acl.add_argument(
+        '--format', default='text', choices=['text', 'json', 'ndjson'],
+        help="Output format, json and ndjson stream one record per RPM "
+        "removed and a summary record, implies --external-sort")
+    plan_group = parser_acl.add_mutually_exclusive_group()
+    plan_group.add_argument(
+        '--plan-out', default=None,
+        help="Does a dry-run and writes the files to remove, as JSON, to "
+        "this file")
+    plan_group.add_argument(
+        '--apply', default=None,
+        help="Remove the files listed in this plan (see --plan-out) "
+        "without scanning the repositories again")
     parser_acl.set_defaults(func=do_clean)
 
     # DELETE
@@ -287,20 +793,170 @@ def setup_parser():
         'delete',
         help='delete one or more RPMs into a repository')
     parser_acl.add_argument(
-        'rpms', default=None, nargs="+",
-        help="RPMs to delete")
+        'rpms', default=None, nargs="*",
+        help="RPMs to delete, or use the selectors below")
     parser_acl.add_argument(
         '--repos', default=None, nargs="*",
         help="Repositories to delete the RPMs from")
     parser_acl.add_argument(
         '-m', '--message', default=None,
         help="Message added to the log file(s) and explaining the action")
+    parser_acl.add_argument(
+        '--check-deps', default=None, choices=['warn', 'skip'],
+        help="Report (warn) or do not remove (skip) the RPMs whose removal "
+        "would leave requirements of the remaining RPMs unresolved")
+    parser_acl.add_argument(
+        '--name', default=None,
+        help="Delete the RPMs whose name matches this glob")
+    parser_acl.add_argument(
+        '--evr', default=None, type=_parse_evr,
+        help="Delete the RPMs whose [epoch:]version[-release] compares as "
+        "specified, for example \"<0.6\"")
+    parser_acl.add_argument(
+        '--arch', default=None, type=_parse_arch,
+        help="Delete the RPMs of these (comma separated) architectures")
+    parser_acl.add_argument(
+        '--older-than', default=None, type=float,
+        help="Delete the RPMs built more than this number of days ago")
+    parser_acl.add_argument(
+        '--dry-run', default=False, action='store_true',
+        help="Does a dry-run, does not delete anything but outputs what it "
+        "would do (only with selectors)")
     parser_acl.set_defaults(func=do_delete)
 
+    # HISTORY
+    parser_acl = subparsers.add_parser(
+        'history',
+        help='Show the actions done on the repositories')
+    parser_acl.add_argument(
+        'name', default=None, nargs="?",
+        help="Name of the package to show the history of")
+    parser_acl.add_argument(
+        '--since', default=None, type=_parse_date,
+        help="Only show the actions done since this date "
+        "(YYYY-MM-DD [HH:MM:SS])")
+    parser_acl.add_argument(
+        '--until', default=None, type=_parse_date,
+        help="Only show the actions done until this date "
+        "(YYYY-MM-DD [HH:MM:SS])")
+    parser_acl.set_defaults(func=do_history)
+
+    # VERIFY
+    parser_acl = subparsers.add_parser(
+        'verify',
+        help='Verify the integrity of the RPMs of a repository')
+    parser_acl.add_argument(
+        'repos', default=None, nargs="*",
+        help="Repositories to verify")
+    parser_acl.add_argument(
+        '--workers', default=4, type=int,
+        help="Number of RPMs verified in parallel")
+    parser_acl.add_argument(
+        '--signatures', default=False, action='store_true',
+        help="Check the signatures of the RPMs as well")
+    parser_acl.add_argument(
+        '--full', default=False, action='store_true',
+        help="Verify again the RPMs already verified and not changed since")
+    parser_acl.add_argument(
+        '--failures-out', default=None,
+        help="Write the statistics and the failures, as JSON, to this file")
+    parser_acl.set_defaults(func=do_verify)
+
+    # MIRROR
+    parser_acl = subparsers.add_parser(
+        'mirror',
+        help='Copy the RPMs changed and the repodata of a repository to its '
+        'mirror folders')
+    parser_acl.add_argument(
+        'repos', default=None, nargs="*",
+        help="Repositories to mirror")
+    parser_acl.add_argument(
+        '--targets', default=None, nargs="+",
+        help="Mirror folders, instead of the ones set in the configuration "
+        "(mirrors)")
+    parser_acl.add_argument(
+        '--workers', default=None, type=int,
+        help="Number of RPMs copied in parallel, 4 by default")
+    parser_acl.add_argument(
+        '--hardlink', default=False, action='store_true',
+        help="Hardlink the RPMs and the repodata instead of copying them, "
+        "when the mirror is on the same file system")
+    parser_acl.add_argument(
+        '--dry-run', default=False, action='store_true',
+        help="Does a dry-run, does not copy anything but outputs what it "
+        "would do.")
+    parser_acl.set_defaults(func=do_mirror)
+
+    # UNDO
+    parser_acl = subparsers.add_parser(
+        'undo',
+        help='Restore the files removed by the last clean or delete, '
+        'requires the trash')
+    parser_acl.add_argument(
+        'repos', default=None, nargs="*",
+        help="Repositories to restore")
+    parser_acl.set_defaults(func=do_undo)
+
+    # PURGE
+    parser_acl = subparsers.add_parser(
+        'purge',
+        help='Remove for good the files in the trash of a repository')
+    parser_acl.add_argument(
+        'repos', default=None, nargs="*",
+        help="Repositories to purge")
+    parser_acl.add_argument(
+        '--older-than', default=None, type=float,
+        help="Only purge the files moved to the trash more than this "
+        "number of days ago")
+    parser_acl.set_defaults(func=do_purge)
+
+    # SNAPSHOT
+    parser_acl = subparsers.add_parser(
+        'snapshot',
+        help='Take a snapshot, using hardlinks, of the RPMs and the repodata '
+        'of a repository')
+    parser_acl.add_argument(
+        'repos', default=None, nargs="*",
+        help="Repositories to snapshot")
+    parser_acl.add_argument(
+        '--label', default=None,
+        help="Label added to the name of the snapshot")
+    parser_acl.add_argument(
+        '--keep', default=None, type=int,
+        help="Number of snapshots of the repository to keep")
+    parser_acl.add_argument(
+        '--list', default=False, action='store_true',
+        help="List the snapshots instead of taking one")
+    parser_acl.set_defaults(func=do_snapshot)
+
+    # ROLLBACK
+    parser_acl = subparsers.add_parser(
+        'rollback',
+        help='Restore a repository from one of its snapshots')
+    parser_acl.add_argument(
+        'repos', default=None, nargs="*",
+        help="Repositories to restore")
+    parser_acl.add_argument(
+        '--snapshot', default=None,
+        help="Name or label of the snapshot to restore, the most recent one "
+        "by default")
+    parser_acl.set_defaults(func=do_rollback)
+
+    # COMPLETION
+    parser_acl = subparsers.add_parser(
+        'completion',
+        help='Print the bash or zsh completion script, for example: '
+        'repo_manager completion bash > /etc/bash_completion.d/repo_manager')
+    parser_acl.add_argument(
+        'shell', default='bash', nargs="?", choices=['bash', 'zsh'],
+        help="Shell to generate the completion script for")
+    parser_acl.set_defaults(func=do_completion)
+
     # REPLACE
     parser_acl = subparsers.add_parser(
         'replace',
-        help='Replace one or more RPMs in a repository')
+        help='Replace one or more RPMs of a repository by rebuilt RPMs '
+        'of the same name, version and release')
     parser_acl.add_argument(
         'rpms', default=None, nargs="+",
         help="RPMs to replace")
@@ -312,6 +968,33 @@ def setup_parser():
         help="Message added to the log file(s) and explaining the action")
     parser_acl.set_defaults(func=do_replace)
 
+    # APPLY
+    parser_acl = subparsers.add_parser(
+        'apply',
+        help='Apply the add, delete, upgrade and replace operations of a '
+        'JSON (or YAML) manifest to several repositories at once')
+    parser_acl.add_argument(
+        'manifest',
+        help="Manifest listing the operations")
+    parser_acl.add_argument(
+        '--workers', default=None, type=int,
+        help="Number of operations run in parallel, 4 by default")
+    parser_acl.add_argument(
+        '--dry-run', default=False, action='store_true',
+        help="Only validate the operations")
+    parser_acl.add_argument(
+        '--rollback', default=False, action='store_true',
+        help="Undo all the operations if one of them fails")
+    parser_acl.add_argument(
+        '-m', '--message', default=None,
+        help="Message added to the log file(s) and explaining the action, "
+        "overrides the one of the manifest")
+    parser_acl.add_argument(
+        '--format', default='text', choices=['text', 'json', 'ndjson'],
+        help="Output format, json and ndjson stream one record per "
+        "operation")
+    parser_acl.set_defaults(func=do_apply)
+
     # UPGRADE
     parser_acl = subparsers.add_parser(
         'upgrade',
@@ -323,7 +1006,7 @@ def setup_parser():
         '--repo_from', default=None, nargs="?",
         help="Repository from which to copy the RPMs")
     parser_acl.add_argument(
-        '--repos', default=None, nargs="?",
+        '--repos', default=None, nargs="*",
         help="Repositories to copy the RPMs to")
     parser_acl.add_argument(
         '-m', '--message', default=None,
@@ -336,54 +1019,45 @@ def setup_parser():
 def main():
     ''' Main function of the repo_manager project.
     '''
+    if sys.argv[1:2] == ['_complete']:
+        return _complete(sys.argv[2:])
+
     # Set up parser for global args
     parser = setup_parser()
     # Parse the commandline
     try:
         arg = parser.parse_args()
-    except argparse.ArgumentTypeError, err:
-        print "\nError: {0}".format(err)
+    except argparse.ArgumentTypeError as err:
+        print("\nError: {0}".format(err))
         return 2
 
     if arg.debug:
         LOG.setLevel(logging.DEBUG)
-        logging.getLogger('').handlers[1].setLevel(logging.DEBUG)
 
-    # The stream logger is always at INFO
-    logging.getLogger('').handlers[0].setLevel(logging.INFO)
-
-    global CONFIG
-    if arg.configfile:
-        CONFIG.read(arg.configfile)
-    elif os.path.exists('/etc/repo_manager.cfg'):
-        CONFIG.read('/etc/repo_manager.cfg')
+    _read_config(arg.configfile)
 
+    log_file = None
+    unique_log = False
     if CONFIG.has_section('main') and \
             CONFIG.has_option('main', 'log_file'):
         log_file = CONFIG.get('main', 'log_file')
-        if CONFIG.has_option('main', 'unique_log') \
-                and CONFIG.getboolean('main', 'unique_log'):
-            # Close/Remove existing logfile
-            repo_manager.LOG.handlers[0].stream.close()
-            repo_manager.LOG.removeHandler(repo_manager.LOG.handlers[0])
-
-        if not repo_manager.LOG.handlers \
-                or repo_manager.LOG.handlers[0].baseFilename != log_file:
-            # Create new logfile
-            repo_manager.HDLER = logging.FileHandler(log_file)
-            repo_manager.HDLER.setFormatter(
-                logging.Formatter(
-                    '%(asctime)s %(levelname)-8s %(message)s'))
-            repo_manager.HDLER.setLevel(logging.INFO)
-            repo_manager.LOG.addHandler(repo_manager.HDLER)
+        if CONFIG.has_option('main', 'unique_log'):
+            unique_log = CONFIG.getboolean('main', 'unique_log')
+    repo_manager.setup_logging(
+        log_file=log_file, unique_log=unique_log, debug=arg.debug)
+    repo_manager.JOURNAL = journal.Journal(_get_journal())
+    _setup_scan()
 
     return_code = 0
 
     try:
-        arg.func(arg)
+        return_code = arg.func(arg) or 0
     except KeyboardInterrupt:
-        print "\nInterrupted by user."
+        print("\nInterrupted by user.")
         return_code = 1
+    finally:
+        # Write what was done, even if interrupted
+        repo_manager.JOURNAL.flush()
 
     return return_code
 
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Asyncio API, to use repo_manager from a service running an event loop.
+
+The coroutines have the same arguments, outputs and return values as
+the functions of repo_manager.repo_manager of the same name. The copies,
+removals and header reads are run in an executor (the default one of the
+loop unless one is specified) and createrepo in an asyncio subprocess,
+which is killed when it times out or when the task is cancelled.
+
+The operations on a given folder are run one at a time while operations
+on different folders run concurrently.
+
+This module requires Python 3.5 or later and is not imported by the
+package.
+"""
+
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import signal
+import time
+import warnings
+import weakref
+
+from . import repo_manager
+
+
+LOG = logging.getLogger('repo_manager')
+
+# Default timeout, in seconds, of createrepo
+CREATEREPO_TIMEOUT = 3600
+
+# Event loop -> folder -> lock, asyncio locks being bound to a loop
+_LOCKS = weakref.WeakKeyDictionary()
+
+# Loop running the current coroutine, get_running_loop being Python 3.7+
+_get_running_loop = getattr(
+    asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+def _get_lock(folder):
+    ''' Return the lock of the running loop serializing the operations on
+    the specified folder.
+    '''
+    locks = _LOCKS.setdefault(_get_running_loop(), {})
+    folder = os.path.realpath(os.path.expanduser(folder))
+    if folder not in locks:
+        locks[folder] = asyncio.Lock()
+    return locks[folder]
+
+
+async def _run(executor, func, *args, **kwargs):
+    ''' Run the given function in the executor and return its result. '''
+    return await _get_running_loop().run_in_executor(
+        executor, functools.partial(func, *args, **kwargs))
+
+
+def _kill(proc):
+    ''' Kill the given process and its children. '''
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+async def _run_createrepo(folder, createrepo_cmd, force, timeout, executor):
+    ''' Run createrepo in the specified folder, see run_createrepo. '''
+    folder = os.path.expanduser(folder)
+    if not os.path.exists(folder):
+        print('Folder "%s" does not exist' % folder)
+        return
+    elif not os.path.isdir(folder):
+        print('"%s" is not a folder' % folder)
+        return
+
+    LOG.debug('run_createrepo')
+    createrepo_cmd = createrepo_cmd or 'createrepo'
+    start = time.time()
+    cnt, digest = await _run(
+        executor, repo_manager.repo_manifest, folder, createrepo_cmd)
+    duration = time.time() - start
+    if not force and await _run(
+            executor, repo_manager.read_manifest, folder) == digest:
+        LOG.info('Content of %s unchanged, not running %s',
+                 folder, createrepo_cmd)
+        print('  repodata up to date, createrepo skipped '
+              '(%s RPMs checked in %.3fs)' % (cnt, duration))
+        return False
+
+    LOG.info('Run %s on %s', createrepo_cmd, folder)
+    cmd = [createrepo_cmd, '.']
+    LOG.debug('  Calling  : `%s` from %s', cmd, folder)
+    # In its own session so that the whole process group can be killed
+    proc = await asyncio.create_subprocess_shell(
+        ' '.join(cmd), cwd=folder, start_new_session=True)
+    try:
+        return_code = await asyncio.wait_for(proc.wait(), timeout)
+    except asyncio.TimeoutError:
+        _kill(proc)
+        await proc.wait()
+        return_code = None
+    except asyncio.CancelledError:
+        _kill(proc)
+        await proc.wait()
+        await _run(executor, _remove_partial_repodata, folder)
+        raise
+
+    if return_code is None:
+        await _run(executor, _remove_partial_repodata, folder)
+        LOG.warning('%s timed out on %s', createrepo_cmd, folder)
+        print('  %s timed out after %ss' % (createrepo_cmd, timeout))
+    elif return_code:
+        LOG.warning('%s failed on %s', createrepo_cmd, folder)
+        print('  %s failed (exit code %s)' % (createrepo_cmd, return_code))
+    else:
+        # Not recorded if the content changed while createrepo ran
+        _, after = await _run(
+            executor, repo_manager.repo_manifest, folder, createrepo_cmd)
+        if after == digest:
+            await _run(
+                executor, repo_manager.write_manifest, folder, digest)
+        print('  repodata regenerated (%s RPMs)' % cnt)
+    return True
+
+
+def _remove_partial_repodata(folder):
+    ''' Remove the temporary repodata left by a createrepo killed, which
+    would make the next run fail.
+    '''
+    shutil.rmtree(os.path.join(folder, '.repodata'), ignore_errors=True)
+
+
+async def run_createrepo(folder, createrepo_cmd=None, force=False,
+                         timeout=CREATEREPO_TIMEOUT, executor=None):
+    ''' Run the ``createrepo`` command in the specified folder, killing it
+    if it does not complete within ``timeout`` seconds.
+
+    See repo_manager.run_createrepo, a createrepo timing out is reported
+    as a failure: the repodata is left as it was.
+    '''
+    async with _get_lock(folder):
+        return await _run_createrepo(
+            folder, createrepo_cmd, force, timeout, executor)
+
+
+async def add_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
+                  message=None, force_createrepo=False,
+                  timeout=CREATEREPO_TIMEOUT, executor=None):
+    ''' Copy the provided RPM into the specified folder, see
+    repo_manager.add_rpm.
+    '''
+    async with _get_lock(folder):
+        status = await _run(
+            executor, repo_manager.add_rpm, rpm, folder,
+            no_createrepo=True, message=message)
+        if status == repo_manager.ADDED and not no_createrepo:
+            await _run_createrepo(
+                folder, createrepo_cmd, force_createrepo, timeout, executor)
+    return status
+
+
+async def delete_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
+                     message=None, trash=False, check_deps=None,
+                     force_createrepo=False, timeout=CREATEREPO_TIMEOUT,
+                     executor=None):
+    ''' Delete the specified RPM of the specified folder, see
+    repo_manager.delete_rpm.
+    '''
+    async with _get_lock(folder):
+        removed = await _run(
+            executor, repo_manager.delete_rpm, rpm, folder,
+            no_createrepo=True, message=message, trash=trash,
+            check_deps=check_deps)
+        if removed and not no_createrepo:
+            await _run_createrepo(
+                folder, createrepo_cmd, force_createrepo, timeout, executor)
+    return removed
+
+
+async def upgrade_rpm(rpm, folder_from, folder_to, no_createrepo=False,
+                      createrepo_cmd=None, message=None,
+                      force_createrepo=False, timeout=CREATEREPO_TIMEOUT,
+                      executor=None):
+    ''' Upgrade/copy the specified RPM from one repo into another one, see
+    repo_manager.ugrade_rpm.
+    '''
+    # Always locked in the same order so that an upgrade from A to B and
+    # one from B to A cannot wait for each other
+    locks = [_get_lock(folder) for folder in sorted(
+        set([os.path.realpath(os.path.expanduser(folder_from)),
+             os.path.realpath(os.path.expanduser(folder_to))]))]
+    acquired = []
+    try:
+        for lock in locks:
+            await lock.acquire()
+            acquired.append(lock)
+        status = await _run(
+            executor, repo_manager.ugrade_rpm, rpm, folder_from, folder_to,
+            no_createrepo=True, message=message)
+        if status == repo_manager.ADDED and not no_createrepo:
+            await _run_createrepo(
+                folder_to, createrepo_cmd, force_createrepo, timeout,
+                executor)
+        if status in (repo_manager.ADDED, repo_manager.ALREADY_PRESENT) \
+                and not no_createrepo:
+            await _run_createrepo(
+                folder_from, createrepo_cmd, force_createrepo, timeout,
+                executor)
+    finally:
+        for lock in reversed(acquired):
+            lock.release()
+    return status
+
+
+async def ugrade_rpm(*args, **kwargs):
+    ''' Deprecated alias of upgrade_rpm. '''
+    warnings.warn(
+        'repo_manager.aio.ugrade_rpm is deprecated, use upgrade_rpm',
+        DeprecationWarning, stacklevel=2)
+    return await upgrade_rpm(*args, **kwargs)
+
+
+async def clean_repo(folder, keep=3, srpm=False, dry_run=False,
+                     no_createrepo=False, createrepo_cmd=None,
+                     external_sort=False, trash=False, check_deps=None,
+                     force_createrepo=False, plan=None, report=None,
+                     timeout=CREATEREPO_TIMEOUT, executor=None):
+    ''' Remove duplicates from a given folder, see repo_manager.clean_repo.
+
+    ``report`` is called from the executor.
+    '''
+    async with _get_lock(folder):
+        await _run(
+            executor, repo_manager.clean_repo, folder, keep=keep, srpm=srpm,
+            dry_run=dry_run, no_createrepo=True,
+            external_sort=external_sort, trash=trash, check_deps=check_deps,
+            plan=plan, report=report)
+        if not dry_run and not no_createrepo \
+                and os.path.isdir(os.path.expanduser(folder)):
+            await _run_createrepo(
+                folder, createrepo_cmd, force_createrepo, timeout, executor)
+
+
+async def info_repo(folder, keep=3, external_sort=False, report=None,
+                    executor=None):
+    ''' Returns some info/stats about the specified repo, see
+    repo_manager.info_repo.
+
+    ``report`` is called from the executor.
+    '''
+    return await _run(
+        executor, repo_manager.info_repo, folder, keep=keep,
+        external_sort=external_sort, report=report)
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Batches of add, delete, upgrade and replace operations described in a
+manifest and applied to several repositories at once.
+
+All the operations are validated before anything is changed, reading the
+content of each repository once (see repo_manager.get_package_index).
+As no two operations may change the same file, they are independent and
+the files are copied and moved in parallel. The RPMs replaced or deleted
+are kept aside, as hidden files of their folder, until all the operations
+succeeded so that the batch can be rolled back, then createrepo is run
+once per repository changed.
+"""
+
+from __future__ import absolute_import, print_function
+
+import json
+import logging
+import os
+import sys
+
+from . import repo_manager
+
+
+LOG = logging.getLogger('repo_manager')
+
+OPERATIONS = ('add', 'delete', 'upgrade', 'replace')
+
+# Outcomes of the operations, besides repo_manager.ALREADY_PRESENT
+DONE = {
+    'add': 'added',
+    'delete': 'deleted',
+    'upgrade': 'upgraded',
+    'replace': 'replaced',
+}
+INVALID = 'invalid'
+FAILED = 'failed'
+ROLLED_BACK = 'rolled back'
+NOT_RUN = 'not run'
+
+# Number of operations run at the same time by default
+WORKERS = 4
+
+
+def load_manifest(path):
+    ''' Return a tuple (operations, message) read from the specified
+    manifest.
+
+    The manifest is a JSON file, or a YAML file if its name ends with
+    ``.yaml`` or ``.yml`` (which requires PyYAML), containing either the
+    list of operations or an object with the ``operations`` and an optional
+    ``message``. Each operation is an object with the ``op`` (add, delete,
+    upgrade or replace), the ``rpm``, the ``repo`` it changes and, to
+    upgrade, the repo to upgrade ``from``. Raises ValueError if the
+    manifest cannot be read.
+    '''
+    stream = open(path)
+    try:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError(
+                    'PyYAML is required to read the manifest %s' % path)
+            content = yaml.safe_load(stream)
+        else:
+            content = json.load(stream)
+    finally:
+        stream.close()
+
+    message = None
+    if isinstance(content, dict):
+        message = content.get('message')
+        content = content.get('operations')
+    if not isinstance(content, list) \
+            or not all(isinstance(item, dict) for item in content):
+        raise ValueError('%s does not contain a list of operations' % path)
+    return (content, message)
+
+
+def _native(value):
+    ''' Return the given string as a native string, json returns unicode
+    strings on Python 2.
+    '''
+    if sys.version_info[0] < 3 and isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _folder(folder):
+    ''' Return the absolute, normalized, path of the given folder so that
+    the same folder is always designated by the same path.
+    '''
+    if not folder:
+        return folder
+    return os.path.abspath(os.path.normpath(
+        os.path.expanduser(_native(folder))))
+
+
+class Operation(object):
+    ''' One operation of a batch, its outcome and how to undo it. '''
+
+    def __init__(self, action, rpm, folder, source=None):
+        self.action = _native(action)
+        self.rpm = rpm and os.path.expanduser(_native(rpm))
+        self.folder = _folder(folder)
+        self.source = _folder(source)
+        self.filename = os.path.basename(self.rpm or '')
+        self.nevra = None
+        # Checksum of the RPM, recorded in the journal
+        self.digest = None
+        self.status = None
+        self.error = None
+        # Copy the RPM into the folder, remove it from the source
+        self.copy = action in ('add', 'upgrade', 'replace')
+        self.remove = action in ('delete', 'upgrade')
+        # Files moved aside: (hidden file, file)
+        self.backups = []
+        # Files added
+        self.added = []
+
+    def record(self):
+        ''' Return the record describing the operation in the report. '''
+        record = {
+            'op': self.action,
+            'rpm': self.rpm,
+            'repo': self.folder,
+            'nevra': self.nevra,
+            'status': self.status,
+        }
+        if self.source:
+            record['from'] = self.source
+        if self.error:
+            record['error'] = self.error
+        return record
+
+
+def _backup_name(filename):
+    ''' Return the hidden file in which a RPM is kept until the batch
+    completes, ignored by createrepo as it does not end with ``.rpm``.
+    '''
+    return os.path.join(
+        os.path.dirname(filename),
+        '.%s.%s.orig' % (os.path.basename(filename), os.getpid()))
+
+
+def validate_operations(operations):
+    ''' Check the given Operation, reading the content of each folder once,
+    and return the list of errors found.
+
+    The operations with nothing to do, the exact same RPM being already in
+    the folder, are marked ALREADY_PRESENT.
+    '''
+    LOG.debug('validate_operations')
+    errors = []
+    indexes = {}
+
+    def _index(folder):
+        ''' Return the file name -> NEVRA of the RPMs of the folder. '''
+        if folder not in indexes:
+            indexes[folder] = dict(
+                (entry.basename, entry.nevra)
+                for entry, _ in repo_manager.get_package_index(folder))
+        return indexes[folder]
+
+    def _error(cnt, operation, message):
+        ''' Record an error of the specified operation. '''
+        operation.status = INVALID
+        operation.error = message
+        errors.append('Operation %s (%s %s): %s' % (
+            cnt + 1, operation.action, operation.rpm, message))
+
+    changed = {}
+    for cnt, operation in enumerate(operations):
+        if operation.action not in OPERATIONS:
+            _error(cnt, operation, 'unknown operation')
+            continue
+        if not operation.rpm:
+            _error(cnt, operation, 'no rpm specified')
+            continue
+        folders = [operation.folder]
+        if operation.action == 'upgrade':
+            folders.append(operation.source)
+        missing = [
+            folder for folder in folders
+            if not folder or not os.path.isdir(folder)]
+        if missing:
+            _error(cnt, operation, 'folder "%s" does not exist' % missing[0])
+            continue
+
+        if operation.action == 'upgrade':
+            if operation.filename not in _index(operation.source):
+                _error(cnt, operation, 'not found in %s' % operation.source)
+                continue
+            operation.rpm = os.path.join(
+                operation.source, operation.filename)
+            operation.nevra = _index(operation.source)[operation.filename]
+        elif operation.action == 'delete':
+            if operation.filename not in _index(operation.folder):
+                _error(cnt, operation, 'not found in %s' % operation.folder)
+                continue
+            operation.nevra = _index(operation.folder)[operation.filename]
+        else:
+            if not repo_manager.is_rpm(operation.rpm):
+                _error(cnt, operation, 'does not point to a RPM file')
+                continue
+            operation.nevra = repo_manager.get_rpm_nevra(operation.rpm)
+
+        if operation.copy:
+            existing = _index(operation.folder).get(operation.filename)
+            dest = os.path.join(operation.folder, operation.filename)
+            if operation.action == 'replace' and existing is None:
+                _error(cnt, operation, 'not found in %s' % operation.folder)
+                continue
+            elif existing is not None and existing != operation.nevra:
+                _error(cnt, operation, 'conflicts with %s' % dest)
+                continue
+            elif existing is not None:
+                checksums = {}
+                status = repo_manager.compare_rpm_files(
+                    operation.rpm, dest, checksums)
+                if status == repo_manager.ALREADY_PRESENT:
+                    # Upgrading still removes the RPM from the source
+                    operation.copy = False
+                    operation.digest = checksums.get(operation.rpm)
+                elif operation.action != 'replace':
+                    _error(cnt, operation, 'conflicts with %s' % dest)
+                    continue
+            if not operation.copy and not operation.remove:
+                operation.status = repo_manager.ALREADY_PRESENT
+
+        paths = [os.path.join(operation.folder, operation.filename)]
+        if operation.action == 'upgrade':
+            paths.append(operation.rpm)
+        for path in paths:
+            if path in changed:
+                _error(cnt, operation, '%s is also changed by operation %s' % (
+                    path, changed[path] + 1))
+                break
+            changed[path] = cnt
+
+    return errors
+
+
+def run_operation(operation):
+    ''' Run the file operations of the given Operation, recording how to
+    undo them, and return it.
+    '''
+    tmp = None
+    try:
+        if operation.copy:
+            dest = os.path.join(operation.folder, operation.filename)
+            digest = repo_manager.journal_digest()
+            tmp = repo_manager.copy_to_temp(
+                operation.rpm, operation.folder, digest)
+            if digest is not None:
+                operation.digest = digest.hexdigest()
+            if os.path.exists(dest):
+                os.link(dest, _backup_name(dest))
+                operation.backups.append((_backup_name(dest), dest))
+            else:
+                operation.added.append(dest)
+            os.rename(tmp, dest)
+            tmp = None
+        if operation.remove:
+            path = os.path.join(
+                operation.source or operation.folder, operation.filename)
+            os.rename(path, _backup_name(path))
+            operation.backups.append((_backup_name(path), path))
+        operation.status = DONE[operation.action]
+    except (IOError, OSError) as err:
+        LOG.warning('%s %s failed: %s', operation.action, operation.rpm, err)
+        operation.status = FAILED
+        operation.error = str(err)
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+        # A failed operation is always undone, not to be left half done
+        undo_operation(operation)
+    return operation
+
+
+def undo_operation(operation):
+    ''' Restore the files changed by the given Operation. '''
+    for filename in operation.added:
+        if os.path.exists(filename):
+            os.unlink(filename)
+    for backup, filename in operation.backups:
+        os.rename(backup, filename)
+    operation.added = []
+    operation.backups = []
+
+
+def commit_operation(operation, trash_batches):
+    ''' Remove, or move to the trash, the files kept aside by the given
+    Operation and record it in the journal.
+    '''
+    for backup, filename in operation.backups:
+        trash_batch = trash_batches.get(os.path.dirname(filename))
+        if trash_batch:
+            if not os.path.isdir(trash_batch):
+                os.makedirs(trash_batch)
+            os.rename(backup, os.path.join(
+                trash_batch,
+                os.path.basename(filename) + repo_manager.TRASH_SUFFIX))
+        else:
+            os.unlink(backup)
+    operation.backups = []
+
+
+def _record(operation, message):
+    ''' Record the Operation done in the journal. '''
+    if operation.copy:
+        action = 'replace' if operation.action == 'replace' else 'add'
+        repo_manager.record_action(
+            action, operation.folder,
+            os.path.join(operation.folder, operation.filename),
+            nevra=operation.nevra, digest=operation.digest, message=message)
+    if operation.remove:
+        repo_manager.record_action(
+            'delete', operation.source or operation.folder,
+            operation.filename, nevra=operation.nevra,
+            digest=operation.digest, message=message)
+
+
+def apply_operations(operations, workers=WORKERS, dry_run=False,
+                     rollback=False, no_createrepo=False,
+                     createrepo_cmd=None, message=None, trash=False,
+                     force_createrepo=False, report=None):
+    ''' Validate then apply the given Operation, running up to ``workers``
+    of them at the same time, then run createrepo once in each folder
+    changed.
+
+    Nothing is changed if any operation is invalid. If an operation fails,
+    the ones completed are kept unless ``rollback`` is True, in which case
+    they are all undone and createrepo is not run. ``report`` is called
+    with the record of each operation. Returns whether all the operations
+    succeeded.
+    '''
+    LOG.debug('apply_operations')
+    errors = validate_operations(operations)
+    for error in errors:
+        print(error)
+    if errors or dry_run:
+        for operation in operations:
+            if operation.status is None:
+                operation.status = NOT_RUN
+    else:
+        # Imported here, multiprocessing being slow to import
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(max(int(workers), 1))
+        try:
+            pool.map(run_operation, [
+                operation for operation in operations
+                if operation.status is None])
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = [
+            operation for operation in operations
+            if operation.status == FAILED]
+        done = [
+            operation for operation in operations
+            if operation.status in DONE.values()]
+        if failed and rollback:
+            LOG.info('Rolling back %s operations', len(done))
+            for operation in done:
+                undo_operation(operation)
+                operation.status = ROLLED_BACK
+            done = []
+        else:
+            trash_batches = {}
+            folders = set()
+            for operation in done:
+                folders.add(operation.folder)
+                if operation.remove:
+                    folders.add(operation.source or operation.folder)
+            if trash:
+                for folder in folders:
+                    trash_batches[folder] = repo_manager.new_trash_batch(
+                        folder, 'apply')
+            for operation in done:
+                commit_operation(operation, trash_batches)
+                _record(operation, message)
+
+            if not no_createrepo:
+                for folder in sorted(folders):
+                    print(folder)
+                    repo_manager.run_createrepo(
+                        folder, createrepo_cmd=createrepo_cmd,
+                        force=force_createrepo, update=True)
+
+    for operation in operations:
+        print('%s %s in %s: %s' % (
+            operation.action, operation.filename, operation.folder,
+            operation.status))
+        if report:
+            report(operation.record())
+
+    return all(
+        operation.status in DONE.values()
+        or operation.status == repo_manager.ALREADY_PRESENT
+        or (dry_run and operation.status == NOT_RUN)
+        for operation in operations)
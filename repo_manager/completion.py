@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Shell completion.
+
+The bash and zsh scripts are generated from the argparse parser so that
+the actions and options never get out of sync. They complete the options
+and their choices by themselves and only call back ``repo_manager
+_complete`` for the values depending on the configuration: the names of
+the repositories and the packages they contain.
+
+The packages are read from a completion index, a sorted list of the RPMs
+of the repo kept in its state folder and rebuilt, without reading any
+header, when the folder changed. The completion path thus neither loads
+librpm nor sets up the logging.
+"""
+
+from __future__ import absolute_import
+
+import bisect
+import os
+
+from . import repo_manager
+
+
+# Name of the completion index in the state folder of the repos
+COMPLETION_INDEX = 'completion'
+
+# Destinations of the arguments whose values are repositories
+REPO_DESTS = ('repos', 'repo_from')
+# Destinations of the arguments whose values are local files
+FILE_DESTS = (
+    'configfile', 'plan_out', 'apply', 'failures_out', 'manifest', 'targets')
+# Actions whose ``rpms`` are RPMs of the repos, for the others they are
+# local files
+PACKAGE_ACTIONS = ('delete', 'upgrade')
+
+BASH_SCRIPT = '''\
+_repo_manager()
+{
+    local cur="${COMP_WORDS[COMP_CWORD]}" prev="${COMP_WORDS[COMP_CWORD-1]}"
+    local action="" word i
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        word="${COMP_WORDS[i]}"
+        case "$word" in
+%(global_values)s
+            -*) ;;
+            *) action="$word"; break ;;
+        esac
+    done
+
+    local opts="" kind=""
+    case "$action" in
+        "")
+            opts="%(global_opts)s %(actions)s"
+            case "$prev" in
+%(global_prev)s
+            esac ;;
+%(actions_cases)s
+    esac
+
+    if [[ -z "$kind" && "$cur" != -* ]]; then
+        # Positional arguments
+        case "$action" in
+%(positionals)s
+        esac
+    fi
+
+    case "$kind" in
+        files)
+            compopt -o filenames 2>/dev/null
+            COMPREPLY=($(compgen -f -- "$cur")) ;;
+        none)
+            COMPREPLY=() ;;
+        words:*)
+            COMPREPLY=($(compgen -W "${kind#words:}" -- "$cur")) ;;
+        "")
+            COMPREPLY=($(compgen -W "$opts" -- "$cur")) ;;
+        *)
+            COMPREPLY=($(%(prog)s _complete "$kind" "$cur" \\
+                "${COMP_WORDS[@]:1}" 2>/dev/null)) ;;
+    esac
+}
+complete -F _repo_manager repo_manager repo-manager
+'''
+
+ZSH_HEADER = '''\
+#compdef repo_manager repo-manager
+autoload -U +X bashcompinit && bashcompinit
+'''
+
+
+def _kind(action_name, action):
+    ''' Return what the values of the given argparse action are: ``repos``,
+    ``packages``, ``names``, ``files``, ``words:<choices>``, ``none`` if
+    they cannot be completed or None if it does not take any value.
+    '''
+    if action.nargs == 0:
+        return None
+    if action.choices:
+        return 'words:%s' % ' '.join(sorted(action.choices))
+    if action.dest in REPO_DESTS:
+        return 'repos'
+    if action.dest == 'rpms':
+        if action_name in PACKAGE_ACTIONS:
+            return 'packages'
+        return 'files'
+    if action.dest == 'name':
+        return 'names'
+    if action.dest in FILE_DESTS:
+        return 'files'
+    return 'none'
+
+
+def _subparsers(parser):
+    ''' Return the dictionary of the sub-parsers, ie: the actions, of the
+    given parser.
+    '''
+    for action in parser._actions:  # pylint: disable=W0212
+        if action.choices and isinstance(action.choices, dict):
+            return action.choices
+    return {}
+
+
+def _option_cases(action_name, parser, indent):
+    ''' Return the options of the given parser and the lines of the case
+    statement setting the kind of value expected after each of them.
+    '''
+    opts = []
+    cases = []
+    for action in parser._actions:  # pylint: disable=W0212
+        if not action.option_strings or action.dest == 'help':
+            continue
+        opts.extend(action.option_strings)
+        kind = _kind(action_name, action)
+        if kind:
+            cases.append('%s%s) kind="%s" ;;' % (
+                indent, '|'.join(action.option_strings), kind))
+    return opts, cases
+
+
+def generate(parser, shell='bash', prog='repo_manager'):
+    ''' Return the completion script for the given shell (``bash`` or
+    ``zsh``) of the specified argparse parser.
+    '''
+    global_opts, global_prev = _option_cases(None, parser, ' ' * 16)
+    global_values = []
+    for action in parser._actions:  # pylint: disable=W0212
+        if action.option_strings and action.nargs != 0 \
+                and action.dest != 'help':
+            global_values.append('%s%s) ((i++)) ;;' % (
+                ' ' * 12, '|'.join(action.option_strings)))
+
+    actions = _subparsers(parser)
+    actions_cases = []
+    positionals = []
+    for name in sorted(actions):
+        subparser = actions[name]
+        opts, cases = _option_cases(name, subparser, ' ' * 16)
+        actions_cases.append('%s%s)' % (' ' * 8, name))
+        actions_cases.append('%sopts="%s"' % (' ' * 12, ' '.join(opts)))
+        if cases:
+            actions_cases.append('%scase "$prev" in' % (' ' * 12))
+            actions_cases.extend(cases)
+            actions_cases.append('%sesac' % (' ' * 12))
+        actions_cases.append('%s;;' % (' ' * 12))
+        for action in subparser._actions:  # pylint: disable=W0212
+            if not action.option_strings:
+                positionals.append('%s%s) kind="%s" ;;' % (
+                    ' ' * 12, name, _kind(name, action)))
+                break
+
+    script = BASH_SCRIPT % {
+        'prog': prog,
+        'global_opts': ' '.join(global_opts),
+        'global_values': '\n'.join(global_values),
+        'global_prev': '\n'.join(global_prev),
+        'actions': ' '.join(sorted(actions)),
+        'actions_cases': '\n'.join(actions_cases),
+        'positionals': '\n'.join(positionals),
+    }
+    if shell == 'zsh':
+        script = ZSH_HEADER + script
+    return script
+
+
+def get_completion_index(folder):
+    ''' Return the sorted list of the RPMs of the specified folder, from its
+    completion index if the folder did not change since it was written.
+    '''
+    state = os.path.join(folder, repo_manager.STATE_DIR)
+    path = os.path.join(state, COMPLETION_INDEX)
+    try:
+        if not os.path.isdir(state):
+            # Creating it changes the mtime of the folder
+            os.mkdir(state)
+    except OSError:
+        pass
+    try:
+        mtime = repr(os.stat(folder).st_mtime)
+    except OSError:
+        return []
+
+    try:
+        stream = open(path)
+        try:
+            if stream.readline().rstrip('\n') == mtime:
+                return stream.read().splitlines()
+        finally:
+            stream.close()
+    except IOError:
+        pass
+
+    filenames = sorted(
+        filename for filename in os.listdir(folder)
+        if filename.endswith('.rpm'))
+    try:
+        repo_manager.write_state_file(
+            folder, COMPLETION_INDEX,
+            '%s\n%s' % (mtime, ''.join(
+                filename + '\n' for filename in filenames)))
+    except (IOError, OSError):
+        # Completing in a repo we cannot write to
+        pass
+    return filenames
+
+
+def _starting_with(values, prefix):
+    ''' Return the values of the given sorted list starting with prefix. '''
+    start = bisect.bisect_left(values, prefix)
+    end = start
+    while end < len(values) and values[end].startswith(prefix):
+        end += 1
+    return values[start:end]
+
+
+def _option_values(words, option):
+    ''' Return the values following the given option in the words of the
+    command line.
+    '''
+    values = []
+    for cnt, word in enumerate(words):
+        if word == option:
+            for value in words[cnt + 1:]:
+                if value.startswith('-'):
+                    break
+                values.append(value)
+    return values
+
+
+def complete(kind, prefix, words, config):
+    ''' Return the completions of the given kind (``repos``, ``packages``
+    or ``names``) starting with prefix, ``words`` being the words of the
+    command line and ``config`` the ConfigParser of the configuration.
+    '''
+    sections = [
+        section for section in config.sections() if section != 'main']
+    if kind == 'repos':
+        return _starting_with(sorted(sections), prefix)
+
+    # The repos whose packages to complete: the ones given on the command
+    # line, the default ones otherwise
+    repos = _option_values(words, '--repo_from') \
+        or _option_values(words, '--repos')
+    if not repos and config.has_option('main', 'default_repos'):
+        repos = [
+            repo.strip()
+            for repo in config.get('main', 'default_repos').split(',')]
+    if not repos:
+        repos = sections
+
+    values = set()
+    for repo in repos:
+        folder = repo
+        if config.has_section(repo) and config.has_option(repo, 'folder'):
+            folder = config.get(repo, 'folder')
+        folder = os.path.expanduser(folder)
+        if not os.path.isdir(folder):
+            continue
+        # The name being the start of the file name, only the files
+        # starting with the prefix are of interest
+        filenames = _starting_with(get_completion_index(folder), prefix)
+        if kind == 'names':
+            # name-version-release.arch.rpm
+            values.update(
+                filename.rsplit('-', 2)[0]
+                for filename in filenames if filename.count('-') >= 2)
+        else:
+            values.update(filenames)
+    return _starting_with(sorted(values), prefix)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+In-memory provides/requires index of a repository, used to find out if
+removing some packages leaves requirements of the remaining ones
+unresolved.
+"""
+
+import re
+
+# Flags of the dependencies, see rpmds.h
+RPMSENSE_LESS = 1 << 1
+RPMSENSE_GREATER = 1 << 2
+RPMSENSE_EQUAL = 1 << 3
+RPMSENSE_RPMLIB = 1 << 24
+
+# As createrepo does for primary.xml, only the files matching this are
+# considered as provided, they are the ones packages usually depend on.
+PRIMARY_FILES = re.compile(r'^(/etc/|.*bin/|/usr/lib/sendmail$)')
+
+
+def split_evr(evr):
+    ''' Split a ``[epoch:]version[-release]`` string into a tuple
+    (epoch, version, release), the missing parts being None.
+    '''
+    epoch = None
+    release = None
+    if ':' in evr:
+        epoch, evr = evr.split(':', 1)
+    if '-' in evr:
+        evr, release = evr.rsplit('-', 1)
+    return (epoch, evr, release)
+
+
+def format_dependency(name, flags, evr):
+    ''' Return the given dependency as it is written in a spec file. '''
+    if not evr:
+        return name
+    sense = ''
+    if flags & RPMSENSE_LESS:
+        sense += '<'
+    if flags & RPMSENSE_GREATER:
+        sense += '>'
+    if flags & RPMSENSE_EQUAL:
+        sense += '='
+    return '%s %s %s' % (name, sense, evr)
+
+
+def compare_evr(evr1, evr2, vercmp_key):
+    ''' Compare two ``[epoch:]version[-release]`` strings the way rpm does
+    for dependencies, ie: ignoring the release if one of them does not have
+    one, ``vercmp_key`` being the function returning the sort key of a
+    version string. Returns -1, 0 or 1.
+    '''
+    epoch1, version1, release1 = split_evr(evr1)
+    epoch2, version2, release2 = split_evr(evr2)
+    key1 = [vercmp_key(epoch1 or '0'), vercmp_key(version1)]
+    key2 = [vercmp_key(epoch2 or '0'), vercmp_key(version2)]
+    if release1 is not None and release2 is not None:
+        key1.append(vercmp_key(release1))
+        key2.append(vercmp_key(release2))
+    return (key1 > key2) - (key1 < key2)
+
+
+class DependencyIndex(object):
+    ''' Provides and requires of all the packages of a repository.
+
+    The packages are added once, while scanning the repository, and the
+    indexes are dictionaries keyed by the name of the capabilities so
+    that checking a requirement does not depend on the number of packages.
+    '''
+
+    def __init__(self, vercmp_key):
+        # Function returning the sort key of a version string
+        self.vercmp_key = vercmp_key
+        self.packages = []
+        # capability -> list of (package id, flags, evr)
+        self.providers = {}
+        self.requirers = {}
+        # package id -> capabilities it provides
+        self.provided = []
+
+    def add_package(self, filename, provides, requires, files=()):
+        ''' Add a package to the index, ``provides`` and ``requires`` being
+        lists of (name, flags, evr) tuples and ``files`` the list of files
+        it contains.
+        '''
+        pkgid = len(self.packages)
+        self.packages.append(filename)
+
+        names = set()
+        for name, flags, evr in provides:
+            self.providers.setdefault(name, []).append((pkgid, flags, evr))
+            names.add(name)
+        for path in files:
+            if PRIMARY_FILES.match(path):
+                self.providers.setdefault(path, []).append((pkgid, 0, None))
+                names.add(path)
+        self.provided.append(tuple(names))
+
+        for name, flags, evr in requires:
+            if flags & RPMSENSE_RPMLIB or name in names:
+                continue
+            self.requirers.setdefault(name, []).append((pkgid, flags, evr))
+
+    def _compare_evr(self, evr1, evr2):
+        ''' Compare two ``[epoch:]version[-release]`` strings, see
+        compare_evr.
+        '''
+        return compare_evr(evr1, evr2, self.vercmp_key)
+
+    def _overlap(self, provide, require):
+        ''' Return whether the (flags, evr) range of the provide satisfies
+        the (flags, evr) range of the requirement.
+        '''
+        pflags, pevr = provide
+        rflags, revr = require
+        if not pevr or not revr \
+                or not (pflags & (RPMSENSE_LESS | RPMSENSE_GREATER
+                                  | RPMSENSE_EQUAL)) \
+                or not (rflags & (RPMSENSE_LESS | RPMSENSE_GREATER
+                                  | RPMSENSE_EQUAL)):
+            return True
+
+        sense = self._compare_evr(pevr, revr)
+        if sense < 0:
+            return bool(pflags & RPMSENSE_GREATER
+                        or rflags & RPMSENSE_LESS)
+        elif sense > 0:
+            return bool(pflags & RPMSENSE_LESS
+                        or rflags & RPMSENSE_GREATER)
+        return bool(
+            (pflags & RPMSENSE_EQUAL and rflags & RPMSENSE_EQUAL)
+            or (pflags & RPMSENSE_LESS and rflags & RPMSENSE_LESS)
+            or (pflags & RPMSENSE_GREATER and rflags & RPMSENSE_GREATER))
+
+    def _satisfied(self, name, flags, evr, removed):
+        ''' Return whether the given requirement is satisfied by a package
+        not in ``removed``.
+        '''
+        for pkgid, pflags, pevr in self.providers.get(name, ()):
+            if pkgid not in removed \
+                    and self._overlap((pflags, pevr), (flags, evr)):
+                return True
+        return False
+
+    def broken_by(self, filenames):
+        ''' Return a dictionary associating to each of the given files
+        whose removal would leave a requirement unresolved, the list of
+        tuples (file requiring it, requirement).
+
+        All the files are considered removed at the same time, requirements
+        that were not resolved within the repository in the first place
+        (for example provided by another repository) are ignored.
+        '''
+        ids = dict((filename, pkgid)
+                   for pkgid, filename in enumerate(self.packages))
+        removed = set()
+        for filename in filenames:
+            if filename in ids:
+                removed.add(ids[filename])
+
+        broken = {}
+        for pkgid in removed:
+            for name in self.provided[pkgid]:
+                provides = [
+                    (pflags, pevr)
+                    for provid, pflags, pevr in self.providers[name]
+                    if provid == pkgid
+                ]
+                for reqid, flags, evr in self.requirers.get(name, ()):
+                    if reqid in removed:
+                        continue
+                    for provide in provides:
+                        if self._overlap(provide, (flags, evr)):
+                            break
+                    else:
+                        # This package is not the one satisfying it
+                        continue
+                    if self._satisfied(name, flags, evr, removed):
+                        continue
+                    broken.setdefault(self.packages[pkgid], []).append(
+                        (self.packages[reqid],
+                         format_dependency(name, flags, evr)))
+        return broken
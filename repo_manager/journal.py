@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Append-only structured journal of the actions done on the repositories.
+
+The journal is a file with one JSON entry per line. Next to it, the
+``<journal>.idx`` folder contains one file per package name listing, as
+fixed-width records, the timestamp and the offset in the journal of each
+entry about this package. Looking for the history of a package thus only
+reads its index file (using a binary search for the start of the time
+range) and the matching lines of the journal.
+
+The entries are timestamped when the action is recorded but written when
+the command ends, so commands running at the same time can append entries
+older than the last ones of the index. Each index record thus also holds
+the highest timestamp of the index up to it, which never decreases, and
+the binary search is done on it.
+"""
+
+import binascii
+import fcntl
+import getpass
+import json
+import os
+import time
+
+
+DEFAULT_JOURNAL = '/var/tmp/repo_manager.journal'
+
+# timestamp, highest timestamp of the index so far and offset in the
+# journal, all zero-padded
+INDEX_RECORD = '%012d %012d %016d\n'
+INDEX_RECORD_SIZE = len(INDEX_RECORD % (0, 0, 0))
+
+
+def _index_name(name):
+    ''' Return the name of the index file of the given package name. '''
+    return name.replace('/', '_') or '_'
+
+
+class Journal(object):
+    ''' Buffered writer and reader of the journal.
+
+    The entries recorded are kept in memory and written, with a single
+    fsync, when flush is called, ie: once per command.
+    '''
+
+    def __init__(self, path=DEFAULT_JOURNAL):
+        self.path = os.path.expanduser(path)
+        self.index = self.path + '.idx'
+        # Not using uuid, it is slow to import and this is loaded when
+        # completing the command line
+        self.batch = binascii.hexlify(os.urandom(6)).decode('ascii')
+        try:
+            self.user = getpass.getuser()
+        except Exception:  # pylint: disable=W0703
+            self.user = str(os.getuid())
+        self.entries = []
+
+    def record(self, action, repo, filename, name=None, nevra=None,
+               digest=None, message=None):
+        ''' Record the given action in the journal, it is only written to
+        the disk when flush is called.
+        '''
+        self.entries.append({
+            'timestamp': time.time(),
+            'batch': self.batch,
+            'user': self.user,
+            'action': action,
+            'repo': repo,
+            'file': os.path.basename(filename),
+            'name': name,
+            'nevra': nevra,
+            'digest': digest,
+            'message': message,
+        })
+
+    def flush(self):
+        ''' Append the entries recorded to the journal, fsync it and update
+        the index.
+        '''
+        if not self.entries:
+            return
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        if not os.path.isdir(self.index):
+            os.makedirs(self.index)
+
+        stream = open(self.path, 'a')
+        try:
+            # Several commands may be running at the same time, the lock
+            # makes the offsets we compute valid
+            fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+            stream.seek(0, os.SEEK_END)
+            offset = stream.tell()
+            lines = []
+            records = {}
+            for entry in sorted(
+                    self.entries, key=lambda entry: entry['timestamp']):
+                line = json.dumps(entry, sort_keys=True) + '\n'
+                lines.append(line)
+                if entry['name']:
+                    records.setdefault(entry['name'], []).append(
+                        (int(entry['timestamp']), offset))
+                offset += len(line)
+            stream.write(''.join(lines))
+            stream.flush()
+            os.fsync(stream.fileno())
+
+            for name in records:
+                index = open(
+                    os.path.join(self.index, _index_name(name)), 'a+')
+                try:
+                    highest = 0
+                    index.seek(0, os.SEEK_END)
+                    if index.tell() >= INDEX_RECORD_SIZE:
+                        index.seek(index.tell() - INDEX_RECORD_SIZE)
+                        highest = int(index.read().split()[1])
+                    content = []
+                    for stamp, offset in records[name]:
+                        highest = max(highest, stamp)
+                        content.append(INDEX_RECORD % (stamp, highest, offset))
+                    index.write(''.join(content))
+                finally:
+                    index.close()
+        finally:
+            stream.close()
+        self.entries = []
+
+    def _read_index(self, name, since=None, until=None):
+        ''' Yield the offsets of the entries of the given package name,
+        between ``since`` and ``until`` (timestamps) if specified.
+        '''
+        path = os.path.join(self.index, _index_name(name))
+        if not os.path.exists(path):
+            return
+
+        stream = open(path)
+        try:
+            count = os.fstat(stream.fileno()).st_size // INDEX_RECORD_SIZE
+            # Binary search of the first record whose highest timestamp so
+            # far is at or after since, the records before are all older.
+            # The timestamps of the index are truncated to the second.
+            low, high = 0, count
+            while since is not None and low < high:
+                middle = (low + high) // 2
+                stream.seek(middle * INDEX_RECORD_SIZE)
+                stamp = int(stream.read(INDEX_RECORD_SIZE).split()[1])
+                if stamp < int(since):
+                    low = middle + 1
+                else:
+                    high = middle
+            stream.seek(low * INDEX_RECORD_SIZE)
+            for _ in range(low, count):
+                fields = stream.read(INDEX_RECORD_SIZE).split()
+                stamp = int(fields[0])
+                # Not stopping after until, older entries may follow
+                if since is not None and stamp < int(since):
+                    continue
+                if until is not None and stamp > until:
+                    continue
+                yield int(fields[2])
+        finally:
+            stream.close()
+
+    def history(self, name=None, since=None, until=None):
+        ''' Yield the entries of the journal about the given package name,
+        or all of them if no name is specified, recorded between ``since``
+        and ``until`` (timestamps) if specified.
+        '''
+        if not os.path.exists(self.path):
+            return
+
+        stream = open(self.path)
+        try:
+            if name:
+                for offset in self._read_index(name, since, until):
+                    stream.seek(offset)
+                    entry = json.loads(stream.readline())
+                    if entry['name'] != name:
+                        continue
+                    if since is not None and entry['timestamp'] < since:
+                        continue
+                    if until is not None and entry['timestamp'] > until:
+                        continue
+                    yield entry
+                return
+
+            for line in stream:
+                entry = json.loads(line)
+                if since is not None and entry['timestamp'] < since:
+                    continue
+                if until is not None and entry['timestamp'] > until:
+                    continue
+                yield entry
+        finally:
+            stream.close()
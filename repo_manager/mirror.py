@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Replication of a repository to local mirror folders.
+
+Only the RPMs whose name, size or mtime differ between the repository and
+the mirror are copied (or hardlinked), in parallel, each one to a
+temporary file renamed in place. The repodata is published once all the
+RPMs it lists are there, by swapping it as a whole, and the RPMs no longer
+in the repository are only removed afterwards, so that the clients of the
+mirror never see repodata referencing missing files.
+"""
+
+from __future__ import absolute_import, print_function
+
+import errno
+import logging
+import os
+import shutil
+import time
+
+from . import repo_manager
+
+
+LOG = logging.getLogger('repo_manager')
+
+# Number of RPMs copied at the same time by default
+WORKERS = 4
+
+
+def _stat_files(folder, relpaths):
+    ''' Return a dictionary associating the given paths, relative to the
+    folder, to their (size, mtime), mtime being truncated to the second as
+    not all file systems keep more.
+    '''
+    stats = {}
+    for relpath in relpaths:
+        try:
+            stat = os.stat(os.path.join(folder, relpath))
+        except OSError:
+            continue
+        stats[relpath] = (stat.st_size, int(stat.st_mtime))
+    return stats
+
+
+def _repodata_files(folder):
+    ''' Return the paths, relative to the repodata of the folder, of its
+    files.
+    '''
+    repodata = os.path.join(folder, 'repodata')
+    relpaths = []
+    for root, _, files in os.walk(repodata):
+        for filename in files:
+            relpaths.append(os.path.relpath(
+                os.path.join(root, filename), repodata))
+    return relpaths
+
+
+def _publish_file(source, dest, hardlink=False):
+    ''' Hardlink or copy, keeping its mtime, the source file to a temporary
+    file next to dest and rename it to dest. Returns whether the file was
+    hardlinked.
+    '''
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError as err:
+            # Created by another thread
+            if err.errno != errno.EEXIST:
+                raise
+    if hardlink:
+        tmp = os.path.join(parent, '.%s.%s.part' % (
+            os.path.basename(dest), os.getpid()))
+        try:
+            os.link(source, tmp)
+            os.rename(tmp, dest)
+            return True
+        except OSError as err:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            if err.errno != errno.EXDEV:
+                raise
+            LOG.warning('%s is on another filesystem, copying it', dest)
+    tmp = repo_manager.copy_to_temp(source, parent)
+    try:
+        shutil.copystat(source, tmp)
+        os.rename(tmp, dest)
+    except OSError:
+        os.unlink(tmp)
+        raise
+    return False
+
+
+def mirror_repo(folder, target, workers=WORKERS, hardlink=False,
+                dry_run=False):
+    ''' Make the target folder a mirror of the RPMs and the repodata of the
+    specified repo, copying or, if ``hardlink`` is True, hardlinking the
+    files changed using ``workers`` threads.
+
+    Returns a dictionary with the statistics of the run.
+    '''
+    LOG.debug('mirror_repo')
+    folder = os.path.expanduser(folder)
+    target = os.path.expanduser(target)
+
+    if not os.path.isdir(folder):
+        print('%s not found' % folder)
+        return
+
+    start = time.time()
+    stats = {
+        'folder': folder, 'target': target, 'copied': 0, 'linked': 0,
+        'unchanged': 0, 'removed': 0, 'bytes': 0, 'repodata': False,
+        'duration': 0}
+
+    wanted = _stat_files(folder, repo_manager.iter_repo_rpms(folder))
+    current = {}
+    if os.path.isdir(target):
+        current = _stat_files(target, repo_manager.iter_repo_rpms(target))
+    changed = sorted(
+        relpath for relpath in wanted
+        if current.get(relpath) != wanted[relpath])
+    stale = sorted(set(current) - set(wanted))
+    stats['unchanged'] = len(wanted) - len(changed)
+    stats['bytes'] = sum(wanted[relpath][0] for relpath in changed)
+
+    repodata = _stat_files(
+        os.path.join(folder, 'repodata'), _repodata_files(folder))
+    stats['repodata'] = bool(repodata) and repodata != _stat_files(
+        os.path.join(target, 'repodata'), _repodata_files(target))
+
+    if dry_run:
+        for relpath in changed:
+            print('Copy file %s' % relpath)
+        for relpath in stale:
+            print('Remove file %s' % relpath)
+        stats['copied'] = len(changed)
+        stats['removed'] = len(stale)
+        stats['duration'] = time.time() - start
+        return stats
+
+    LOG.info('Mirroring %s to %s: %s RPMs to copy, %s to remove',
+             folder, target, len(changed), len(stale))
+
+    def _copy(relpath):
+        ''' Copy one RPM, run in the threads of the pool. '''
+        return _publish_file(
+            os.path.join(folder, relpath), os.path.join(target, relpath),
+            hardlink=hardlink)
+
+    if changed:
+        # Imported here, multiprocessing being slow to import
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(max(int(workers), 1))
+        try:
+            for linked in pool.imap_unordered(_copy, changed):
+                if linked:
+                    stats['linked'] += 1
+                else:
+                    stats['copied'] += 1
+        finally:
+            pool.close()
+            pool.join()
+
+    # Only once all the RPMs it lists are there
+    if stats['repodata']:
+        staging = os.path.join(target, '.repodata.%s' % os.getpid())
+        for relpath in repodata:
+            _publish_file(
+                os.path.join(folder, 'repodata', relpath),
+                os.path.join(staging, relpath), hardlink=hardlink)
+        repo_manager.swap_repodata(target, staging)
+
+    # Only once the repodata no longer lists them
+    for relpath in stale:
+        os.unlink(os.path.join(target, relpath))
+        stats['removed'] += 1
+
+    stats['duration'] = time.time() - start
+    return stats
@@ -14,33 +14,159 @@
 # license.
 """
 
+from __future__ import absolute_import, print_function
+
+import errno
+import fnmatch
+import hashlib
+import heapq
+import itertools
+import json
 import logging
-import rpm
+import operator
 import os
+import re
 import shutil
-import subprocess
-
-TS = rpm.ts()
-TS.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
-
-# set up logging to file - see previous section for more details
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)-8s %(message)s',
-    filename='/var/tmp/repo_manager.log',
-    filemode='a')
-# define a Handler which writes INFO messages or higher to the sys.stderr
-CSL = logging.StreamHandler()
-CSL.setLevel(logging.WARNING)
-# set a format which is simpler for console use
-# tell the handler to use this format
-CSL.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
-# add the handler to the root logger
-logging.getLogger('').addHandler(CSL)
+import sys
+import threading
+import time
+
+from . import deps
+from . import scan
+
+try:
+    intern
+except NameError:  # Python 3
+    from sys import intern  # pylint: disable=W0622
+
+# The rpm bindings and the transaction set are only loaded when an action
+# needs them (see get_rpm_module and get_transaction_set) and nothing is
+# logged to a file until setup_logging is called, so that importing this
+# module stays cheap and free of side-effects.
+RPM = None
+# Transaction sets are not thread-safe, each thread gets its own
+TS = threading.local()
+
+# Journal (see repo_manager.journal) in which the actions are recorded, when
+# None the actions are logged instead
+JOURNAL = None
+
+# Folders whose headers are read using the I/O-scheduled scan (see
+# repo_manager.scan), associated to the number of files read at the same time
+SCHEDULED_SCAN = {}
+
+DEFAULT_LOG_FILE = '/var/tmp/repo_manager.log'
 
 LOG = logging.getLogger('repo_manager')
 
 
+def setup_logging(log_file=None, unique_log=False, debug=False):
+    ''' Set up the logging of the actions to the default log file and/or
+    the specified one (only the specified one if ``unique_log`` is True) and
+    of the warnings (or debugging info) to the console.
+
+    The log files are only opened when the first message is logged.
+    '''
+    root = logging.getLogger('')
+    root.setLevel(logging.INFO)
+    if debug:
+        root.setLevel(logging.DEBUG)
+
+    log_files = []
+    if not log_file or not unique_log:
+        log_files.append(DEFAULT_LOG_FILE)
+    if log_file and log_file not in log_files:
+        log_files.append(log_file)
+
+    for filename in log_files:
+        handler = logging.FileHandler(filename, mode='a', delay=True)
+        handler.setLevel(logging.INFO)
+        handler.setFormatter(
+            logging.Formatter('%(asctime)s %(levelname)-8s %(message)s'))
+        root.addHandler(handler)
+
+    # define a Handler which writes WARNING messages or higher to the
+    # sys.stderr, using a format which is simpler for console use
+    console = logging.StreamHandler()
+    console.setLevel(logging.WARNING)
+    if debug:
+        console.setLevel(logging.DEBUG)
+    console.setFormatter(logging.Formatter('%(levelname)-8s %(message)s'))
+    root.addHandler(console)
+
+
+def get_rpm_module():
+    ''' Import the rpm python bindings the first time they are needed and
+    return them.
+    '''
+    global RPM
+    if RPM is None:
+        import rpm
+        RPM = rpm
+    return RPM
+
+
+def get_transaction_set():
+    ''' Return the transaction set, of the current thread, used to read
+    the headers of the RPMs, creating it the first time it is needed.
+    '''
+    transaction_set = getattr(TS, 'ts', None)
+    if transaction_set is None:
+        rpmlib = get_rpm_module()
+        transaction_set = rpmlib.ts()
+        transaction_set.setVSFlags(rpmlib._RPMVSF_NOSIGNATURES)
+        TS.ts = transaction_set
+    return transaction_set
+
+
+# Outcomes of add_rpm
+ADDED = 'added'
+ALREADY_PRESENT = 'already present'
+CONFLICT = 'conflict'
+# Outcome of replace_rpm
+REPLACED = 'replaced'
+
+# Size of the blocks read when computing checksums
+BLOCK_SIZE = 1024 * 1024
+
+# Folder, in each repo, where repo_manager keeps its state (checkpoints,
+# manifests...)
+STATE_DIR = '.repo_manager'
+
+# Folder, in each repo, where the files removed are moved when using the
+# trash. The files are renamed with TRASH_SUFFIX so that createrepo, which
+# only looks at the ``.rpm`` files, ignores them.
+TRASH_DIR = '.trash'
+TRASH_SUFFIX = '.trashed'
+
+# Arguments of renameat2 exchanging two paths (see exchange_paths)
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+# Name of the file, in the state folder, caching the information read from
+# the headers of the RPMs (see get_package_index)
+PACKAGE_INDEX = 'packages.json'
+
+# Comparison operators of the EVR selector of delete_rpms
+EVR_OPERATORS = {
+    '<': lambda sense: sense < 0,
+    '<=': lambda sense: sense <= 0,
+    '=': lambda sense: sense == 0,
+    '==': lambda sense: sense == 0,
+    '!=': lambda sense: sense != 0,
+    '>=': lambda sense: sense >= 0,
+    '>': lambda sense: sense > 0,
+}
+
+# Name of the file, in the state folder, recording the content of the repo
+# at the last successful run of createrepo
+MANIFEST = 'createrepo.manifest'
+
+# Segments considered by rpmvercmp: runs of digits, runs of letters and the
+# special ``~`` and ``^`` characters, everything else is a separator.
+EVR_SEGMENTS = re.compile(r'[0-9]+|[a-zA-Z]+|~|\^')
+
+
 def is_rpm(rpmfile):
     ''' Check if the provided rpm is indeed one.
     '''
@@ -49,7 +175,23 @@ def is_rpm(rpmfile):
     stream = open(rpmfile, 'rb')
     start = stream.read(4)
     stream.close()
-    return start == '\xed\xab\xee\xdb'
+    return start == b'\xed\xab\xee\xdb'
+
+
+def file_checksum(path, checksum_type='sha256'):
+    ''' Return the hexadecimal checksum of the given file. '''
+    if checksum_type == 'sha':
+        checksum_type = 'sha1'
+    digest = hashlib.new(checksum_type)
+    stream = open(path, 'rb')
+    try:
+        block = stream.read(BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = stream.read(BLOCK_SIZE)
+    finally:
+        stream.close()
+    return digest.hexdigest()
 
 
 def get_rpm_headers(rpmfile):
@@ -60,7 +202,7 @@ def get_rpm_headers(rpmfile):
         return
     LOG.debug('get_rpm_headers')
     fd = os.open(rpmfile, os.O_RDONLY)
-    headers = TS.hdrFromFdno(fd)
+    headers = get_transaction_set().hdrFromFdno(fd)
     os.close(fd)
     return headers
 
@@ -79,128 +221,933 @@ def get_rpm_tag(rpmfile, tag):
 def get_rpm_name(rpmfile):
     ''' Return the name of the rpm according to its headers information.
     '''
-    return get_rpm_tag(rpmfile, rpm.RPMTAG_NAME)
+    return get_rpm_tag(rpmfile, get_rpm_module().RPMTAG_NAME)
 
 
 def get_rpm_version(rpmfile):
     ''' Return the version of the rpm according to its headers information.
     '''
-    return get_rpm_tag(rpmfile, rpm.RPMTAG_VERSION)
+    return get_rpm_tag(rpmfile, get_rpm_module().RPMTAG_VERSION)
 
 
 def get_rpm_version_release(rpmfile):
     ''' Return the version-release of the rpm according to its headers
     information.
     '''
-    vers = get_rpm_tag(rpmfile, rpm.RPMTAG_VERSION),
-    rele = get_rpm_tag(rpmfile, rpm.RPMTAG_RELEASE),
+    rpmlib = get_rpm_module()
+    vers = get_rpm_tag(rpmfile, rpmlib.RPMTAG_VERSION),
+    rele = get_rpm_tag(rpmfile, rpmlib.RPMTAG_RELEASE),
     if vers and rele and vers[0] and rele[0]:
         return '%s-%s' % (vers[0], rele[0])
 
 
-def get_duplicated_rpms(folder):
-    ''' Browse all the files in a folder and find out which are RPMs and
-    return the RPMs of an application present multiple time.
+def get_rpm_arch(headers):
+    ''' Return the architecture of the rpm according to its headers
+    information, ``src`` for source RPMs (which, as for librpm, are the ones
+    not having a SOURCERPM tag).
     '''
-    LOG.debug('get_duplicated_rpms')
+    rpmlib = get_rpm_module()
+    if not headers[rpmlib.RPMTAG_SOURCERPM]:
+        return 'src'
+    return headers[rpmlib.RPMTAG_ARCH]
+
+
+def format_nevra(name, epoch, version, release, arch):
+    ''' Return the name-[epoch:]version-release.arch of a package. '''
+    if epoch is None or epoch == '':
+        return '%s-%s-%s.%s' % (name, version, release, arch)
+    return '%s-%s:%s-%s.%s' % (name, epoch, version, release, arch)
+
+
+def get_rpm_nevra(rpmfile):
+    ''' Return the name-[epoch:]version-release.arch of the rpm according to
+    its headers information.
+    '''
+    headers = get_rpm_headers(rpmfile)
+    if not headers:
+        return
+    rpmlib = get_rpm_module()
+    return format_nevra(
+        headers[rpmlib.RPMTAG_NAME], headers[rpmlib.RPMTAG_EPOCH],
+        headers[rpmlib.RPMTAG_VERSION], headers[rpmlib.RPMTAG_RELEASE],
+        get_rpm_arch(headers))
+
+
+def record_action(action, folder, filename, nevra=None, digest=None,
+                  message=None):
+    ''' Record the specified action done on the specified file of the
+    specified repo in the journal or, if there is none, in the logs.
+
+    ``digest`` is the checksum of the file when it is already known, the
+    files are never read only to record it.
+    '''
+    if JOURNAL is None:
+        LOG.info('%s file %s', action.capitalize(), filename)
+        if message:
+            LOG.info('   Message: %s', message)
+        return
+
+    name = None
+    if nevra:
+        name = nevra.rsplit('-', 2)[0]
+    JOURNAL.record(
+        action, folder, filename, name=name, nevra=nevra, digest=digest,
+        message=message)
+
+
+def journal_digest():
+    ''' Return the hashlib object computing, while a file is copied, the
+    checksum to record in the journal, or None if there is no journal.
+    '''
+    if JOURNAL is None:
+        return None
+    return hashlib.sha256()
+
+
+def vercmp_key(value):
+    ''' Return a tuple which, when compared with the tuple of another
+    version (or release) string, sorts the same way ``rpmvercmp`` does.
+
+    Each segment is turned into a ``(rank, value)`` tuple, the ranks being
+    chosen so that ``~`` sorts before the end of the string, the end of the
+    string before ``^``, ``^`` before letters and letters before digits.
+    '''
+    if value is None:
+        return ()
+    key = []
+    for segment in EVR_SEGMENTS.findall(value):
+        if segment == '~':
+            key.append((0,))
+        elif segment == '^':
+            key.append((2,))
+        elif segment.isdigit():
+            key.append((4, int(segment)))
+        else:
+            key.append((3, segment))
+    key.append((1,))
+    return tuple(key)
+
+
+def evr_key(epoch, version, release):
+    ''' Return the sort key of the given epoch, version and release.
+
+    Sorting on this key gives the same order as ``rpm.labelCompare`` on
+    the ``(epoch, version, release)`` tuples but computes the key only once
+    per package instead of once per comparison.
+    '''
+    if epoch is None or epoch == '':
+        epoch = '0'
+    return (
+        vercmp_key(str(epoch)), vercmp_key(version), vercmp_key(release))
+
+
+class RpmEntry(object):
+    ''' Compact record of a RPM found while scanning a repository.
+
+    Using ``__slots__``, interned strings and storing only the basename of
+    the file keeps the memory used per package low on very large
+    repositories. The record can still be accessed as the dictionaries
+    previously returned by get_duplicated_rpms, ie: ``entry['version']``
+    or ``entry['filename']``.
+    '''
+    __slots__ = ('name', 'epoch', 'ver', 'rel', 'arch', 'folder', 'basename')
+
+    def __init__(self, name, epoch, ver, rel, arch, folder, basename):
+        self.name = intern(name)
+        self.epoch = epoch
+        self.ver = intern(ver)
+        self.rel = intern(rel)
+        self.arch = intern(arch)
+        self.folder = intern(folder)
+        self.basename = basename
+
+    @property
+    def version(self):
+        ''' Return the version-release of the RPM. '''
+        return '%s-%s' % (self.ver, self.rel)
+
+    @property
+    def nevra(self):
+        ''' Return the name-[epoch:]version-release.arch of the RPM. '''
+        return format_nevra(
+            self.name, self.epoch, self.ver, self.rel, self.arch)
+
+    @property
+    def filename(self):
+        ''' Return the full path to the RPM. '''
+        return os.path.join(self.folder, self.basename)
+
+    @property
+    def evr(self):
+        ''' Return the sort key of the RPM, see evr_key. '''
+        return evr_key(self.epoch, self.ver, self.rel)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return '<RpmEntry %s>' % self.basename
+
+    def to_line(self):
+        ''' Serialize the record into a tab separated line starting with
+        the name of the RPM so that sorting the lines sorts by name.
+        '''
+        epoch = self.epoch
+        if epoch is None:
+            epoch = ''
+        return '%s\t%s\t%s\t%s\t%s\t%s\t%s\n' % (
+            self.name, epoch, self.ver, self.rel, self.arch, self.folder,
+            self.basename)
+
+    @classmethod
+    def from_line(cls, line):
+        ''' Return the RpmEntry serialized in the given line. '''
+        name, epoch, ver, rel, arch, folder, basename = line.rstrip(
+            '\n').split('\t')
+        return cls(name, epoch or None, ver, rel, arch, folder, basename)
+
+
+def get_rpm_dependencies(headers):
+    ''' Return a tuple (provides, requires, files) of the rpm according to
+    its headers information, provides and requires being lists of
+    (name, flags, evr) tuples.
+    '''
+    rpmlib = get_rpm_module()
+    deps = []
+    for name_tag, flags_tag, version_tag in [
+            (rpmlib.RPMTAG_PROVIDENAME, rpmlib.RPMTAG_PROVIDEFLAGS,
+             rpmlib.RPMTAG_PROVIDEVERSION),
+            (rpmlib.RPMTAG_REQUIRENAME, rpmlib.RPMTAG_REQUIREFLAGS,
+             rpmlib.RPMTAG_REQUIREVERSION)]:
+        deps.append(list(zip(
+            headers[name_tag] or [],
+            headers[flags_tag] or [],
+            headers[version_tag] or [])))
+
+    dirnames = headers[rpmlib.RPMTAG_DIRNAMES] or []
+    files = [
+        dirnames[dirindex] + basename
+        for basename, dirindex in zip(
+            headers[rpmlib.RPMTAG_BASENAMES] or [],
+            headers[rpmlib.RPMTAG_DIRINDEXES] or [])
+    ]
+    return (deps[0], deps[1], files)
+
+
+def iter_rpm_headers(folder, filenames=None):
+    ''' Yield a tuple (file name, headers) for the RPMs of the specified
+    folder, all its ``.rpm`` files or the ones specified, the headers being
+    None for the files that are not RPMs.
+
+    The headers of the folders of SCHEDULED_SCAN are read using
+    scan.iter_headers, the others through librpm in directory order.
+    '''
+    in_flight = SCHEDULED_SCAN.get(os.path.normpath(folder))
+    if in_flight:
+        return scan.iter_headers(
+            folder, get_rpm_module().hdr, filenames, in_flight=in_flight)
+    if filenames is None:
+        filenames = [
+            filename for filename in os.listdir(folder)
+            if filename.endswith('.rpm')]
+    return (
+        (filename, get_rpm_headers(os.path.join(folder, filename)))
+        for filename in filenames)
+
+
+def iter_rpm_entries(folder, callback=None):
+    ''' Browse all the files in a folder and yield a RpmEntry for each of
+    the RPMs found.
+
+    If specified, ``callback`` is called with each RpmEntry and the headers
+    of the RPM, allowing to collect more information in the same pass.
+    '''
+    LOG.debug('iter_rpm_entries')
     folder = os.path.expanduser(folder)
+    rpmlib = get_rpm_module()
 
-    seen = {}
-    for filename in os.listdir(folder):
+    for filename, headers in iter_rpm_headers(folder):
+        if not headers:
+            continue
+
+        name = headers[rpmlib.RPMTAG_NAME]
+        version = headers[rpmlib.RPMTAG_VERSION]
+        release = headers[rpmlib.RPMTAG_RELEASE]
+        if not name or not version or not release:
+            continue
+
+        entry = RpmEntry(
+            name, headers[rpmlib.RPMTAG_EPOCH], version, release,
+            get_rpm_arch(headers), folder, filename)
+        if callback:
+            callback(entry, headers)
+        yield entry
+
+
+def get_package_index(folder):
+    ''' Return a list of tuples (RpmEntry, build time) for all the RPMs of
+    the specified folder.
+
+    The information is cached in the state folder of the repo so that only
+    the headers of the RPMs added or changed (according to their size and
+    mtime) since the last call are read.
+    '''
+    LOG.debug('get_package_index')
+    folder = os.path.expanduser(folder)
+    path = os.path.join(folder, STATE_DIR, PACKAGE_INDEX)
+    cache = {}
+    if os.path.exists(path):
+        stream = open(path)
+        try:
+            cache = json.load(stream)
+        except ValueError:
+            LOG.warning('Ignoring invalid package index %s', path)
+        finally:
+            stream.close()
+
+    index = {}
+    changed = {}
+    for filename in sorted(os.listdir(folder)):
         if not filename.endswith('.rpm'):
             continue
+        try:
+            stat = os.stat(os.path.join(folder, filename))
+        except OSError:
+            continue
+        record = cache.get(filename)
+        if record and sys.version_info[0] < 3:
+            # json returns unicode strings, RpmEntry interns them
+            record = [
+                field.encode('utf-8') if isinstance(field, unicode) else field
+                for field in record]
+        if not record or record[:2] != [stat.st_size, stat.st_mtime]:
+            changed[filename] = stat
+            continue
+        index[filename] = record
+
+    if changed:
+        rpmlib = get_rpm_module()
+        for filename, headers in iter_rpm_headers(folder, sorted(changed)):
+            if not headers or not headers[rpmlib.RPMTAG_NAME]:
+                continue
+            stat = changed[filename]
+            index[filename] = [
+                stat.st_size, stat.st_mtime,
+                headers[rpmlib.RPMTAG_NAME], headers[rpmlib.RPMTAG_EPOCH],
+                headers[rpmlib.RPMTAG_VERSION],
+                headers[rpmlib.RPMTAG_RELEASE], get_rpm_arch(headers),
+                headers[rpmlib.RPMTAG_BUILDTIME]]
+
+    if index != cache:
+        try:
+            write_state_file(folder, PACKAGE_INDEX, json.dumps(index))
+        except (IOError, OSError) as err:
+            LOG.debug('Could not save the package index: %s', err)
 
-        filename = os.path.join(folder, filename)
-        name = get_rpm_name(filename)
-        version = get_rpm_version_release(filename)
+    return [
+        (RpmEntry(name, epoch, version, release, arch, folder, filename),
+         buildtime)
+        for filename, (_, _, name, epoch, version, release, arch, buildtime)
+        in sorted(index.items())
+    ]
 
-        if not name or not version:
+
+def select_rpms(packages, name=None, evr=None, arch=None, older_than=None):
+    ''' Return the RpmEntry of the given list of (RpmEntry, build time)
+    tuples matching all the specified selectors:
+      - ``name``: a glob the name of the package must match,
+      - ``evr``: a tuple (operator, ``[epoch:]version[-release]``), for
+        example ``('<', '0.6')``, compared the way rpm does (the release is
+        ignored if not specified),
+      - ``arch``: a list of architectures,
+      - ``older_than``: a number of days the package was built before.
+    '''
+    limit = None
+    if older_than is not None:
+        limit = time.time() - older_than * 24 * 3600
+    selected = []
+    for entry, buildtime in packages:
+        if name and not fnmatch.fnmatchcase(entry.name, name):
             continue
+        if arch and entry.arch not in arch:
+            continue
+        if limit is not None and (not buildtime or buildtime >= limit):
+            continue
+        if evr:
+            op_name, value = evr
+            epoch = entry.epoch
+            if epoch is None:
+                epoch = 0
+            sense = deps.compare_evr(
+                '%s:%s-%s' % (epoch, entry.ver, entry.rel), value,
+                vercmp_key)
+            if not EVR_OPERATORS[op_name](sense):
+                continue
+        selected.append(entry)
+    return selected
+
+
+def _write_chunk(entries, folder):
+    ''' Sort the given RpmEntry by name and write them to a new file in
+    the specified folder, returns the path to this file.
+    '''
+    import tempfile
+    lines = [entry.to_line() for entry in entries]
+    lines.sort()
+    stream = tempfile.NamedTemporaryFile(
+        mode='w', dir=folder, suffix='.chunk', delete=False)
+    try:
+        stream.writelines(lines)
+    finally:
+        stream.close()
+    return stream.name
+
+
+def group_rpm_entries(entries, external_sort=False, chunk_size=50000):
+    ''' Group the given RpmEntry by name and yield a tuple (name, entries)
+    for each name, sorted by name.
+
+    By default the grouping is done in memory. With ``external_sort``, the
+    entries are written to disk by sorted chunks of ``chunk_size`` entries
+    which are then merged, so that only one chunk and one group are in
+    memory at a time.
+    '''
+    if external_sort:
+        # Imported here, as subprocess in run_createrepo, not to slow
+        # down the start-up
+        import tempfile
+        workdir = tempfile.mkdtemp(prefix='repo_manager-')
+        chunks = []
+        try:
+            chunk = []
+            for entry in entries:
+                if '\t' in entry.basename or '\n' in entry.basename:
+                    LOG.warning(
+                        'Skipping %s, unsupported filename', entry.filename)
+                    continue
+                chunk.append(entry)
+                if len(chunk) >= chunk_size:
+                    chunks.append(_write_chunk(chunk, workdir))
+                    chunk = []
+
+            if chunks:
+                if chunk:
+                    chunks.append(_write_chunk(chunk, workdir))
+                    chunk = []
+                streams = [open(path) for path in chunks]
+                try:
+                    lines = heapq.merge(*streams)
+                    for name, group in itertools.groupby(
+                            lines, key=lambda line: line.split('\t', 1)[0]):
+                        yield (name, [RpmEntry.from_line(line)
+                                      for line in group])
+                finally:
+                    for stream in streams:
+                        stream.close()
+                return
+            # Everything fitted in one chunk, group it in memory
+            entries = chunk
+        finally:
+            shutil.rmtree(workdir)
+
+    seen = {}
+    for entry in entries:
+        if entry.name in seen:
+            seen[entry.name].append(entry)
+        else:
+            seen[entry.name] = [entry]
+    for name in sorted(seen):
+        yield (name, seen.pop(name))
+
+
+def iter_duplicated_rpms(folder, external_sort=False, callback=None):
+    ''' Browse all the files in a folder and yield a tuple (name, rpms) for
+    each application present multiple time, sorted by name.
+
+    ``callback`` is passed to iter_rpm_entries.
+    '''
+    LOG.debug('iter_duplicated_rpms')
+    for name, rpms in group_rpm_entries(
+            iter_rpm_entries(folder, callback=callback),
+            external_sort=external_sort):
+        if len(rpms) > 1:
+            yield (name, rpms)
+
+
+def get_duplicated_rpms(folder, external_sort=False):
+    ''' Browse all the files in a folder and find out which are RPMs and
+    return the RPMs of an application present multiple time.
+    '''
+    LOG.debug('get_duplicated_rpms')
+    return dict(iter_duplicated_rpms(folder, external_sort=external_sort))
+
+
+def split_duplicates(rpms, keep=3):
+    ''' Sort the given RPMs of an application by epoch, version and release
+    and return a tuple containing the list of RPMs to keep (the ``keep``
+    most recent versions) and the list of RPMs that could be removed.
+    '''
+    rpms = sorted(
+        [(rpmfile['evr'], rpmfile) for rpmfile in rpms],
+        key=operator.itemgetter(0))
+    evrs = []
+    for evr, rpmfile in rpms:
+        if not evrs or evrs[-1] != evr:
+            evrs.append(evr)
+    keep_evrs = evrs[-int(keep):]
+
+    to_keep = []
+    to_remove = []
+    for evr, rpmfile in rpms:
+        if evr in keep_evrs:
+            to_keep.append(rpmfile)
+        else:
+            to_remove.append(rpmfile)
+    return (to_keep, to_remove)
+
+
+def new_trash_batch(folder, action):
+    ''' Return the path to a new folder of the trash of the specified repo
+    in which to move the files removed by the given action.
+
+    The names of the batches sort chronologically, the folder itself is
+    only created when the first file is moved into it.
+    '''
+    return os.path.join(
+        folder, TRASH_DIR,
+        '%.6f-%s-%s' % (time.time(), os.getpid(), action))
+
+
+def remove_rpm_file(filename, trash_batch=None):
+    ''' Remove the specified file, either by unlinking it or, if a trash
+    batch is specified, by renaming it into this batch which is O(1)
+    whatever the size of the file.
+    '''
+    if trash_batch:
+        if not os.path.isdir(trash_batch):
+            os.makedirs(trash_batch)
+        try:
+            os.rename(filename, os.path.join(
+                trash_batch, os.path.basename(filename) + TRASH_SUFFIX))
+            return
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            LOG.warning(
+                'Trash of %s is on another filesystem, removing the file',
+                filename)
+    os.unlink(filename)
+
+
+def new_dependency_index():
+    ''' Return a tuple containing an empty deps.DependencyIndex and the
+    callback to give to iter_rpm_entries to fill it while scanning a repo.
+    '''
+    index = deps.DependencyIndex(vercmp_key)
+
+    def _add_package(entry, headers):
+        ''' Add the binary RPMs scanned to the index. '''
+        if entry.arch == 'src':
+            return
+        provides, requires, files = get_rpm_dependencies(headers)
+        index.add_package(entry.filename, provides, requires, files)
+
+    return (index, _add_package)
+
+
+def new_srpm_index():
+    ''' Return a tuple containing the list of the source RpmEntry, the
+    dictionary associating to the file name of each binary RPM the file name
+    of its SRPM (its SOURCERPM tag) and the callback to give to
+    iter_rpm_entries to fill them while scanning a repo.
+    '''
+    srpms = []
+    sources = {}
+
+    def _add_package(entry, headers):
+        ''' Index the RPMs scanned by SRPM. '''
+        if entry.arch == 'src':
+            srpms.append(entry)
+        else:
+            sources[entry.basename] = intern(
+                headers[get_rpm_module().RPMTAG_SOURCERPM])
+
+    return (srpms, sources, _add_package)
+
+
+def select_orphan_srpms(srpms, sources, removed=(), keep=3):
+    ''' Return, sorted by file name, the source RpmEntry that can be
+    removed given the SRPM of each binary RPM (``sources``, see
+    new_srpm_index) and the binary RPMs being removed.
+
+    These are the SRPMs none of the remaining binary RPMs was built from
+    and, for the applications with only SRPMs in the repo, the SRPMs not
+    among the ``keep`` most recent versions.
+    '''
+    referenced = set(
+        srpm for rpmfile, srpm in sources.items() if rpmfile not in removed)
+    built = set(sources.values())
+    # Applications with binary RPMs in the repo
+    names = set(entry.name for entry in srpms if entry.basename in built)
+
+    standalone = {}
+    to_remove = []
+    for entry in srpms:
+        if entry.name not in names:
+            standalone.setdefault(entry.name, []).append(entry)
+        elif entry.basename not in referenced:
+            to_remove.append(entry)
+    for name in standalone:
+        to_remove.extend(split_duplicates(standalone[name], keep)[1])
+    return sorted(to_remove, key=operator.attrgetter('basename'))
+
+
+def check_removals(index, filenames, check_deps='warn', quiet=False):
+    ''' Check, using the given deps.DependencyIndex, if removing all the
+    specified files at once leaves requirements unresolved and print them,
+    on stderr if ``quiet``.
 
-        if name in seen:
-            seen[name].append(
-                {'version': version, 'filename': filename}
-            )
+    Returns the list of files that can be removed: all of them if
+    ``check_deps`` is ``warn``, only the ones not breaking any requirement
+    if it is ``skip``.
+    '''
+    stream = sys.stderr if quiet else sys.stdout
+    broken = index.broken_by(filenames)
+    for filename in sorted(broken):
+        for requirer, requirement in sorted(broken[filename]):
+            print('{0} is needed by {1} ({2})'.format(
+                filename, requirer, requirement), file=stream)
+        if check_deps == 'skip':
+            print('Not removing {0}'.format(filename), file=stream)
+
+    if check_deps == 'skip':
+        return [filename for filename in filenames if filename not in broken]
+    return filenames
+
+
+class Reporter(object):
+    ''' Stream the records describing the result of a command, as they are
+    produced, either as a JSON array (``json``) or as one JSON object per
+    line (``ndjson``).
+
+    With the ``text`` format the records are ignored, the functions print
+    their human readable summary themselves. Given a reporter, they print
+    nothing on stdout, only errors on stderr, so that the records can be
+    written there.
+    '''
+
+    def __init__(self, fmt='text', stream=None):
+        self.format = fmt
+        self.stream = stream or sys.stdout
+        self.count = 0
+
+    def __call__(self, record):
+        if self.format == 'text':
+            return
+        line = json.dumps(record, sort_keys=True)
+        if self.format == 'json':
+            line = ('[\n' if not self.count else ',\n') + line
         else:
-            seen[name] = [
-                {'version': version, 'filename': filename}
-            ]
+            line += '\n'
+        self.stream.write(line)
+        self.stream.flush()
+        self.count += 1
+
+    def close(self):
+        ''' End the output. '''
+        if self.format == 'json':
+            self.stream.write('\n]\n' if self.count else '[]\n')
+            self.stream.flush()
+
 
-    dups = {}
-    for rpmfile in sorted(seen):
-        if len(seen[rpmfile]) > 1:
-            dups[rpmfile] = seen[rpmfile]
-    return dups
+def plan_entry(filename, nevra=None):
+    ''' Return the entry of a clean plan for the specified file: its
+    folder, as an absolute path, name, NEVRA and the size and mtime used to
+    check, when applying the plan, that it did not change.
+    '''
+    stat = os.stat(filename)
+    return {
+        'folder': os.path.abspath(os.path.dirname(filename)),
+        'file': os.path.basename(filename),
+        'nevra': nevra,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
 
 
 def clean_repo(folder, keep=3, srpm=False, dry_run=False,
-               no_createrepo=False, createrepo_cmd=None):
+               no_createrepo=False, createrepo_cmd=None,
+               external_sort=False, trash=False, check_deps=None,
+               force_createrepo=False, plan=None, report=None):
     ''' Remove duplicates from a given folder.
+
+    ``srpm`` True removes all the source RPMs of the folder. ``orphans``
+    only removes the ones none of the remaining binary RPMs was built from
+    (according to their SOURCERPM tag, read in the same pass as the rest)
+    and, for the applications with only source RPMs, the ones not in the
+    ``keep`` most recent versions, see select_orphan_srpms.
+
+    If ``check_deps`` is ``warn`` or ``skip``, the duplicates whose removal
+    would leave requirements of the remaining RPMs unresolved are reported
+    or, respectively, kept.
+
+    In dry-run mode, if ``plan`` is a list, the entries (see plan_entry) of
+    the files that would be removed are appended to it.
+
+    If specified, ``report`` (see Reporter) is called with a record for
+    each file removed, as it is, and with a summary record at the end,
+    instead of printing the human readable output. The RPMs are then always
+    grouped with the external sort (see group_rpm_entries) so that the
+    memory usage stays bounded, unless ``check_deps`` or orphan ``srpm``
+    need to see the whole repo.
     '''
     LOG.debug('clean_repo')
     folder = os.path.expanduser(folder)
+    quiet = bool(report)
+    if report:
+        external_sort = True
 
     if not os.path.exists(folder):
-        print '%s not found' % folder
+        print('%s not found' % folder,
+              file=sys.stderr if quiet else sys.stdout)
         return
 
     before = len(os.listdir(folder))
-    dups = get_duplicated_rpms(folder)
-    cnt = 0
+    trash_batch = None
+    if trash:
+        trash_batch = new_trash_batch(folder, 'clean')
+    index = None
+    callbacks = []
+    if check_deps:
+        index, callback = new_dependency_index()
+        callbacks.append(callback)
+    srpms = sources = None
+    removed = set()
+    if srpm == 'orphans':
+        srpms, sources, callback = new_srpm_index()
+        callbacks.append(callback)
+
+    def _callback(entry, headers):
+        ''' Collect the information needed from the headers. '''
+        for function in callbacks:
+            function(entry, headers)
+
+    def _candidates(rpms):
+        ''' Return the RPMs to which ``keep`` applies. '''
+        if srpm == 'orphans':
+            # The SRPMs are handled once all the binary RPMs are known
+            return [rpmfile for rpmfile in rpms if rpmfile.arch != 'src']
+        return rpms
     if not dry_run:
         LOG.info(
             'Cleaning duplicates files (keeping the last %s) in %s',
             keep, folder)
-    for dup in sorted(dups):
-        versions = [rpmfile['version'] for rpmfile in sorted(dups[dup])]
-        keep_versions = versions[-keep:]
-        for rpmfile in sorted(dups[dup]):
-            if rpmfile['version'] not in keep_versions:
-                cnt += 1
-                filename = rpmfile['filename']
-                if dry_run:
-                    print('Remove file {0}'.format(filename))
-                else:
-                    LOG.info(
-                        'Remove file %s while cleaning the repo', filename)
-                    os.unlink(filename)
+
+    # Removed while the repo is scanned, unless the dependencies have to be
+    # checked first
+    removals = (
+        rpmfile
+        for _, rpms in iter_duplicated_rpms(
+            folder, external_sort=external_sort,
+            callback=_callback if callbacks else None)
+        for rpmfile in split_duplicates(_candidates(rpms), keep)[1]
+    )
+
+    skipped = 0
+    if index:
+        removals = list(removals)
+        filenames = set(check_removals(
+            index, [rpmfile.filename for rpmfile in removals], check_deps,
+            quiet=quiet))
+        skipped = len(removals) - len(filenames)
+        removals = [
+            rpmfile for rpmfile in removals if rpmfile.filename in filenames]
+
+    cnt = 0
+    linked_cnt = linked_size = 0
+    for rpmfile in removals:
+        cnt += 1
+        if sources is not None:
+            removed.add(rpmfile.basename)
+        filename = rpmfile.filename
+        stat = os.stat(filename)
+        if stat.st_nlink > 1:
+            # Hardlinked, for example in a snapshot: removing it does not
+            # free any space
+            linked_cnt += 1
+            linked_size += stat.st_size
+        if dry_run:
+            if not quiet:
+                print('Remove file {0}'.format(filename))
+            if plan is not None:
+                plan.append(plan_entry(filename, rpmfile.nevra))
+        else:
+            record_action('clean', folder, filename, nevra=rpmfile.nevra)
+            remove_rpm_file(filename, trash_batch)
+        if report:
+            report({
+                'type': 'removal', 'repo': folder,
+                'file': rpmfile.basename, 'name': rpmfile.name,
+                'nevra': rpmfile.nevra, 'size': stat.st_size,
+                'dry_run': dry_run})
 
     srpm_cnt = 0
     if srpm:
         LOG.info('Cleaning duplicates srpm')
-        for rpmfile in os.listdir(folder):
-            if rpmfile.endswith('.src.rpm'):
-                srpm_cnt += 1
-                filename = os.path.join(folder, rpmfile)
-                if dry_run:
+        if srpm == 'orphans':
+            srpm_files = [
+                (rpmfile.filename, rpmfile.nevra)
+                for rpmfile in select_orphan_srpms(
+                    srpms, sources, removed, keep)]
+        else:
+            srpm_files = [
+                (os.path.join(folder, rpmfile), None)
+                for rpmfile in os.listdir(folder)
+                if rpmfile.endswith('.src.rpm')]
+        for filename, nevra in srpm_files:
+            srpm_cnt += 1
+            rpmfile = os.path.basename(filename)
+            stat = os.stat(filename)
+            if stat.st_nlink > 1:
+                linked_cnt += 1
+                linked_size += stat.st_size
+            if dry_run:
+                if not quiet:
                     print('Remove file {0}'.format(filename))
-                else:
-                    LOG.info(
-                        'Remove file %s while cleaning the repo', filename)
-                    os.unlink(filename)
-
-    print folder
-    print '  %s files before' % before
-    print '  %s RPMs removed' % cnt
-    if srpm:
-        print '  %s source RPMs removed' % srpm_cnt
-    print '  %s files after' % len(os.listdir(folder))
+                if plan is not None:
+                    plan.append(plan_entry(
+                        filename, nevra or get_rpm_nevra(filename)))
+            else:
+                record_action(
+                    'clean', folder, filename,
+                    nevra=nevra or get_rpm_nevra(filename))
+                remove_rpm_file(filename, trash_batch)
+            if report:
+                report({
+                    'type': 'removal', 'repo': folder, 'file': rpmfile,
+                    'name': rpmfile.rsplit('-', 2)[0], 'nevra': nevra,
+                    'size': stat.st_size, 'dry_run': dry_run})
+
+    if not dry_run:
+        LOG.info('%s files removed from %s', cnt + srpm_cnt, folder)
+
+    after = len(os.listdir(folder))
+    if not quiet:
+        print(folder)
+        print('  %s files before' % before)
+        print('  %s RPMs removed' % cnt)
+        if check_deps == 'skip':
+            print('  %s RPMs kept to satisfy dependencies' % skipped)
+        if srpm:
+            print('  %s source RPMs removed' % srpm_cnt)
+        if linked_cnt:
+            print('  %s RPMs removed are still referenced elsewhere '\
+                '(snapshots), %s bytes not freed' % (linked_cnt, linked_size))
+        print('  %s files after' % after)
+    if report:
+        report({
+            'type': 'summary', 'repo': folder, 'keep': int(keep),
+            'dry_run': dry_run, 'files_before': before,
+            'files_after': after, 'removed': cnt, 'srpm_removed': srpm_cnt,
+            'kept_for_deps': skipped, 'linked': linked_cnt,
+            'linked_bytes': linked_size})
 
     if not dry_run and not no_createrepo:
-        run_createrepo(folder, createrepo_cmd=createrepo_cmd)
+        run_createrepo(
+            folder, createrepo_cmd=createrepo_cmd, force=force_createrepo,
+            quiet=quiet)
+
+
+def apply_clean_plan(plan, no_createrepo=False, createrepo_cmd=None,
+                     trash=False, force_createrepo=False):
+    ''' Remove the files listed in the given clean plan, as returned by
+    clean_repo, without scanning the folders again.
+
+    Files whose size or mtime changed since the plan was made, or which
+    are gone, are not removed. Returns the number of such files. A plan
+    with relative folders, which depend on where it is applied from, is
+    refused as a whole.
+    '''
+    LOG.debug('apply_clean_plan')
+    relative = sorted(set(
+        entry['folder'] for entry in plan
+        if not os.path.isabs(entry['folder'])))
+    for folder in relative:
+        print('The folder "%s" of the plan is not an absolute path, not '\
+            'applying the plan' % folder)
+    if relative:
+        return len(plan)
+
+    folders = []
+    entries = {}
+    for entry in plan:
+        if entry['folder'] not in entries:
+            folders.append(entry['folder'])
+        entries.setdefault(entry['folder'], []).append(entry)
+
+    refused = 0
+    for folder in folders:
+        if not os.path.isdir(folder):
+            print('%s not found' % folder)
+            refused += len(entries[folder])
+            continue
+
+        trash_batch = None
+        if trash:
+            trash_batch = new_trash_batch(folder, 'clean')
+        LOG.info('Applying the clean plan to %s', folder)
+        cnt = 0
+        changed = 0
+        for entry in entries[folder]:
+            filename = os.path.join(folder, entry['file'])
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                print('File {0} is gone, skipping it'.format(filename))
+                changed += 1
+                continue
+            if stat.st_size != entry['size'] \
+                    or stat.st_mtime != entry['mtime']:
+                print('File {0} changed since the plan was made, not '\
+                    'removing it'.format(filename))
+                changed += 1
+                continue
+            record_action('clean', folder, filename, nevra=entry['nevra'])
+            remove_rpm_file(filename, trash_batch)
+            cnt += 1
+        refused += changed
+
+        LOG.info('%s files removed from %s', cnt, folder)
+        print(folder)
+        print('  %s files removed' % cnt)
+        print('  %s files changed since the plan was made' % changed)
+
+        if cnt and not no_createrepo:
+            run_createrepo(
+                folder, createrepo_cmd=createrepo_cmd, force=force_createrepo)
+
+    return refused
 
 
-def info_repo(folder, keep=3):
+def info_repo(folder, keep=3, external_sort=False, report=None):
     ''' Returns some info/stats about the specified repo.
+
+    If specified, ``report`` (see Reporter) is called with a record for
+    each package, as the repo is scanned, and with a summary record at the
+    end, instead of printing the human readable output. The RPMs are then
+    always grouped with the external sort (see group_rpm_entries) so that
+    the memory usage stays bounded.
     '''
     LOG.debug('info_repo')
     folder = os.path.expanduser(folder)
+    if report:
+        external_sort = True
 
     if not os.path.exists(folder):
-        print '%s not found' % folder
+        print('%s not found' % folder,
+              file=sys.stderr if report else sys.stdout)
         return
 
-    print folder
     cnt_rpm = 0
     cnt_srpm = 0
     for filename in os.listdir(folder):
@@ -209,25 +1156,68 @@ def info_repo(folder, keep=3):
         elif filename.endswith('.rpm'):
             cnt_rpm += 1
 
-    print '  %s RPMs found' % cnt_rpm
-    print '  %s source RPMs found' % cnt_srpm
+    if not report:
+        print(folder)
+        print('  %s RPMs found' % cnt_rpm)
+        print('  %s source RPMs found' % cnt_srpm)
 
-    dups = get_duplicated_rpms(folder)
     cnt = 0
-    for dup in sorted(dups):
-        versions = [rpmfile['version'] for rpmfile in sorted(dups[dup])]
-        keep_versions = versions[-keep:]
-        for rpmfile in sorted(dups[dup]):
-            if rpmfile['version'] not in keep_versions:
-                cnt += 1
+    if report:
+        groups = group_rpm_entries(
+            iter_rpm_entries(folder), external_sort=external_sort)
+    else:
+        groups = iter_duplicated_rpms(folder, external_sort=external_sort)
+    for name, rpms in groups:
+        to_keep, to_remove = split_duplicates(rpms, keep)
+        cnt += len(to_remove)
+        if report:
+            report({
+                'type': 'package', 'repo': folder, 'name': name,
+                'keep': [rpmfile.basename for rpmfile in to_keep],
+                'remove': [rpmfile.basename for rpmfile in to_remove]})
+
+    if report:
+        report({
+            'type': 'summary', 'repo': folder, 'keep': int(keep),
+            'rpms': cnt_rpm, 'srpms': cnt_srpm, 'removable': cnt})
+    else:
+        print('  %s SRPMs/RPMs are present more than %s times and thus '\
+            'could be removed' % (cnt, keep))
+
 
-    print '  %s SRPMs/RPMs are present more than %s times and thus could '\
-        'be removed' % (cnt, keep)
+def compare_rpm_files(rpmfile, existing, checksums=None):
+    ''' Compare the specified RPM with an existing file and return None if
+    the file does not exist, ALREADY_PRESENT if it is the same RPM (same
+    NEVRA, size and checksum) and CONFLICT otherwise.
+
+    The files are only read entirely when their NEVRA and size match, the
+    checksums then computed are stored in the ``checksums`` dictionary, if
+    one is given, keyed on the path of the file.
+    '''
+    if not os.path.exists(existing):
+        return None
+    if os.path.samefile(rpmfile, existing):
+        return ALREADY_PRESENT
+    if os.path.getsize(rpmfile) != os.path.getsize(existing) \
+            or get_rpm_nevra(rpmfile) != get_rpm_nevra(existing):
+        return CONFLICT
+    checksum = file_checksum(rpmfile)
+    existing_checksum = file_checksum(existing)
+    if checksums is not None:
+        checksums[rpmfile] = checksum
+        checksums[existing] = existing_checksum
+    if checksum != existing_checksum:
+        return CONFLICT
+    return ALREADY_PRESENT
 
 
 def add_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
-            message=None):
+            message=None, force_createrepo=False):
     ''' Copy the provided RPM into the specified folder.
+
+    Returns ADDED, ALREADY_PRESENT if the exact same RPM is already in the
+    folder (in which case neither the copy nor createrepo are done) or
+    CONFLICT if a different RPM with the same file name is there.
     '''
     LOG.debug('add_rpm')
     rpm = os.path.expanduser(rpm)
@@ -235,29 +1225,49 @@ def add_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
 
     # Check input
     if not is_rpm(rpm):
-        print '"%s" does not point to a RPM file' % rpm
+        print('"%s" does not point to a RPM file' % rpm)
         return
 
     # Check destination
     if not os.path.exists(folder):
-        print 'Folder "%s" does not exist' % folder
+        print('Folder "%s" does not exist' % folder)
         return
     elif not os.path.isdir(folder):
-        print '"%s" is not a folder' % folder
+        print('"%s" is not a folder' % folder)
         return
 
-    LOG.info('Adding file "%s", into folder "%s"', rpm, folder)
-    if message:
-        LOG.info('   Message: %s', message)
-    shutil.copy(rpm, folder)
+    existing = os.path.join(folder, os.path.basename(rpm))
+    status = compare_rpm_files(rpm, existing)
+    if status == ALREADY_PRESENT:
+        print('"%s" is already present in "%s"' % (rpm, folder))
+        return status
+    elif status == CONFLICT:
+        print('"%s" conflicts with "%s" which has the same name but a '\
+            'different content' % (rpm, existing))
+        return status
+
+    digest = journal_digest()
+    tmp = copy_to_temp(rpm, folder, digest)
+    os.rename(tmp, existing)
+    record_action(
+        'add', folder, existing, nevra=get_rpm_nevra(existing),
+        digest=digest and digest.hexdigest(), message=message)
 
     if not no_createrepo:
-        run_createrepo(folder, createrepo_cmd=createrepo_cmd)
+        run_createrepo(
+            folder, createrepo_cmd=createrepo_cmd, force=force_createrepo)
+    return ADDED
 
 
 def delete_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
-               message=None):
+               message=None, trash=False, check_deps=None,
+               force_createrepo=False):
     ''' Delete the specified RPM of the specified folder.
+
+    If ``check_deps`` is ``warn`` or ``skip``, report the requirements of
+    the other RPMs of the folder the removal would leave unresolved and,
+    with ``skip``, do not remove it in that case. Returns True if the RPM
+    was removed.
     '''
     LOG.debug('delete_rpm')
     rpm = os.path.expanduser(rpm)
@@ -266,30 +1276,173 @@ def delete_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
     # Check input
     path = os.path.join(folder, rpm)
     if not os.path.exists(path):
-        print 'File "%s" cannot be found' % path
+        print('File "%s" cannot be found' % path)
         return
     if os.path.isdir(path):
-        print '"%s" points to a directory' % path
+        print('"%s" points to a directory' % path)
         return
 
     if not is_rpm(path):
-        print '"%s" does not point to a RPM file' % path
+        print('"%s" does not point to a RPM file' % path)
         return
 
-    LOG.info('Deleting file "%s"', path)
-    if message:
-        LOG.info('   Message: %s', message)
-    os.unlink(path)
+    if check_deps:
+        index, callback = new_dependency_index()
+        for _ in iter_rpm_entries(folder, callback=callback):
+            pass
+        if not check_removals(index, [path], check_deps):
+            return
+
+    record_action(
+        'delete', folder, path, nevra=get_rpm_nevra(path), message=message)
+    trash_batch = None
+    if trash:
+        trash_batch = new_trash_batch(folder, 'delete')
+    remove_rpm_file(path, trash_batch)
 
     if not no_createrepo:
-        run_createrepo(folder, createrepo_cmd=createrepo_cmd)
+        run_createrepo(
+            folder, createrepo_cmd=createrepo_cmd, force=force_createrepo)
+    return True
+
+
+def delete_rpms(folder, name=None, evr=None, arch=None, older_than=None,
+                dry_run=False, no_createrepo=False, createrepo_cmd=None,
+                message=None, trash=False, check_deps=None,
+                force_createrepo=False, rpms=None):
+    ''' Delete, in one batch, the RPMs of the specified folder matching all
+    the given selectors (see select_rpms) and run createrepo once.
+
+    If ``rpms``, a list of files of the folder, is given, only these RPMs
+    are deleted. With ``check_deps``, the removals are checked all at once,
+    as removing several RPMs may break a requirement that removing any one
+    of them does not.
+
+    The dry-run prints exactly what the actual run does. Returns the list of
+    RpmEntry removed (or that would be).
+    '''
+    LOG.debug('delete_rpms')
+    folder = os.path.expanduser(folder)
+
+    if not os.path.isdir(folder):
+        print('%s not found' % folder)
+        return
+
+    packages = get_package_index(folder)
+    if rpms is not None:
+        paths = set()
+        for rpm in rpms:
+            path = os.path.join(folder, os.path.expanduser(rpm))
+            if not os.path.exists(path):
+                print('File "%s" cannot be found' % path)
+            elif os.path.isdir(path):
+                print('"%s" points to a directory' % path)
+            elif not is_rpm(path):
+                print('"%s" does not point to a RPM file' % path)
+            else:
+                paths.add(os.path.normpath(path))
+        packages = [
+            (entry, buildtime) for entry, buildtime in packages
+            if os.path.normpath(entry.filename) in paths]
+
+    removals = select_rpms(
+        packages, name=name, evr=evr, arch=arch, older_than=older_than)
+
+    skipped = 0
+    if check_deps and removals:
+        index, callback = new_dependency_index()
+        for _ in iter_rpm_entries(folder, callback=callback):
+            pass
+        filenames = set(check_removals(
+            index, [rpmfile.filename for rpmfile in removals], check_deps))
+        skipped = len(removals) - len(filenames)
+        removals = [
+            rpmfile for rpmfile in removals if rpmfile.filename in filenames]
+
+    trash_batch = None
+    if trash and not dry_run:
+        trash_batch = new_trash_batch(folder, 'delete')
+    for rpmfile in removals:
+        print('Remove file {0}'.format(rpmfile.filename))
+        if not dry_run:
+            record_action(
+                'delete', folder, rpmfile.filename, nevra=rpmfile.nevra,
+                message=message)
+            remove_rpm_file(rpmfile.filename, trash_batch)
+
+    if not dry_run:
+        LOG.info('%s files removed from %s', len(removals), folder)
+
+    print(folder)
+    print('  %s RPMs removed' % len(removals))
+    if check_deps == 'skip':
+        print('  %s RPMs kept to satisfy dependencies' % skipped)
+
+    if removals and not dry_run and not no_createrepo:
+        run_createrepo(
+            folder, createrepo_cmd=createrepo_cmd, force=force_createrepo)
+    return removals
+
+
+def copy_to_temp(rpm, folder, digest=None):
+    ''' Copy the specified file to a temporary file of the specified folder,
+    flushed to the disk, and return its path. If ``digest``, a hashlib
+    object, is given, it is updated with the content copied.
+
+    The temporary file is hidden and does not end with ``.rpm`` so that
+    createrepo and repo_manager ignore it, being in the folder it can then
+    be renamed atomically over a file of the folder.
+    '''
+    tmp = os.path.join(folder, '.%s.%s.part' % (
+        os.path.basename(rpm), os.getpid()))
+    source = open(rpm, 'rb')
+    try:
+        stream = open(tmp, 'wb')
+        try:
+            block = source.read(BLOCK_SIZE)
+            while block:
+                stream.write(block)
+                if digest is not None:
+                    digest.update(block)
+                block = source.read(BLOCK_SIZE)
+            stream.flush()
+            os.fsync(stream.fileno())
+        finally:
+            stream.close()
+        shutil.copymode(rpm, tmp)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        source.close()
+    return tmp
+
+
+def fsync_folder(folder):
+    ''' Flush the entries of the specified folder, ie: the files renamed in
+    it, to the disk.
+    '''
+    fd = os.open(folder, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 
 def replace_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
-                message=None):
+                message=None, force_createrepo=False):
     ''' Replace an RPM in a repository, this means replacing an existing
     RPM of the repository by one being exactly the same (same name, version
-    and release).
+    and release), for example rebuilt or signed.
+
+    The new RPM is written to a temporary file of the folder and renamed
+    over the existing one, so the package is never missing from the repo,
+    and createrepo is run with ``--update`` so that only the metadata of
+    this package is generated again.
+
+    Returns REPLACED, ALREADY_PRESENT if the exact same RPM is already in
+    the folder or CONFLICT if the RPM in the folder has a different NEVRA.
     '''
     LOG.debug('replace_rpm')
     rpm = os.path.expanduser(rpm)
@@ -297,27 +1450,53 @@ def replace_rpm(rpm, folder, no_createrepo=False, createrepo_cmd=None,
 
     # Check input
     if not is_rpm(rpm):
-        print '"%s" does not point to a RPM file' % rpm
+        print('"%s" does not point to a RPM file' % rpm)
         return
 
-    rpmfile = rpm
-    if '/' in rpm:
-        rpmfile = rpm.rsplit('/', 1)[1]
+    # Check destination
+    if not os.path.exists(folder):
+        print('Folder "%s" does not exist' % folder)
+        return
+    elif not os.path.isdir(folder):
+        print('"%s" is not a folder' % folder)
+        return
+
+    existing = os.path.join(folder, os.path.basename(rpm))
+    if not is_rpm(existing):
+        print('RPM "%s" cannot be found' % existing)
+        return
+    nevra = get_rpm_nevra(existing)
+    if get_rpm_nevra(rpm) != nevra:
+        print('"%s" is not the same package as "%s"' % (rpm, existing))
+        return CONFLICT
+    if compare_rpm_files(rpm, existing) == ALREADY_PRESENT:
+        print('"%s" is already present in "%s"' % (rpm, folder))
+        return ALREADY_PRESENT
+
+    digest = journal_digest()
+    tmp = copy_to_temp(rpm, folder, digest)
+    # The RPM may have changed while being copied
+    if get_rpm_nevra(tmp) != nevra:
+        os.unlink(tmp)
+        print('"%s" is not the same package as "%s"' % (rpm, existing))
+        return CONFLICT
+
+    os.rename(tmp, existing)
+    fsync_folder(folder)
+    record_action(
+        'replace', folder, existing, nevra=nevra,
+        digest=digest and digest.hexdigest(), message=message)
+
+    if not no_createrepo:
+        run_createrepo(
+            folder, createrepo_cmd=createrepo_cmd, force=force_createrepo,
+            update=True)
+    return REPLACED
 
-    delete_rpm(
-        rpm, folder_from,
-        no_createrepo=no_createrepo,
-        createrepo_cmd=createrepo_cmd,
-        message=message)
-        
-    add_rpm(
-        path, folder_to,
-        no_createrepo=no_createrepo,
-        createrepo_cmd=createrepo_cmd,
-        message=message)
 
 def ugrade_rpm(rpm, folder_from, folder_to,
-               no_createrepo=False, createrepo_cmd=None, message=None):
+               no_createrepo=False, createrepo_cmd=None, message=None,
+               force_createrepo=False):
     ''' Upgrade/copy the specified RPM from one repo into another one.
     '''
     LOG.debug('update_rpm')
@@ -328,50 +1507,299 @@ def ugrade_rpm(rpm, folder_from, folder_to,
     path = os.path.join(folder_from, rpm)
     # Check input
     if not os.path.exists(path):
-        print 'RPM "%s" could not be found' % path
+        print('RPM "%s" could not be found' % path)
         return
     if not is_rpm(path):
-        print '"%s" does not point to a RPM file' % path
+        print('"%s" does not point to a RPM file' % path)
         return
 
     # Check destination
     if not os.path.exists(folder_to):
-        print 'Folder "%s" could not be found' % folder_to
+        print('Folder "%s" could not be found' % folder_to)
         return
     elif not os.path.isdir(folder_to):
-        print '"%s" is not a folder' % folder_to
+        print('"%s" is not a folder' % folder_to)
         return
 
-    add_rpm(
+    status = add_rpm(
         path, folder_to,
         no_createrepo=no_createrepo,
         createrepo_cmd=createrepo_cmd,
-        message=message)
+        message=message,
+        force_createrepo=force_createrepo)
+    if status not in (ADDED, ALREADY_PRESENT):
+        return status
 
     delete_rpm(
         rpm, folder_from,
         no_createrepo=no_createrepo,
         createrepo_cmd=createrepo_cmd,
-        message=message)
+        message=message,
+        force_createrepo=force_createrepo)
+    return status
+
+
+def iter_repo_rpms(folder):
+    ''' Yield, sorted, the paths relative to the specified folder of the
+    RPMs it contains, as seen by createrepo: in all its sub-folders but the
+    repodata, the trash and the state folder of repo_manager.
+    '''
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = sorted(
+            dirname for dirname in dirs
+            if dirname not in ('repodata', STATE_DIR, TRASH_DIR))
+        for filename in sorted(files):
+            if filename.endswith('.rpm'):
+                yield os.path.relpath(os.path.join(root, filename), folder)
+
+
+def _to_bytes(value):
+    ''' Return the given string as bytes, as hashlib wants them. '''
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8', 'surrogateescape')
+
+
+def repo_manifest(folder, createrepo_cmd=None):
+    ''' Return a tuple (number of RPMs, digest) describing the content of
+    the specified folder as seen by createrepo: the name, size and mtime of
+    all its RPMs as well as the createrepo command used.
+
+    Only the file system metadata is read, so this is much cheaper than
+    running createrepo.
+    '''
+    digest = hashlib.sha1(_to_bytes(createrepo_cmd or 'createrepo'))
+    cnt = 0
+    for relpath in iter_repo_rpms(folder):
+        try:
+            stat = os.stat(os.path.join(folder, relpath))
+        except OSError:
+            continue
+        digest.update(_to_bytes('%s\0%d\0%d\n' % (
+            relpath, stat.st_size, int(stat.st_mtime * 1000000))))
+        cnt += 1
+    return (cnt, digest.hexdigest())
+
+
+def read_manifest(folder):
+    ''' Return the digest recorded at the last successful run of
+    createrepo in the specified folder, if any.
+    '''
+    path = os.path.join(folder, STATE_DIR, MANIFEST)
+    if not os.path.exists(os.path.join(folder, 'repodata', 'repomd.xml')) \
+            or not os.path.exists(path):
+        return None
+    stream = open(path)
+    try:
+        return stream.read().strip()
+    finally:
+        stream.close()
+
+
+def write_state_file(folder, filename, content):
+    ''' Atomically write the given content to the specified file of the
+    state folder of the repo.
+    '''
+    state = os.path.join(folder, STATE_DIR)
+    if not os.path.isdir(state):
+        os.makedirs(state)
+    path = os.path.join(state, filename)
+    tmp = '%s.%s' % (path, os.getpid())
+    stream = open(tmp, 'w')
+    try:
+        stream.write(content)
+    finally:
+        stream.close()
+    os.rename(tmp, path)
+
+
+def write_manifest(folder, digest):
+    ''' Atomically record the digest of the content of the folder. '''
+    write_state_file(folder, MANIFEST, digest + '\n')
+
+
+def exchange_paths(path1, path2):
+    ''' Atomically exchange the two given paths, using renameat2 with
+    RENAME_EXCHANGE. Returns False, leaving them untouched, if the system
+    or the file system does not support it.
+    '''
+    if not sys.platform.startswith('linux'):
+        return False
+    # Imported here, it is only needed to swap the repodata
+    import ctypes
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (AttributeError, OSError):
+        # glibc older than 2.28
+        return False
+    if renameat2(AT_FDCWD, _to_bytes(path1), AT_FDCWD, _to_bytes(path2),
+                 RENAME_EXCHANGE) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EINVAL, errno.ENOSYS):
+        # Kernel older than 3.15 or file system not supporting it
+        return False
+    raise OSError(err, os.strerror(err), path1)
+
+
+def swap_repodata(folder, repodata):
+    ''' Replace the repodata of the specified folder by the given folder,
+    which must be on the same file system.
 
+    The new repodata and the current one are exchanged atomically (see
+    exchange_paths) so that clients always find a repodata, the old or the
+    new one but never a partially written one. Where this is not
+    supported, the current repodata is moved away right before the new one
+    is moved in place, leaving a short window without repodata.
+    '''
+    current = os.path.join(folder, 'repodata')
+    if os.path.isdir(current) and not os.path.islink(current) \
+            and exchange_paths(repodata, current):
+        # The old repodata is now where the new one was
+        shutil.rmtree(repodata)
+        return
+
+    old = os.path.join(folder, '.repodata.old.%s' % os.getpid())
+    if os.path.exists(current):
+        os.rename(current, old)
+    os.rename(repodata, current)
+    if os.path.exists(old):
+        shutil.rmtree(old)
 
-def run_createrepo(folder, createrepo_cmd=None):
+
+def run_createrepo(folder, createrepo_cmd=None, force=False, update=False,
+                   quiet=False):
     ''' Run the ``createrepo`` command in the specified folder.
+
+    createrepo is skipped, unless ``force`` is True, if the RPMs of the
+    folder did not change since its last successful run. With ``update``,
+    createrepo reuses the metadata of the RPMs whose size and mtime did not
+    change instead of reading them all again. Returns whether createrepo
+    was run.
+
+    With ``quiet``, nothing is printed on stdout: the errors and the output
+    of createrepo go to stderr.
     '''
      # Check destination
+    stream = sys.stderr if quiet else sys.stdout
     if not os.path.exists(folder):
-        print 'Folder "%s" does not exist' % folder
+        print('Folder "%s" does not exist' % folder, file=stream)
         return
     elif not os.path.isdir(folder):
-        print '"%s" is not a folder' % folder
+        print('"%s" is not a folder' % folder, file=stream)
         return
 
     LOG.debug('run_createrepo')
-    cur_wd = os.getcwd()
-    os.chdir(folder)
     createrepo_cmd = createrepo_cmd or 'createrepo'
-    LOG.info('Run %s on %s', createrepo_cmd, os.getcwd())
+    start = time.time()
+    cnt, digest = repo_manifest(folder, createrepo_cmd)
+    duration = time.time() - start
+    if not force and read_manifest(folder) == digest:
+        LOG.info('Content of %s unchanged, not running %s',
+                 folder, createrepo_cmd)
+        if not quiet:
+            print('  repodata up to date, createrepo skipped '\
+                '(%s RPMs checked in %.3fs)' % (cnt, duration))
+        return False
+
+    LOG.info('Run %s on %s', createrepo_cmd, folder)
     cmd = [createrepo_cmd, '.']
+    if update and os.path.exists(
+            os.path.join(folder, 'repodata', 'repomd.xml')):
+        cmd.insert(1, '--update')
     LOG.debug('  Calling  : `%s` from %s', cmd, folder)
-    subprocess.call(' '.join(cmd), shell=True)
-    os.chdir(cur_wd)
+    import subprocess
+    # Not changing the working directory of the process, which is shared
+    # by all its threads. If quiet, the output goes to the file descriptor
+    # of stderr, sys.stderr may not have one
+    return_code = subprocess.call(
+        ' '.join(cmd), shell=True, cwd=folder, stdout=2 if quiet else None)
+    if return_code:
+        LOG.warning('%s failed on %s', createrepo_cmd, folder)
+        print('  %s failed (exit code %s)' % (createrepo_cmd, return_code),
+              file=stream)
+    else:
+        # Not recorded if the content changed while createrepo ran, the
+        # repodata may miss the changes
+        if repo_manifest(folder, createrepo_cmd)[1] == digest:
+            write_manifest(folder, digest)
+        else:
+            LOG.info('Content of %s changed while %s ran', folder,
+                     createrepo_cmd)
+        if not quiet:
+            print('  repodata regenerated (%s RPMs)' % cnt)
+    return True
+
+
+def undo_trash(folder, no_createrepo=False, createrepo_cmd=None,
+               force_createrepo=False):
+    ''' Restore in the specified folder the files moved to the trash by the
+    last clean or delete.
+    '''
+    LOG.debug('undo_trash')
+    folder = os.path.expanduser(folder)
+
+    trash = os.path.join(folder, TRASH_DIR)
+    batches = []
+    if os.path.isdir(trash):
+        batches = sorted(os.listdir(trash))
+    if not batches:
+        print('Nothing to restore in %s' % folder)
+        return
+
+    batch = os.path.join(trash, batches[-1])
+    LOG.info('Restoring files from %s', batch)
+    cnt = 0
+    for filename in sorted(os.listdir(batch)):
+        if not filename.endswith(TRASH_SUFFIX):
+            continue
+        dest = os.path.join(folder, filename[:-len(TRASH_SUFFIX)])
+        if os.path.exists(dest):
+            print('File "%s" already exists, not restoring it' % dest)
+            continue
+        os.rename(os.path.join(batch, filename), dest)
+        record_action('restore', folder, dest, nevra=get_rpm_nevra(dest))
+        cnt += 1
+
+    if not os.listdir(batch):
+        os.rmdir(batch)
+
+    print(folder)
+    print('  %s files restored' % cnt)
+
+    if cnt and not no_createrepo:
+        run_createrepo(
+            folder, createrepo_cmd=createrepo_cmd, force=force_createrepo)
+
+
+def purge_trash(folder, older_than=None):
+    ''' Actually remove the files moved to the trash of the specified
+    folder, only the ones moved there more than ``older_than`` days ago if
+    specified.
+    '''
+    LOG.debug('purge_trash')
+    folder = os.path.expanduser(folder)
+
+    trash = os.path.join(folder, TRASH_DIR)
+    if not os.path.isdir(trash):
+        return
+
+    limit = None
+    if older_than is not None:
+        limit = time.time() - float(older_than) * 24 * 3600
+
+    cnt = 0
+    for batch in sorted(os.listdir(trash)):
+        try:
+            stamp = float(batch.split('-', 1)[0])
+        except ValueError:
+            continue
+        if limit is not None and stamp > limit:
+            continue
+        path = os.path.join(trash, batch)
+        cnt += len(os.listdir(path))
+        LOG.info('Purging %s', path)
+        shutil.rmtree(path)
+
+    print(folder)
+    print('  %s files purged from the trash' % cnt)
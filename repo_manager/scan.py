@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+I/O-scheduled reading of the headers of the RPMs of a folder.
+
+On NFS or on spinning disks, opening the RPMs in ``os.listdir`` order and
+letting librpm read them is dominated by seeks and round-trips. Here the
+files are read in inode order, which on most file systems follows their
+order on disk, the kernel is asked to read ahead the beginning of the
+files only (where the headers are) and only the lead, signature and header
+bytes are read, using pread, while up to ``in_flight`` files are being
+read at the same time. librpm then loads the headers from memory.
+
+Python 2 lacks os.pread and os.posix_fadvise, they are then called from
+the C library using ctypes.
+"""
+
+import collections
+import logging
+import os
+import struct
+
+
+LOG = logging.getLogger('repo_manager')
+
+# Number of files read at the same time by default
+IN_FLIGHT = 8
+
+RPM_MAGIC = b'\xed\xab\xee\xdb'
+HEADER_MAGIC = b'\x8e\xad\xe8\x01'
+# Size of the lead, followed by the signature header and the header
+LEAD_SIZE = 96
+# Size of the header structures before their index: magic, reserved bytes,
+# number of index entries and size of the data
+INTRO_SIZE = 16
+INDEX_ENTRY_SIZE = 16
+
+# First read done, and read ahead, for each file: it holds the headers of
+# most RPMs, the bytes missing are read afterwards for the others
+READ_SIZE = 64 * 1024
+
+# Values of the advices of posix_fadvise on Linux, for Python 2
+POSIX_FADV_RANDOM = getattr(os, 'POSIX_FADV_RANDOM', 1)
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+
+# C library, loaded on Python 2 by _libc
+_LIBC = []
+
+
+def _libc():
+    ''' Return the C library, with pread64 and posix_fadvise64 set up to
+    be called through ctypes, or None if they are not available.
+    '''
+    if not _LIBC:
+        # Imported here, it is only needed on Python 2
+        import ctypes
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            libc.pread64.restype = ctypes.c_ssize_t
+            libc.pread64.argtypes = [
+                ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t,
+                ctypes.c_longlong]
+            libc.posix_fadvise64.argtypes = [
+                ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong,
+                ctypes.c_int]
+        except (AttributeError, OSError):
+            LOG.warning('pread and posix_fadvise are not available, the '
+                        'headers are read without readahead hints')
+            libc = None
+        _LIBC.append(libc)
+    return _LIBC[0]
+
+
+def _libc_pread(fd, size, offset):
+    ''' os.pread, for Python 2. '''
+    libc = _libc()
+    if libc is None:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+    import ctypes
+    buf = ctypes.create_string_buffer(size)
+    cnt = libc.pread64(fd, buf, size, offset)
+    if cnt < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return buf.raw[:cnt]
+
+
+def _pread(fd, size, offset):
+    ''' Read size bytes of the file at the given offset, fewer at the end
+    of the file.
+    '''
+    pread = getattr(os, 'pread', _libc_pread)
+    data = b''
+    while len(data) < size:
+        chunk = pread(fd, size - len(data), offset + len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def _advise(fd, size):
+    ''' Ask the kernel to read ahead the first size bytes of the file and
+    nothing more.
+    '''
+    if not hasattr(os, 'posix_fadvise'):  # Python 2
+        libc = _libc()
+        if libc is None:
+            return
+        # Returns the error number instead of setting errno
+        for offset, length, advice in [
+                (0, 0, POSIX_FADV_RANDOM), (0, size, POSIX_FADV_WILLNEED)]:
+            err = libc.posix_fadvise64(fd, offset, length, advice)
+            if err:
+                LOG.debug('posix_fadvise failed: %s', os.strerror(err))
+                return
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        os.posix_fadvise(fd, 0, size, os.POSIX_FADV_WILLNEED)
+    except OSError as err:
+        LOG.debug('posix_fadvise failed: %s', err)
+
+
+def _extend(fd, data, size):
+    ''' Return data, the beginning of the file, extended to size bytes. '''
+    if len(data) < size:
+        data += _pread(fd, size - len(data), len(data))
+        if len(data) < size:
+            raise ValueError('truncated file')
+    return data
+
+
+def _header_end(data, offset):
+    ''' Return the offset of the end of the header structure starting at
+    the given offset.
+    '''
+    if data[offset:offset + len(HEADER_MAGIC)] != HEADER_MAGIC:
+        raise ValueError('no header found at offset %s' % offset)
+    nindex, hsize = struct.unpack('>II', data[offset + 8:offset + 16])
+    return offset + INTRO_SIZE + nindex * INDEX_ENTRY_SIZE + hsize
+
+
+def read_header_blob(fd):
+    ''' Return the header of the RPM opened as fd, without its magic, as
+    expected by ``rpm.hdr``, None if it is not a RPM.
+
+    Only the lead, the signature header and the header are read.
+    '''
+    data = _pread(fd, READ_SIZE, 0)
+    if data[:len(RPM_MAGIC)] != RPM_MAGIC:
+        return None
+    data = _extend(fd, data, LEAD_SIZE + INTRO_SIZE)
+    end = _header_end(data, LEAD_SIZE)
+    # The signature header is padded to a multiple of 8 bytes
+    start = end + (-end % 8)
+    data = _extend(fd, data, start + INTRO_SIZE)
+    end = _header_end(data, start)
+    data = _extend(fd, data, end)
+    return data[start + 8:end]
+
+
+def _sorted_by_inode(folder, filenames):
+    ''' Return the given files of the folder sorted by inode number. '''
+    if filenames is None and hasattr(os, 'scandir'):
+        # The inode numbers come with the directory entries
+        return [
+            entry.name for entry in sorted(
+                os.scandir(folder), key=lambda entry: entry.inode())
+            if entry.name.endswith('.rpm')]
+
+    if filenames is None:
+        filenames = [
+            filename for filename in os.listdir(folder)
+            if filename.endswith('.rpm')]
+    inodes = []
+    for filename in filenames:
+        try:
+            inodes.append(
+                (os.lstat(os.path.join(folder, filename)).st_ino, filename))
+        except OSError:
+            continue
+    return [filename for _, filename in sorted(inodes)]
+
+
+def iter_headers(folder, load_header, filenames=None, in_flight=IN_FLIGHT):
+    ''' Yield a tuple (file name, headers) for the RPMs of the folder, all
+    the ``.rpm`` files or the ones specified, in inode order, the headers
+    being None for the files that are not valid RPMs.
+
+    ``load_header`` is the function returning the headers from the header
+    blob, ie: ``rpm.hdr``. Up to ``in_flight`` files are read at the same
+    time.
+    '''
+    # Imported here, multiprocessing being slow to import
+    from multiprocessing.pool import ThreadPool
+
+    in_flight = max(int(in_flight), 1)
+
+    def _read(filename, fd):
+        ''' Read the headers of one file, run in the threads of the pool. '''
+        try:
+            blob = read_header_blob(fd)
+            if blob is None:
+                return (filename, None)
+            return (filename, load_header(blob))
+        except Exception as err:  # pylint: disable=W0703
+            LOG.warning('Cannot read the headers of %s: %s', filename, err)
+            return (filename, None)
+        finally:
+            os.close(fd)
+
+    pool = ThreadPool(in_flight)
+    pending = collections.deque()
+    try:
+        for filename in _sorted_by_inode(folder, filenames):
+            if len(pending) >= in_flight:
+                yield pending.popleft().get()
+            try:
+                fd = os.open(os.path.join(folder, filename), os.O_RDONLY)
+            except OSError as err:
+                LOG.warning('Cannot open %s: %s', filename, err)
+                continue
+            # The read ahead is started now, while the files before it are
+            # being read
+            _advise(fd, READ_SIZE)
+            pending.append(pool.apply_async(_read, (filename, fd)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        # Let the reads started complete, they close their file
+        pool.close()
+        pool.join()
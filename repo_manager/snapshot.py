@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Point-in-time snapshots of repositories.
+
+A snapshot of ``<folder>`` is a folder in ``<folder>.snapshots`` containing
+hardlinks to the RPMs and the repodata of the repository, making it cheap
+to take (no data is copied) and to restore. The snapshots are kept next to
+the repository rather than in it so that createrepo does not see their
+RPMs, while being, usually, on the same file system.
+"""
+
+from __future__ import absolute_import, print_function
+
+import errno
+import logging
+import os
+import shutil
+import time
+
+from . import repo_manager
+
+
+LOG = logging.getLogger('repo_manager')
+
+SNAPSHOTS_SUFFIX = '.snapshots'
+
+
+def get_snapshots_folder(folder):
+    ''' Return the folder in which the snapshots of the specified repo are
+    kept.
+    '''
+    return os.path.normpath(folder) + SNAPSHOTS_SUFFIX
+
+
+def list_snapshots(folder):
+    ''' Return the names of the snapshots of the specified repo, oldest
+    first.
+    '''
+    snapshots = get_snapshots_folder(folder)
+    if not os.path.isdir(snapshots):
+        return []
+    return sorted(
+        name for name in os.listdir(snapshots) if not name.startswith('.'))
+
+
+def find_snapshot(folder, name=None):
+    ''' Return the name of the snapshot of the specified repo with the
+    given name or label, the most recent one if no name is specified.
+    '''
+    names = list_snapshots(folder)
+    if name:
+        names = [
+            snapshot for snapshot in names
+            if snapshot == name or snapshot.endswith('-' + name)]
+    if names:
+        return names[-1]
+
+
+def _link(source, dest):
+    ''' Hardlink the source file to dest, copying it if they are on
+    different file systems.
+    '''
+    parent = os.path.dirname(dest)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    try:
+        os.link(source, dest)
+    except OSError as err:
+        if err.errno != errno.EXDEV:
+            raise
+        LOG.warning('%s is on another filesystem, copying it', source)
+        shutil.copy2(source, dest)
+
+
+def _link_tree(source, dest):
+    ''' Hardlink all the files of the source folder into dest. '''
+    for root, _, files in os.walk(source):
+        for filename in files:
+            path = os.path.join(root, filename)
+            _link(path, os.path.join(dest, os.path.relpath(path, source)))
+
+
+def snapshot_repo(folder, label=None, keep=None):
+    ''' Take a snapshot of the RPMs and the repodata of the specified repo
+    and return its name. If ``keep`` is specified, only the ``keep`` most
+    recent snapshots are kept.
+    '''
+    LOG.debug('snapshot_repo')
+    folder = os.path.expanduser(folder)
+
+    if not os.path.isdir(folder):
+        print('%s not found' % folder)
+        return
+
+    now = time.time()
+    name = '%s.%06d' % (
+        time.strftime('%Y%m%d-%H%M%S', time.localtime(now)),
+        int(now % 1 * 1000000))
+    if label:
+        name = '%s-%s' % (name, label.replace('/', '_'))
+    snapshots = get_snapshots_folder(folder)
+    dest = os.path.join(snapshots, name)
+    # Build the snapshot aside so that it only shows up once complete
+    tmp = os.path.join(snapshots, '.%s.tmp' % name)
+    os.makedirs(tmp)
+
+    cnt = 0
+    for relpath in repo_manager.iter_repo_rpms(folder):
+        _link(os.path.join(folder, relpath), os.path.join(tmp, relpath))
+        cnt += 1
+    repodata = os.path.join(folder, 'repodata')
+    if os.path.isdir(repodata):
+        _link_tree(repodata, os.path.join(tmp, 'repodata'))
+    manifest = os.path.join(
+        folder, repo_manager.STATE_DIR, repo_manager.MANIFEST)
+    if os.path.exists(manifest):
+        shutil.copy2(manifest, os.path.join(tmp, repo_manager.MANIFEST))
+    os.rename(tmp, dest)
+
+    repo_manager.record_action('snapshot', folder, name)
+    LOG.info('Snapshot %s of %s taken', name, folder)
+    print(folder)
+    print('  snapshot %s taken (%s RPMs)' % (name, cnt))
+
+    if keep is not None:
+        prune_snapshots(folder, keep)
+    return name
+
+
+def prune_snapshots(folder, keep):
+    ''' Remove the snapshots of the specified repo but the ``keep`` most
+    recent ones.
+    '''
+    LOG.debug('prune_snapshots')
+    folder = os.path.expanduser(folder)
+    names = list_snapshots(folder)
+    if int(keep) > 0:
+        names = names[:-int(keep)]
+    for name in names:
+        shutil.rmtree(os.path.join(get_snapshots_folder(folder), name))
+        repo_manager.record_action('prune', folder, name)
+        print('  snapshot %s removed' % name)
+
+
+def rollback_repo(folder, name=None, trash=False):
+    ''' Restore the RPMs and the repodata of the specified repo from the
+    snapshot with the given name or label, the most recent one if no name
+    is specified.
+
+    The RPMs of the snapshot missing in the repo are put back first, then
+    the repodata is swapped and only then are the RPMs not in the snapshot
+    removed, so that the repodata never lists a file that is not there.
+    Returns the name of the snapshot restored.
+    '''
+    LOG.debug('rollback_repo')
+    folder = os.path.expanduser(folder)
+
+    snapshot = find_snapshot(folder, name)
+    if not snapshot:
+        print('No snapshot %sfound for %s' % (
+            '"%s" ' % name if name else '', folder))
+        return
+    path = os.path.join(get_snapshots_folder(folder), snapshot)
+    message = 'rollback to %s' % snapshot
+    LOG.info('Rolling back %s to %s', folder, snapshot)
+
+    wanted = set(repo_manager.iter_repo_rpms(path))
+    restored = 0
+    for relpath in sorted(wanted):
+        dest = os.path.join(folder, relpath)
+        source = os.path.join(path, relpath)
+        if os.path.exists(dest) and os.path.samefile(source, dest):
+            continue
+        # Replace any different file of the same name in one rename
+        tmp = os.path.join(
+            os.path.dirname(dest), '.%s.%s' % (
+                os.path.basename(dest), os.getpid()))
+        _link(source, tmp)
+        os.rename(tmp, dest)
+        repo_manager.record_action(
+            'restore', folder, dest, nevra=repo_manager.get_rpm_nevra(dest),
+            message=message)
+        restored += 1
+
+    repodata = os.path.join(path, 'repodata')
+    if os.path.isdir(repodata):
+        staging = os.path.join(folder, '.repodata.%s' % os.getpid())
+        _link_tree(repodata, staging)
+        repo_manager.swap_repodata(folder, staging)
+    manifest = os.path.join(path, repo_manager.MANIFEST)
+    if os.path.exists(manifest):
+        stream = open(manifest)
+        try:
+            repo_manager.write_manifest(folder, stream.read().strip())
+        finally:
+            stream.close()
+
+    trash_batch = None
+    if trash:
+        trash_batch = repo_manager.new_trash_batch(folder, 'rollback')
+    removed = 0
+    for relpath in sorted(
+            set(repo_manager.iter_repo_rpms(folder)) - wanted):
+        filename = os.path.join(folder, relpath)
+        repo_manager.record_action(
+            'delete', folder, filename,
+            nevra=repo_manager.get_rpm_nevra(filename), message=message)
+        repo_manager.remove_rpm_file(filename, trash_batch)
+        removed += 1
+
+    print(folder)
+    print('  rolled back to %s' % snapshot)
+    print('  %s RPMs restored' % restored)
+    print('  %s RPMs removed' % removed)
+    return snapshot
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+
+"""
+# repo_manager - a python module to interact with RPMs repository
+#
+# Copyright (C) 2014 Red Hat Inc
+# Author: Pierre-Yves Chibon <pingou@pingoured.fr>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or (at
+# your option) any later version.
+# See http://www.gnu.org/copyleft/gpl.html  for the full text of the
+# license.
+
+Integrity verification of the RPMs of a repository.
+
+Each RPM is checked against the checksum and size recorded for it in the
+repodata and its header and payload digests (and optionally signatures)
+are checked by ``rpm -K``. The files are verified in parallel and the
+files found valid are recorded, with their size and mtime, in a checkpoint
+file so that an interrupted run resumes where it stopped and the files
+that did not change are not verified again.
+"""
+
+from __future__ import absolute_import
+
+import bz2
+import gzip
+import json
+import logging
+import os
+import subprocess
+import time
+try:
+    import xml.etree.cElementTree as etree
+except ImportError:  # Python 3.9+
+    import xml.etree.ElementTree as etree
+
+from . import repo_manager
+
+
+LOG = logging.getLogger('repo_manager')
+
+REPO_NS = '{http://linux.duke.edu/metadata/repo}'
+COMMON_NS = '{http://linux.duke.edu/metadata/common}'
+
+# Name of the checkpoint file in the state folder of the repo
+CHECKPOINT = 'verify.json'
+# Save the checkpoint every CHECKPOINT_EVERY files verified
+CHECKPOINT_EVERY = 100
+
+
+def _open_metadata(path):
+    ''' Open the given, possibly compressed, metadata file. '''
+    if path.endswith('.gz'):
+        return gzip.open(path)
+    elif path.endswith('.bz2'):
+        return bz2.BZ2File(path)
+    return open(path)
+
+
+def read_repodata(folder):
+    ''' Return a dictionary associating the name of each file listed in
+    the primary metadata of the repo to a tuple (checksum type, checksum,
+    size), None if the repo has no (readable) repodata.
+
+    Raises ValueError if the repodata is corrupt.
+    '''
+    repomd = os.path.join(folder, 'repodata', 'repomd.xml')
+    if not os.path.exists(repomd):
+        return None
+
+    try:
+        return _read_primary(folder, repomd)
+    except (etree.ParseError, EnvironmentError, EOFError, AttributeError,
+            TypeError, ValueError) as err:
+        raise ValueError('corrupt repodata: %s' % err)
+
+
+def _read_primary(folder, repomd):
+    ''' Read the primary metadata of the repo, see read_repodata. '''
+    primary = None
+    for data in etree.parse(repomd).getroot().findall(REPO_NS + 'data'):
+        if data.get('type') == 'primary':
+            primary = data.find(REPO_NS + 'location').get('href')
+    if not primary:
+        return None
+    primary = os.path.join(folder, primary)
+    if primary.endswith('.xz'):
+        LOG.warning('Cannot read %s, xz is not supported', primary)
+        return None
+
+    packages = {}
+    stream = _open_metadata(primary)
+    try:
+        for _, elem in etree.iterparse(stream):
+            if elem.tag != COMMON_NS + 'package':
+                continue
+            checksum = elem.find(COMMON_NS + 'checksum')
+            href = elem.find(COMMON_NS + 'location').get('href')
+            size = elem.find(COMMON_NS + 'size').get('package')
+            packages[os.path.basename(href)] = (
+                checksum.get('type'), checksum.text, int(size))
+            elem.clear()
+    finally:
+        stream.close()
+    return packages
+
+
+def verify_rpm(path, expected=None, signatures=False, rpm_cmd='rpm'):
+    ''' Verify the specified RPM and return the list of problems found,
+    empty if the RPM is valid.
+
+    ``expected`` is the (checksum type, checksum, size) tuple recorded in
+    the repodata. The header and payload digests are checked using
+    ``rpm -K``, the signatures as well if ``signatures`` is True.
+    '''
+    errors = []
+    if expected:
+        checksum_type, checksum, size = expected
+        if os.path.getsize(path) != size:
+            errors.append('size differs from the repodata')
+        elif repo_manager.file_checksum(path, checksum_type) != checksum:
+            errors.append('%s checksum differs from the repodata'
+                          % checksum_type)
+
+    cmd = [rpm_cmd, '-K']
+    if not signatures:
+        cmd.append('--nosignature')
+    cmd.append(path)
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True)
+    output = proc.communicate()[0].strip()
+    if proc.returncode:
+        errors.append(output.replace(path + ':', '').strip()
+                      or '%s failed' % ' '.join(cmd))
+    return errors
+
+
+def _load_checkpoint(path):
+    ''' Return the content of the checkpoint file, if there is one. '''
+    if not os.path.exists(path):
+        return {}
+    stream = open(path)
+    try:
+        return json.load(stream)
+    except ValueError:
+        LOG.warning('Ignoring invalid checkpoint file %s', path)
+        return {}
+    finally:
+        stream.close()
+
+
+def _save_checkpoint(path, verified):
+    ''' Atomically write the checkpoint file. '''
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    tmp = '%s.%s' % (path, os.getpid())
+    stream = open(tmp, 'w')
+    try:
+        json.dump(verified, stream)
+    finally:
+        stream.close()
+    os.rename(tmp, path)
+
+
+def verify_repo(folder, workers=4, signatures=False, full=False,
+                rpm_cmd='rpm'):
+    ''' Verify all the RPMs of the specified folder using ``workers``
+    threads and return a dictionary with the statistics of the run and the
+    list of failures, each failure being a dictionary with the ``file`` and
+    the ``errors`` found.
+
+    The RPMs already verified (with the same size and mtime) are skipped
+    unless ``full`` is True.
+    '''
+    LOG.debug('verify_repo')
+    folder = os.path.expanduser(folder)
+
+    checkpoint = os.path.join(folder, repo_manager.STATE_DIR, CHECKPOINT)
+    verified = {}
+    if not full:
+        verified = _load_checkpoint(checkpoint)
+
+    corrupt = None
+    try:
+        repodata = read_repodata(folder)
+    except ValueError as err:
+        corrupt = str(err)
+        repodata = None
+    if corrupt:
+        LOG.warning('Cannot read the repodata of %s (%s), only checking '
+                    'the RPMs', folder, corrupt)
+    elif repodata is None:
+        LOG.warning('No repodata found in %s, only checking the RPMs',
+                    folder)
+
+    stats = {
+        'folder': folder, 'verified': 0, 'skipped': 0, 'bytes': 0,
+        'duration': 0, 'failures': []}
+    if corrupt:
+        stats['failures'].append({'file': 'repodata', 'errors': [corrupt]})
+    todo = []
+    seen = set()
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith('.rpm'):
+            continue
+        seen.add(filename)
+        stat = os.stat(os.path.join(folder, filename))
+        if verified.get(filename) == [stat.st_size, int(stat.st_mtime)]:
+            stats['skipped'] += 1
+            continue
+        verified.pop(filename, None)
+        todo.append((filename, stat.st_size, int(stat.st_mtime)))
+
+    if repodata:
+        for filename in sorted(set(repodata) - seen):
+            stats['failures'].append({
+                'file': filename,
+                'errors': ['listed in the repodata but missing'],
+            })
+
+    def _verify(item):
+        ''' Verify one file, run in the threads of the pool. '''
+        filename = item[0]
+        path = os.path.join(folder, filename)
+        if repodata is not None and filename not in repodata:
+            return (item, ['not listed in the repodata'])
+        try:
+            expected = None
+            if repodata:
+                expected = repodata[filename]
+            return (item, verify_rpm(
+                path, expected, signatures=signatures, rpm_cmd=rpm_cmd))
+        except (IOError, OSError) as err:
+            return (item, [str(err)])
+
+    # Imported here, multiprocessing being slow to import
+    from multiprocessing.pool import ThreadPool
+
+    start = time.time()
+    pool = ThreadPool(workers)
+    try:
+        for cnt, (item, errors) in enumerate(
+                pool.imap_unordered(_verify, todo)):
+            filename, size, mtime = item
+            stats['verified'] += 1
+            stats['bytes'] += size
+            if errors:
+                stats['failures'].append({'file': filename, 'errors': errors})
+            else:
+                verified[filename] = [size, mtime]
+            if cnt % CHECKPOINT_EVERY == CHECKPOINT_EVERY - 1:
+                _save_checkpoint(checkpoint, verified)
+    finally:
+        pool.terminate()
+        stats['duration'] = time.time() - start
+        # Forget the files that are no longer in the repo
+        for filename in set(verified) - seen:
+            del verified[filename]
+        _save_checkpoint(checkpoint, verified)
+
+    return stats
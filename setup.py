@@ -3,9 +3,28 @@
 Setup script
 """
 
+import sys
+
 from setuptools import setup
+from setuptools.command.build_py import build_py
 from repo_manager import __version__
 
+
+class BuildPy(build_py):
+    """ Leave out, on Python 2, the modules using the Python 3 syntax,
+    which could not be byte-compiled. """
+
+    python3_modules = [('repo_manager', 'aio')]
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info[0] < 3:
+            modules = [
+                (pkg, module, path) for pkg, module, path in modules
+                if (pkg, module) not in self.python3_modules]
+        return modules
+
+
 setup(
     name='repo_manager',
     description='A simple application to manage RPM repositories',
@@ -21,5 +40,6 @@ setup(
         repo_manager = repo_manager:main
     """,
     packages=['repo_manager'],
+    cmdclass={'build_py': BuildPy},
     test_suite="tests",
 )
@@ -18,15 +18,38 @@ Unit-tests
 """
 
 import unittest
+import gzip
+import json
+import random
 import shutil
+import tempfile
 import sys
 import os
 
+try:
+    import ConfigParser as configparser
+except ImportError:  # Python 3
+    import configparser
+try:
+    from StringIO import StringIO
+except ImportError:  # Python 3
+    from io import StringIO
+
+import rpm
+
 sys.path.insert(0, os.path.join(os.path.dirname(
     os.path.abspath(__file__)), '..'))
 
 import repo_manager
+import repo_manager.batch as batch
+import repo_manager.completion as completion
+import repo_manager.deps as deps
+import repo_manager.journal as journal
+import repo_manager.mirror as mirror
 import repo_manager.repo_manager as repomgr
+import repo_manager.scan as scan
+import repo_manager.snapshot as snapshot
+import repo_manager.verify as verify
 
 
 REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'repo')
@@ -36,6 +59,14 @@ TEST_REPO2 = os.path.join(
     os.path.dirname(os.path.abspath(__file__)), 'repo_test2')
 
 
+def _listdir(folder):
+    """ Return the content of the folder without the state folder and the
+    trash of repo_manager. """
+    return [
+        filename for filename in os.listdir(folder)
+        if filename not in (repomgr.STATE_DIR, repomgr.TRASH_DIR)]
+
+
 class RepoManagertests(unittest.TestCase):
     """ RepoManager tests. """
 
@@ -48,6 +79,8 @@ class RepoManagertests(unittest.TestCase):
     # pylint: disable=C0103
     def tearDown(self):
         """ Remove the test.db database if there is one. """
+        repomgr.JOURNAL = None
+        repomgr.SCHEDULED_SCAN.clear()
         if os.path.exists(TEST_REPO):
             shutil.rmtree(TEST_REPO)
         if os.path.exists(TEST_REPO2):
@@ -108,6 +141,154 @@ class RepoManagertests(unittest.TestCase):
             ]
         )
 
+        obs = repomgr.get_duplicated_rpms(TEST_REPO, external_sort=True)
+        self.assertEqual(sorted(obs.keys()), ['fedocal', 'pkgdb2'])
+        pkgdb2_versions = [el['version'] for el in obs['pkgdb2']]
+        self.assertEqual(len(pkgdb2_versions), 4)
+
+    def test_scheduled_scan(self):
+        """ Test reading the headers with the I/O-scheduled scan. """
+        # Not RPMs
+        open(os.path.join(TEST_REPO, 'fake.rpm'), 'w').close()
+        source = open(
+            os.path.join(TEST_REPO, 'fedocal-0.6.1-1.el6.src.rpm'), 'rb')
+        stream = open(os.path.join(TEST_REPO, 'truncated.rpm'), 'wb')
+        stream.write(source.read(200))
+        stream.close()
+        source.close()
+
+        headers = dict(scan.iter_headers(
+            TEST_REPO, rpm.hdr, in_flight=3))
+        self.assertEqual(len(headers), 10)
+        self.assertEqual(headers['fake.rpm'], None)
+        self.assertEqual(headers['truncated.rpm'], None)
+        for filename in os.listdir(REPO):
+            self.assertEqual(
+                headers[filename][rpm.RPMTAG_NAME],
+                repomgr.get_rpm_name(os.path.join(TEST_REPO, filename)))
+            self.assertEqual(
+                headers[filename][rpm.RPMTAG_VERSION],
+                repomgr.get_rpm_version(os.path.join(TEST_REPO, filename)))
+
+        self.assertEqual(
+            [filename for filename, _ in scan.iter_headers(
+                TEST_REPO, rpm.hdr, ['pkgdb2-0.5-1.el6.src.rpm'])],
+            ['pkgdb2-0.5-1.el6.src.rpm'])
+
+        # pread and posix_fadvise through ctypes, as used on Python 2
+        path = os.path.join(TEST_REPO, 'fedocal-0.6.1-1.el6.src.rpm')
+        stream = open(path, 'rb')
+        content = stream.read()
+        stream.close()
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.assertEqual(scan._libc_pread(fd, 100, 50), content[50:150])
+            self.assertEqual(
+                scan._libc_pread(fd, 100, len(content) - 10),
+                content[-10:])
+            if sys.platform.startswith('linux'):
+                libc = scan._libc()
+                self.assertEqual(libc.posix_fadvise64(
+                    fd, 0, 100, scan.POSIX_FADV_WILLNEED), 0)
+        finally:
+            os.close(fd)
+
+        # Selected per folder
+        repomgr.SCHEDULED_SCAN[TEST_REPO] = 2
+        self.assertEqual(
+            sorted(entry.nevra for entry in repomgr.iter_rpm_entries(
+                TEST_REPO)),
+            sorted(entry.nevra for entry in repomgr.iter_rpm_entries(
+                REPO)))
+        self.assertEqual(len(repomgr.get_package_index(TEST_REPO)), 8)
+
+    def test_evr_key(self):
+        """ Test the repo_manager.evr_key function against
+        rpm.labelCompare. """
+
+        self.assertTrue(
+            repomgr.evr_key(None, '0.10', '1.el6')
+            > repomgr.evr_key(None, '0.9', '1.el6'))
+        self.assertTrue(
+            repomgr.evr_key(None, '1.0~rc1', '1')
+            < repomgr.evr_key(None, '1.0', '1'))
+        self.assertTrue(
+            repomgr.evr_key('1', '0.1', '1')
+            > repomgr.evr_key(None, '2.0', '1'))
+
+        segments = [
+            '0', '1', '2', '10', '007', 'a', 'b', 'Z', 'rc', 'el6',
+            '.', '-', '_', '+', '']
+        # Older librpm do not know about ``~`` and ``^``
+        if rpm.labelCompare((None, '1~', '1'), (None, '1', '1')) == -1:
+            segments.append('~')
+        if rpm.labelCompare((None, '1^', '1'), (None, '1', '1')) == 1:
+            segments.append('^')
+        randgen = random.Random(42)
+
+        def _random_string():
+            return ''.join(
+                randgen.choice(segments)
+                for _ in range(randgen.randint(1, 6)))
+
+        for _ in range(20000):
+            evr1 = (
+                randgen.choice([None, '0', '1']),
+                _random_string(), _random_string())
+            evr2 = (
+                randgen.choice([None, '0', '1']),
+                _random_string(), _random_string())
+            key1 = repomgr.evr_key(*evr1)
+            key2 = repomgr.evr_key(*evr2)
+            self.assertEqual(
+                rpm.labelCompare(evr1, evr2),
+                (key1 > key2) - (key1 < key2),
+                '%s vs %s' % (evr1, evr2))
+
+    def test_group_rpm_entries(self):
+        """ Test the repo_manager.group_rpm_entries function. """
+
+        entries = []
+        for cnt in range(50):
+            name = 'pkg%s' % (cnt % 7)
+            entries.append(repomgr.RpmEntry(
+                name, None if cnt % 2 else 1, '0.%s' % cnt, '1.el6',
+                'noarch', TEST_REPO, '%s-0.%s-1.el6.noarch.rpm' % (name, cnt)))
+
+        exp = [
+            (name, [entry.filename for entry in group])
+            for name, group in repomgr.group_rpm_entries(entries)
+        ]
+        self.assertEqual(
+            [el[0] for el in exp], ['pkg%s' % cnt for cnt in range(7)])
+        self.assertEqual(sum([len(el[1]) for el in exp]), 50)
+
+        # Grouping on disk gives the same result
+        obs = [
+            (name, sorted([entry.filename for entry in group]))
+            for name, group in repomgr.group_rpm_entries(
+                entries, external_sort=True, chunk_size=8)
+        ]
+        self.assertEqual(obs, [(name, sorted(group)) for name, group in exp])
+
+        entry = repomgr.RpmEntry.from_line(entries[2].to_line())
+        self.assertEqual(entry['version'], '0.2-1.el6')
+        self.assertEqual(entry['evr'], entries[2]['evr'])
+        self.assertEqual(entry['filename'], entries[2]['filename'])
+
+    def test_split_duplicates(self):
+        """ Test the repo_manager.split_duplicates function. """
+
+        rpms = [
+            {'version': version, 'evr': repomgr.evr_key(None, version, '1')}
+            for version in ['0.9', '0.10', '0.8', '0.10', '0.11']
+        ]
+        to_keep, to_remove = repomgr.split_duplicates(rpms, keep='2')
+        self.assertEqual(
+            [el['version'] for el in to_keep], ['0.10', '0.10', '0.11'])
+        self.assertEqual(
+            [el['version'] for el in to_remove], ['0.8', '0.9'])
+
     def test_clean_repo(self):
         """ Test the repo_manager.clean_repo function. """
         # Before cleaning
@@ -121,13 +302,13 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.7-1.el6.src.rpm',
             'pkgdb2-0.8-1.el6.src.rpm',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
         # Dry run
         obs = repomgr.clean_repo(TEST_REPO, dry_run=True, srpm=True)
         # No changes
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
         # Clean RPMs
@@ -138,7 +319,7 @@ class RepoManagertests(unittest.TestCase):
         self.assertEqual(obs, None)
 
         # After cleaning
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(
             sorted(files),
             [
@@ -155,9 +336,465 @@ class RepoManagertests(unittest.TestCase):
         # Remove all the src.rpm when cleaning the repo
         obs = repomgr.clean_repo(TEST_REPO, srpm=True)
 
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), ['repodata'])
 
+    def test_clean_repo_orphan_srpm(self):
+        """ Test cleaning the SRPMs no RPM is built from. """
+        srpms = [
+            repomgr.RpmEntry(
+                'foo', None, ver, '1', 'src', TEST_REPO,
+                'foo-%s-1.src.rpm' % ver)
+            for ver in ('1.0', '1.1', '1.2', '1.3')
+        ] + [
+            repomgr.RpmEntry(
+                'bar', None, ver, '1', 'src', TEST_REPO,
+                'bar-%s-1.src.rpm' % ver)
+            for ver in ('1.0', '1.1')
+        ]
+        sources = {
+            'foo-1.0-1.x86_64.rpm': 'foo-1.0-1.src.rpm',
+            'foo-libs-1.0-1.x86_64.rpm': 'foo-1.0-1.src.rpm',
+            'foo-1.1-1.x86_64.rpm': 'foo-1.1-1.src.rpm',
+            'foo-1.3-1.x86_64.rpm': 'foo-1.3-1.src.rpm',
+        }
+        obs = repomgr.select_orphan_srpms(srpms, sources, keep=1)
+        self.assertEqual(
+            [entry.basename for entry in obs],
+            ['bar-1.0-1.src.rpm', 'foo-1.2-1.src.rpm'])
+        obs = repomgr.select_orphan_srpms(
+            srpms, sources, removed=set([
+                'foo-1.0-1.x86_64.rpm', 'foo-1.1-1.x86_64.rpm']), keep=3)
+        self.assertEqual(
+            [entry.basename for entry in obs],
+            ['foo-1.1-1.src.rpm', 'foo-1.2-1.src.rpm'])
+
+        # Without RPMs in the repo, keep applies to the SRPMs
+        repomgr.clean_repo(TEST_REPO, srpm='orphans', no_createrepo=True)
+        self.assertEqual(
+            sorted(_listdir(TEST_REPO)),
+            [
+                'fedocal-0.5.1-1.el6.src.rpm',
+                'fedocal-0.6.0-1.el6.src.rpm',
+                'fedocal-0.6.1-1.el6.src.rpm',
+                'pkgdb2-0.6-1.el6.src.rpm',
+                'pkgdb2-0.7-1.el6.src.rpm',
+                'pkgdb2-0.8-1.el6.src.rpm',
+            ]
+        )
+
+    def test_clean_repo_plan(self):
+        """ Test making a clean plan and applying it. """
+        plan = []
+        repomgr.clean_repo(TEST_REPO, dry_run=True, plan=plan)
+        self.assertEqual(len(_listdir(TEST_REPO)), 8)
+        self.assertEqual(
+            sorted(entry['file'] for entry in plan),
+            [
+                'fedocal-0.5.0-1.el6.src.rpm',
+                'pkgdb2-0.5-1.el6.src.rpm',
+            ]
+        )
+        self.assertEqual(plan[0]['folder'], TEST_REPO)
+
+        # The folders are recorded as absolute paths, plans with relative
+        # folders are refused
+        relplan = []
+        repomgr.clean_repo(
+            os.path.relpath(TEST_REPO), dry_run=True, plan=relplan)
+        self.assertEqual(relplan, plan)
+        relplan = [dict(entry) for entry in plan]
+        relplan[1]['folder'] = os.path.relpath(TEST_REPO)
+        self.assertEqual(
+            repomgr.apply_clean_plan(relplan, no_createrepo=True), 2)
+        self.assertEqual(len(_listdir(TEST_REPO)), 8)
+
+        # Files changed since the plan was made are not removed
+        changed = os.path.join(TEST_REPO, 'pkgdb2-0.5-1.el6.src.rpm')
+        os.utime(changed, (0, 0))
+        refused = repomgr.apply_clean_plan(plan, no_createrepo=True)
+        self.assertEqual(refused, 1)
+        files = _listdir(TEST_REPO)
+        self.assertEqual(len(files), 7)
+        self.assertFalse('fedocal-0.5.0-1.el6.src.rpm' in files)
+        self.assertTrue('pkgdb2-0.5-1.el6.src.rpm' in files)
+
+    def test_clean_repo_trash(self):
+        """ Test the repo_manager.clean_repo function using the trash
+        and restoring/purging it. """
+        repomgr.undo_trash(TEST_REPO, no_createrepo=True)
+
+        repomgr.clean_repo(TEST_REPO, trash=True, no_createrepo=True)
+        self.assertEqual(len(_listdir(TEST_REPO)), 6)
+        self.assertTrue('.trash' in os.listdir(TEST_REPO))
+        batches = os.listdir(os.path.join(TEST_REPO, '.trash'))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(
+            sorted(os.listdir(
+                os.path.join(TEST_REPO, '.trash', batches[0]))),
+            [
+                'fedocal-0.5.0-1.el6.src.rpm.trashed',
+                'pkgdb2-0.5-1.el6.src.rpm.trashed',
+            ]
+        )
+
+        # Restore the files removed
+        repomgr.undo_trash(TEST_REPO, no_createrepo=True)
+        files = _listdir(TEST_REPO)
+        self.assertEqual(len(files), 8)
+        self.assertTrue('fedocal-0.5.0-1.el6.src.rpm' in files)
+        self.assertEqual(os.listdir(os.path.join(TEST_REPO, '.trash')), [])
+
+        # Purge the trash
+        repomgr.delete_rpm(
+            'fedocal-0.5.0-1.el6.src.rpm', TEST_REPO, no_createrepo=True,
+            trash=True)
+        repomgr.purge_trash(TEST_REPO, older_than=1)
+        self.assertEqual(
+            len(os.listdir(os.path.join(TEST_REPO, '.trash'))), 1)
+        repomgr.purge_trash(TEST_REPO)
+        self.assertEqual(os.listdir(os.path.join(TEST_REPO, '.trash')), [])
+        self.assertFalse(
+            'fedocal-0.5.0-1.el6.src.rpm' in _listdir(TEST_REPO))
+
+    def test_snapshot_rollback(self):
+        """ Test taking snapshots of a repo and rolling back to them. """
+        snapshots = snapshot.get_snapshots_folder(TEST_REPO)
+        self.addCleanup(shutil.rmtree, snapshots, True)
+        self.assertEqual(snapshot.rollback_repo(TEST_REPO), None)
+
+        os.mkdir(os.path.join(TEST_REPO, 'repodata'))
+        repomd = os.path.join(TEST_REPO, 'repodata', 'repomd.xml')
+        open(repomd, 'w').close()
+        first = snapshot.snapshot_repo(TEST_REPO, label='first')
+        self.assertEqual(snapshot.list_snapshots(TEST_REPO), [first])
+        self.assertEqual(len(os.listdir(os.path.join(snapshots, first))), 9)
+        rpmfile = os.path.join(TEST_REPO, 'fedocal-0.5.0-1.el6.src.rpm')
+        self.assertEqual(os.stat(rpmfile).st_nlink, 2)
+
+        # Change the repo and roll back
+        repomgr.clean_repo(TEST_REPO, no_createrepo=True)
+        os.unlink(repomd)
+        open(repomd, 'w').close()
+        self.assertEqual(len(_listdir(TEST_REPO)), 7)
+        self.assertEqual(snapshot.rollback_repo(TEST_REPO, 'first'), first)
+        self.assertEqual(len(_listdir(TEST_REPO)), 9)
+        self.assertTrue(os.path.samefile(rpmfile, os.path.join(
+            snapshots, first, 'fedocal-0.5.0-1.el6.src.rpm')))
+        self.assertTrue(os.path.samefile(
+            repomd, os.path.join(snapshots, first, 'repodata', 'repomd.xml')))
+
+        # Retention
+        second = snapshot.snapshot_repo(TEST_REPO, label='second', keep=1)
+        self.assertEqual(snapshot.list_snapshots(TEST_REPO), [second])
+        self.assertEqual(snapshot.find_snapshot(TEST_REPO), second)
+        self.assertEqual(snapshot.find_snapshot(TEST_REPO, 'first'), None)
+
+    def test_swap_repodata(self):
+        """ Test replacing the repodata of a repo by another folder. """
+        current = os.path.join(TEST_REPO, 'repodata')
+        staging = os.path.join(TEST_REPO, '.repodata.new')
+
+        # No repodata yet
+        os.mkdir(staging)
+        open(os.path.join(staging, 'first.xml'), 'w').close()
+        repomgr.swap_repodata(TEST_REPO, staging)
+        self.assertEqual(os.listdir(current), ['first.xml'])
+        self.assertFalse(os.path.exists(staging))
+
+        # The repodata exists at any time while it is swapped
+        os.mkdir(staging)
+        open(os.path.join(staging, 'second.xml'), 'w').close()
+        rename = os.rename
+        found = []
+
+        def _rename(src, dst):
+            found.append(os.path.isdir(current))
+            rename(src, dst)
+
+        os.rename = _rename
+        try:
+            repomgr.swap_repodata(TEST_REPO, staging)
+        finally:
+            os.rename = rename
+        self.assertEqual(os.listdir(current), ['second.xml'])
+        self.assertFalse(os.path.exists(staging))
+        self.assertEqual(
+            sorted(_listdir(TEST_REPO)),
+            sorted(os.listdir(REPO) + ['repodata']))
+        if repomgr.exchange_paths(current, current):
+            self.assertEqual(found, [])
+        else:
+            self.assertEqual(found, [True, False])
+
+    def test_completion(self):
+        """ Test the generation of the completion script and the
+        completions. """
+        script = completion.generate(repo_manager.setup_parser())
+        self.assertTrue('complete -F _repo_manager' in script)
+        self.assertTrue('--check-deps) kind="words:skip warn" ;;' in script)
+        self.assertTrue('delete) kind="packages" ;;' in script)
+        self.assertTrue(
+            completion.generate(repo_manager.setup_parser(), 'zsh')
+            .startswith('#compdef'))
+
+        files = completion.get_completion_index(TEST_REPO)
+        self.assertEqual(files, sorted(os.listdir(REPO)))
+        self.assertTrue(os.path.exists(os.path.join(
+            TEST_REPO, repomgr.STATE_DIR, completion.COMPLETION_INDEX)))
+        os.unlink(os.path.join(TEST_REPO, 'pkgdb2-0.5-1.el6.src.rpm'))
+        self.assertEqual(len(completion.get_completion_index(TEST_REPO)), 7)
+
+        config = configparser.ConfigParser()
+        config.add_section('main')
+        config.set('main', 'default_repos', 'test')
+        config.add_section('test')
+        config.set('test', 'folder', TEST_REPO)
+        config.add_section('test2')
+        config.set('test2', 'folder', TEST_REPO2)
+        self.assertEqual(
+            completion.complete('repos', 't', [], config), ['test', 'test2'])
+        self.assertEqual(
+            completion.complete('packages', 'pkgdb2-0.', ['delete'], config),
+            [
+                'pkgdb2-0.6-1.el6.src.rpm',
+                'pkgdb2-0.7-1.el6.src.rpm',
+                'pkgdb2-0.8-1.el6.src.rpm',
+            ])
+        self.assertEqual(
+            len(completion.complete(
+                'packages', 'pkgdb2-0.', ['delete', '--repos', 'test2'],
+                config)),
+            4)
+        self.assertEqual(
+            completion.complete('names', '', ['delete'], config),
+            ['fedocal', 'pkgdb2'])
+
+    def test_import_light(self):
+        """ Test that importing repo_manager, as done for the completion,
+        --help or --version, does not load the heavy modules. """
+        import subprocess
+        script = (
+            "import sys; import repo_manager; "
+            "print(' '.join(sorted(sys.modules)))")
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        modules = output.decode('utf-8').split()
+        self.assertTrue('repo_manager' in modules)
+        for module in ['rpm', 'multiprocessing', 'xml.etree']:
+            self.assertFalse(module in modules)
+
+    def test_journal(self):
+        """ Test recording actions in the journal and querying it. """
+        path = os.path.join(TEST_REPO2, 'journal')
+        repomgr.JOURNAL = journal.Journal(path)
+
+        repomgr.delete_rpm(
+            'fedocal-0.5.0-1.el6.src.rpm', TEST_REPO, no_createrepo=True,
+            message='unit-tests')
+        repomgr.clean_repo(TEST_REPO, no_createrepo=True)
+        # Nothing written until flushed
+        self.assertFalse(os.path.exists(path))
+        repomgr.JOURNAL.flush()
+
+        entries = list(journal.Journal(path).history())
+        self.assertEqual(
+            [entry['action'] for entry in entries], ['delete', 'clean'])
+        self.assertEqual(
+            len(set([entry['batch'] for entry in entries])), 1)
+
+        entries = list(journal.Journal(path).history('fedocal'))
+        self.assertEqual(
+            [(entry['action'], entry['nevra'], entry['message'])
+             for entry in entries],
+            [('delete', 'fedocal-0.5.0-1.el6.src', 'unit-tests')])
+        self.assertEqual(
+            [entry['nevra'] for entry in
+             journal.Journal(path).history('pkgdb2')],
+            ['pkgdb2-0.5-1.el6.src'])
+        self.assertEqual(
+            list(journal.Journal(path).history(
+                'fedocal', since=entries[0]['timestamp'] + 3600)),
+            [])
+        self.assertEqual(
+            len(list(journal.Journal(path).history(
+                'pkgdb2', until=entries[0]['timestamp'] + 3600))),
+            1)
+
+        # The checksum of the files copied is recorded, the files removed
+        # are not read to compute it, the replace records the file of the
+        # repo
+        self.assertEqual(entries[0]['digest'], None)
+        rebuilt = os.path.join(TEST_REPO2, 'pkgdb2-0.8-1.el6.src.rpm')
+        stream = open(rebuilt, 'ab')
+        stream.write(b'rebuilt')
+        stream.close()
+        self.assertEqual(
+            repomgr.replace_rpm(rebuilt, TEST_REPO, no_createrepo=True),
+            repomgr.REPLACED)
+        repomgr.add_rpm(
+            os.path.join(REPO, 'fedocal-0.5.0-1.el6.src.rpm'), TEST_REPO,
+            no_createrepo=True)
+        repomgr.JOURNAL.flush()
+        entries = list(journal.Journal(path).history())[-2:]
+        self.assertEqual(
+            [(entry['action'], entry['file'], entry['digest'])
+             for entry in entries],
+            [('replace', 'pkgdb2-0.8-1.el6.src.rpm',
+              repomgr.file_checksum(rebuilt)),
+             ('add', 'fedocal-0.5.0-1.el6.src.rpm',
+              repomgr.file_checksum(
+                  os.path.join(TEST_REPO, 'fedocal-0.5.0-1.el6.src.rpm')))])
+
+        # The entries keep the time of the action, even when written after
+        # newer entries of another command
+        first = journal.Journal(path)
+        second = journal.Journal(path)
+        first.record('delete', TEST_REPO, 'a.rpm', name='pkgdb2')
+        first.entries[-1]['timestamp'] -= 3600
+        older = first.entries[-1]['timestamp']
+        second.record('delete', TEST_REPO, 'b.rpm', name='pkgdb2')
+        newer = second.entries[-1]['timestamp']
+        second.flush()
+        first.flush()
+        self.assertEqual(
+            [(entry['file'], entry['timestamp'])
+             for entry in journal.Journal(path).history()][-2:],
+            [('b.rpm', newer), ('a.rpm', older)])
+        self.assertEqual(
+            [entry['file'] for entry in journal.Journal(path).history(
+                'pkgdb2', since=older, until=older)],
+            ['a.rpm'])
+        self.assertEqual(
+            [entry['file'] for entry in journal.Journal(path).history(
+                'pkgdb2', since=newer)],
+            ['b.rpm'])
+
+    def test_dependency_index(self):
+        """ Test the deps.DependencyIndex class. """
+        index = deps.DependencyIndex(repomgr.vercmp_key)
+        equal = deps.RPMSENSE_EQUAL
+        greater_equal = deps.RPMSENSE_GREATER | deps.RPMSENSE_EQUAL
+        index.add_package(
+            'libfoo-1.0', [('libfoo', equal, '1.0-1'), ('libfoo.so.1', 0, '')],
+            [], ['/usr/lib64/libfoo.so.1'])
+        index.add_package(
+            'libfoo-2.0', [('libfoo', equal, '2.0-1'), ('libfoo.so.2', 0, '')],
+            [], ['/usr/lib64/libfoo.so.2'])
+        index.add_package(
+            'foo-tools', [('foo-tools', equal, '1.0-1')],
+            [('libfoo.so.1', 0, ''), ('/usr/bin/python', 0, '')],
+            ['/usr/bin/foo'])
+        index.add_package(
+            'bar', [('bar', equal, '1.0-1')],
+            [('libfoo', greater_equal, '1.5'), ('/usr/bin/foo', 0, ''),
+             ('rpmlib(PayloadIsXz)', deps.RPMSENSE_RPMLIB, '5.2-1')],
+            [])
+
+        self.assertEqual(
+            index.broken_by(['libfoo-1.0']),
+            {'libfoo-1.0': [('foo-tools', 'libfoo.so.1')]})
+        self.assertEqual(
+            index.broken_by(['libfoo-2.0']),
+            {'libfoo-2.0': [('bar', 'libfoo >= 1.5')]})
+        # Removed together
+        self.assertEqual(
+            index.broken_by(['libfoo-1.0', 'foo-tools', 'bar']), {})
+        self.assertEqual(
+            index.broken_by(['foo-tools']),
+            {'foo-tools': [('bar', '/usr/bin/foo')]})
+        self.assertEqual(index.broken_by(['bar', 'unknown']), {})
+
+        self.assertEqual(
+            repomgr.check_removals(
+                index, ['libfoo-1.0', 'bar'], check_deps='skip'),
+            ['bar'])
+        self.assertEqual(
+            repomgr.check_removals(
+                index, ['libfoo-1.0', 'bar'], check_deps='warn'),
+            ['libfoo-1.0', 'bar'])
+
+        # Source RPMs are not considered
+        repomgr.clean_repo(TEST_REPO, check_deps='skip', no_createrepo=True)
+        self.assertEqual(len(_listdir(TEST_REPO)), 6)
+
+    def test_verify_repo(self):
+        """ Test the verify.verify_repo function. """
+        os.mkdir(os.path.join(TEST_REPO, 'repodata'))
+        stream = open(
+            os.path.join(TEST_REPO, 'repodata', 'repomd.xml'), 'w')
+        stream.write(
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo">'
+            '<data type="primary">'
+            '<location href="repodata/primary.xml.gz"/></data></repomd>')
+        stream.close()
+        stream = gzip.open(
+            os.path.join(TEST_REPO, 'repodata', 'primary.xml.gz'), 'w')
+        stream.write(
+            b'<metadata xmlns="http://linux.duke.edu/metadata/common">')
+        for filename in sorted(_listdir(TEST_REPO)):
+            if not filename.endswith('.rpm'):
+                continue
+            path = os.path.join(TEST_REPO, filename)
+            stream.write((
+                '<package><checksum type="sha256">%s</checksum>'
+                '<location href="%s"/><size package="%s"/></package>' % (
+                    repomgr.file_checksum(path, 'sha256'), filename,
+                    os.path.getsize(path))).encode('utf-8'))
+        stream.write(b'</metadata>')
+        stream.close()
+
+        stats = verify.verify_repo(TEST_REPO)
+        self.assertEqual(stats['verified'], 8)
+        self.assertEqual(stats['skipped'], 0)
+        self.assertEqual(stats['failures'], [])
+
+        # Corrupt a file, only this one is verified again
+        stream = open(
+            os.path.join(TEST_REPO, 'fedocal-0.6.0-1.el6.src.rpm'), 'a')
+        stream.write('garbage')
+        stream.close()
+        os.unlink(os.path.join(TEST_REPO, 'pkgdb2-0.5-1.el6.src.rpm'))
+
+        stats = verify.verify_repo(TEST_REPO)
+        self.assertEqual(stats['verified'], 1)
+        self.assertEqual(stats['skipped'], 6)
+        self.assertEqual(
+            sorted([failure['file'] for failure in stats['failures']]),
+            ['fedocal-0.6.0-1.el6.src.rpm', 'pkgdb2-0.5-1.el6.src.rpm'])
+
+        stats = verify.verify_repo(TEST_REPO, full=True)
+        self.assertEqual(stats['verified'], 7)
+        self.assertEqual(len(stats['failures']), 2)
+
+        # Corrupt repodata is reported, the RPMs are still checked
+        primary = os.path.join(TEST_REPO, 'repodata', 'primary.xml.gz')
+        stream = open(primary, 'rb')
+        content = stream.read()
+        stream.close()
+        stream = open(primary, 'wb')
+        stream.write(content[:len(content) // 2])
+        stream.close()
+        stats = verify.verify_repo(TEST_REPO, full=True)
+        self.assertEqual(stats['verified'], 7)
+        self.assertEqual(stats['failures'][0]['file'], 'repodata')
+
+        repomd = os.path.join(TEST_REPO, 'repodata', 'repomd.xml')
+        stream = open(repomd)
+        content = stream.read()
+        stream.close()
+        stream = open(repomd, 'w')
+        stream.write(content[:len(content) // 2])
+        stream.close()
+        self.assertRaises(ValueError, verify.read_repodata, TEST_REPO)
+        stats = verify.verify_repo(TEST_REPO, full=True)
+        self.assertEqual(stats['verified'], 7)
+        self.assertEqual(
+            [(failure['file'], failure['errors'][0].split(':')[0])
+             for failure in stats['failures']],
+            [('repodata', 'corrupt repodata')])
+
     def test_info_repo(self):
         """ Test the repo_manager.info_repo function. """
         self.assertEqual(repomgr.info_repo(TEST_REPO), None)
@@ -165,6 +802,81 @@ class RepoManagertests(unittest.TestCase):
         obs = repomgr.info_repo('fake')
         self.assertEqual(obs, None)
 
+    def test_report(self):
+        """ Test the records reported by info_repo and clean_repo. """
+        stream = StringIO()
+        report = repomgr.Reporter('ndjson', stream)
+        repomgr.info_repo(TEST_REPO, keep=2, report=report)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(
+            [record['type'] for record in records],
+            ['package', 'package', 'summary'])
+        self.assertEqual(records[0]['name'], 'fedocal')
+        self.assertEqual(
+            records[0]['remove'],
+            ['fedocal-0.5.0-1.el6.src.rpm', 'fedocal-0.5.1-1.el6.src.rpm'])
+        self.assertEqual(records[2]['removable'], 4)
+
+        stream = StringIO()
+        report = repomgr.Reporter('json', stream)
+        repomgr.clean_repo(TEST_REPO, dry_run=True, report=report)
+        report.close()
+        records = json.loads(stream.getvalue())
+        self.assertEqual(
+            [record['file'] for record in records[:-1]],
+            ['fedocal-0.5.0-1.el6.src.rpm', 'pkgdb2-0.5-1.el6.src.rpm'])
+        self.assertEqual(records[-1]['type'], 'summary')
+        self.assertEqual(records[-1]['removed'], 2)
+
+        stream = StringIO()
+        repomgr.Reporter('json', stream).close()
+        self.assertEqual(json.loads(stream.getvalue()), [])
+
+        # Nothing else is printed on stdout, not even by createrepo
+        stream = StringIO()
+        output = tempfile.TemporaryFile()
+        stdout, saved = sys.stdout, os.dup(1)
+        sys.stdout = stream
+        os.dup2(output.fileno(), 1)
+        try:
+            report = repomgr.Reporter('ndjson', stream)
+            repomgr.info_repo(TEST_REPO, keep=2, report=report)
+            repomgr.clean_repo(
+                TEST_REPO, keep=2, createrepo_cmd='echo createrepo;true',
+                report=report)
+        finally:
+            sys.stdout = stdout
+            os.dup2(saved, 1)
+            os.close(saved)
+        output.seek(0)
+        self.assertEqual(output.read(), b'')
+        output.close()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(
+            [record['type'] for record in records],
+            ['package', 'package', 'summary'] + ['removal'] * 4
+            + ['summary'])
+
+        # Reporting always uses the external sort
+        group_rpm_entries = repomgr.group_rpm_entries
+        external = []
+
+        def _group(entries, external_sort=False, **kwargs):
+            external.append(external_sort)
+            return group_rpm_entries(entries, external_sort, **kwargs)
+
+        repomgr.group_rpm_entries = _group
+        try:
+            repomgr.info_repo(
+                TEST_REPO, report=repomgr.Reporter('ndjson', StringIO()))
+            repomgr.clean_repo(
+                TEST_REPO, dry_run=True,
+                report=repomgr.Reporter('ndjson', StringIO()))
+            repomgr.info_repo(TEST_REPO)
+        finally:
+            repomgr.group_rpm_entries = group_rpm_entries
+        self.assertEqual(external, [True, True, False])
+
     def test_delete_rpm(self):
         """ Test the repo_manager.delete_rpm function. """
 
@@ -179,7 +891,7 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.7-1.el6.src.rpm',
             'pkgdb2-0.8-1.el6.src.rpm',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
         # Create another empty file but ending with .rpm
@@ -205,7 +917,7 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.8-1.el6.src.rpm',
             'repodata',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
     def test_add_rpm(self):
@@ -225,7 +937,7 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.8-1.el6.src.rpm',
             'repodata',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
         # test wrong inputs
@@ -240,9 +952,26 @@ class RepoManagertests(unittest.TestCase):
             os.path.join(TEST_REPO, 'fake.rpm'))
 
         # Valid inputs
-        repomgr.add_rpm(
+        status = repomgr.add_rpm(
+            os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'),
+            TEST_REPO, message='unit-tests')
+        self.assertEqual(status, repomgr.ADDED)
+
+        # Adding it again does nothing
+        status = repomgr.add_rpm(
             os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'),
             TEST_REPO, message='unit-tests')
+        self.assertEqual(status, repomgr.ALREADY_PRESENT)
+
+        # A different RPM with the same name is refused
+        other = os.path.join(TEST_REPO2, 'other')
+        os.mkdir(other)
+        shutil.copy(
+            os.path.join(REPO, 'fedocal-0.6.0-1.el6.src.rpm'),
+            os.path.join(other, 'fedocal-0.6.1-1.el6.src.rpm'))
+        status = repomgr.add_rpm(
+            os.path.join(other, 'fedocal-0.6.1-1.el6.src.rpm'), TEST_REPO)
+        self.assertEqual(status, repomgr.CONFLICT)
 
         # After delete
         exp = [
@@ -257,43 +986,141 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.8-1.el6.src.rpm',
             'repodata',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
+    def test_delete_rpms(self):
+        """ Test the repo_manager.delete_rpms function. """
+        self.assertEqual(repomgr.delete_rpms('fakefolder', name='*'), None)
+
+        packages = repomgr.get_package_index(TEST_REPO)
+        self.assertEqual(len(packages), 8)
+        self.assertTrue(os.path.exists(os.path.join(
+            TEST_REPO, repomgr.STATE_DIR, repomgr.PACKAGE_INDEX)))
+        # Read from the cache
+        self.assertEqual(
+            [(entry.nevra, buildtime) for entry, buildtime
+             in repomgr.get_package_index(TEST_REPO)],
+            [(entry.nevra, buildtime) for entry, buildtime in packages])
+
+        self.assertEqual(
+            [entry.basename for entry in repomgr.select_rpms(
+                packages, name='fed*', evr=('<', '0.6'))],
+            ['fedocal-0.5.0-1.el6.src.rpm', 'fedocal-0.5.1-1.el6.src.rpm'])
+        self.assertEqual(
+            len(repomgr.select_rpms(packages, evr=('>=', '0:0.6-1'))), 5)
+        self.assertEqual(len(repomgr.select_rpms(packages, arch=['src'])), 8)
+        self.assertEqual(
+            len(repomgr.select_rpms(packages, arch=['x86_64'])), 0)
+        self.assertEqual(len(repomgr.select_rpms(packages, older_than=0)), 8)
+        self.assertEqual(
+            len(repomgr.select_rpms(packages, older_than=100000)), 0)
+
+        # Dry run, then actual run
+        removed = repomgr.delete_rpms(
+            TEST_REPO, name='pkgdb2', evr=('<=', '0.6'), dry_run=True)
+        self.assertEqual(len(removed), 2)
+        self.assertEqual(len(_listdir(TEST_REPO)), 8)
+        removed = repomgr.delete_rpms(
+            TEST_REPO, name='pkgdb2', evr=('<=', '0.6'), no_createrepo=True)
+        self.assertEqual(
+            [entry.basename for entry in removed],
+            ['pkgdb2-0.5-1.el6.src.rpm', 'pkgdb2-0.6-1.el6.src.rpm'])
+        self.assertEqual(len(_listdir(TEST_REPO)), 6)
+
+        # Explicit RPMs are checked together, against an index built once:
+        # each of these two provides what pkgdb2 requires
+        first = os.path.join(TEST_REPO, 'fedocal-0.5.0-1.el6.src.rpm')
+        second = os.path.join(TEST_REPO, 'fedocal-0.5.1-1.el6.src.rpm')
+        new_dependency_index = repomgr.new_dependency_index
+        built = []
+
+        def _index():
+            index = deps.DependencyIndex(repomgr.vercmp_key)
+            index.add_package(first, [('fedocal-lib', 0, '')], [], [])
+            index.add_package(second, [('fedocal-lib', 0, '')], [], [])
+            index.add_package(
+                os.path.join(TEST_REPO, 'pkgdb2-0.8-1.el6.src.rpm'), [],
+                [('fedocal-lib', 0, '')], [])
+            built.append(index)
+            return (index, lambda entry, headers: None)
+
+        repomgr.new_dependency_index = _index
+        try:
+            removed = repomgr.delete_rpms(
+                TEST_REPO, rpms=[os.path.basename(first)],
+                check_deps='skip', no_createrepo=True, dry_run=True)
+            self.assertEqual(len(removed), 1)
+            removed = repomgr.delete_rpms(
+                TEST_REPO,
+                rpms=[os.path.basename(first), os.path.basename(second),
+                      'fake.rpm'],
+                check_deps='skip', no_createrepo=True)
+        finally:
+            repomgr.new_dependency_index = new_dependency_index
+        self.assertEqual(removed, [])
+        self.assertEqual(len(built), 2)
+        self.assertTrue(os.path.exists(first))
+
+        removed = repomgr.delete_rpms(
+            TEST_REPO,
+            rpms=[os.path.basename(first), os.path.basename(second)],
+            no_createrepo=True)
+        self.assertEqual(
+            [entry.basename for entry in removed],
+            ['fedocal-0.5.0-1.el6.src.rpm', 'fedocal-0.5.1-1.el6.src.rpm'])
+        self.assertEqual(len(_listdir(TEST_REPO)), 4)
+
     def test_replace_rpm(self):
         """ Test the repo_manager.replace_rpm function. """
-
-        # Before replacing
-        exp = [
-            'fedocal-0.5.0-1.el6.src.rpm',
-            'fedocal-0.5.1-1.el6.src.rpm',
-            'fedocal-0.6.0-1.el6.src.rpm',
-            'fedocal-0.6.1-1.el6.src.rpm',
-            'pkgdb2-0.5-1.el6.src.rpm',
-            'pkgdb2-0.6-1.el6.src.rpm',
-            'pkgdb2-0.7-1.el6.src.rpm',
-            'pkgdb2-0.8-1.el6.src.rpm',
-        ]
-        files = os.listdir(TEST_REPO)
-        self.assertEqual(sorted(files), exp)
+        rpmfile = os.path.join(TEST_REPO, 'fedocal-0.6.1-1.el6.src.rpm')
 
         # test wrong inputs
-        repomgr.replace_rpm('fakefile', TEST_REPO)
-        repomgr.replace_rpm(TEST_REPO, TEST_REPO)
-        repomgr.replace_rpm('fake.rpm', TEST_REPO)
-        repomgr.replace_rpm(
+        self.assertEqual(repomgr.replace_rpm('fakefile', TEST_REPO), None)
+        self.assertEqual(repomgr.replace_rpm(TEST_REPO, TEST_REPO), None)
+        self.assertEqual(repomgr.replace_rpm('fake.rpm', TEST_REPO), None)
+        self.assertEqual(repomgr.replace_rpm(
             os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'),
-            'fakefolder')
-        repomgr.replace_rpm(
+            'fakefolder'), None)
+        self.assertEqual(repomgr.replace_rpm(
             os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'),
-            os.path.join(TEST_REPO, 'fake.rpm'))
+            rpmfile), None)
+        os.unlink(os.path.join(TEST_REPO2, 'pkgdb2-0.8-1.el6.src.rpm'))
+        self.assertEqual(repomgr.replace_rpm(
+            os.path.join(REPO, 'pkgdb2-0.8-1.el6.src.rpm'),
+            TEST_REPO2), None)
 
-        # Valid inputs
-        repomgr.replace_rpm(
-            os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'),
-            TEST_REPO, message='unit-tests')
+        # The exact same RPM is already there
+        status = repomgr.replace_rpm(
+            os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'), TEST_REPO)
+        self.assertEqual(status, repomgr.ALREADY_PRESENT)
+
+        # A different package with the same file name is refused
+        other = os.path.join(TEST_REPO2, 'other')
+        os.mkdir(other)
+        shutil.copy(
+            os.path.join(REPO, 'fedocal-0.6.0-1.el6.src.rpm'),
+            os.path.join(other, 'fedocal-0.6.1-1.el6.src.rpm'))
+        status = repomgr.replace_rpm(
+            os.path.join(other, 'fedocal-0.6.1-1.el6.src.rpm'), TEST_REPO)
+        self.assertEqual(status, repomgr.CONFLICT)
+
+        # A rebuild of the package replaces it in place
+        rebuilt = os.path.join(other, 'rebuilt')
+        os.mkdir(rebuilt)
+        rebuilt = os.path.join(rebuilt, 'fedocal-0.6.1-1.el6.src.rpm')
+        shutil.copy(
+            os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm'), rebuilt)
+        stream = open(rebuilt, 'ab')
+        stream.write(b'rebuilt')
+        stream.close()
+        status = repomgr.replace_rpm(
+            rebuilt, TEST_REPO, message='unit-tests')
+        self.assertEqual(status, repomgr.REPLACED)
+        self.assertEqual(
+            repomgr.file_checksum(rpmfile), repomgr.file_checksum(rebuilt))
 
-        # After replacing
+        # After replacing, no temporary file is left
         exp = [
             'fedocal-0.5.0-1.el6.src.rpm',
             'fedocal-0.5.1-1.el6.src.rpm',
@@ -305,7 +1132,7 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.8-1.el6.src.rpm',
             'repodata',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
     def test_ugrade_rpm(self):
@@ -325,7 +1152,7 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.8-1.el6.src.rpm',
             'repodata',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
         # test wrong inputs
@@ -361,9 +1188,214 @@ class RepoManagertests(unittest.TestCase):
             'pkgdb2-0.8-1.el6.src.rpm',
             'repodata',
         ]
-        files = os.listdir(TEST_REPO)
+        files = _listdir(TEST_REPO)
         self.assertEqual(sorted(files), exp)
 
+    def test_apply_operations(self):
+        """ Test the repo_manager.batch functions. """
+        other = os.path.join(TEST_REPO2, 'other')
+        os.mkdir(other)
+        rebuilt = os.path.join(other, 'fedocal-0.6.0-1.el6.src.rpm')
+        shutil.copy(os.path.join(REPO, 'fedocal-0.6.0-1.el6.src.rpm'), rebuilt)
+        stream = open(rebuilt, 'ab')
+        stream.write(b'rebuilt')
+        stream.close()
+        os.unlink(os.path.join(TEST_REPO2, 'fedocal-0.6.1-1.el6.src.rpm'))
+        os.unlink(os.path.join(TEST_REPO2, 'pkgdb2-0.8-1.el6.src.rpm'))
+
+        def _content():
+            # The validation caches the content of the repos
+            return [
+                sorted(_listdir(folder)) for folder in (TEST_REPO, TEST_REPO2)]
+
+        before = _content()
+
+        manifest = os.path.join(other, 'manifest.json')
+        stream = open(manifest, 'w')
+        json.dump({'message': 'release', 'operations': [
+            {'op': 'add', 'repo': TEST_REPO2,
+             'rpm': os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm')},
+            {'op': 'upgrade', 'from': TEST_REPO, 'repo': TEST_REPO2,
+             'rpm': 'pkgdb2-0.8-1.el6.src.rpm'},
+            {'op': 'delete', 'repo': TEST_REPO + '/',
+             'rpm': 'pkgdb2-0.5-1.el6.src.rpm'},
+            {'op': 'replace', 'repo': TEST_REPO, 'rpm': rebuilt},
+            {'op': 'add', 'repo': TEST_REPO,
+             'rpm': os.path.join(REPO, 'fedocal-0.5.0-1.el6.src.rpm')},
+        ]}, stream)
+        stream.close()
+        items, message = batch.load_manifest(manifest)
+        self.assertEqual(message, 'release')
+        self.assertEqual(len(items), 5)
+        stream = open(manifest, 'w')
+        json.dump({'operations': 'add'}, stream)
+        stream.close()
+        self.assertRaises(ValueError, batch.load_manifest, manifest)
+
+        def _operations(extra=()):
+            return [
+                batch.Operation(
+                    item['op'], item['rpm'], item['repo'], item.get('from'))
+                for item in items + list(extra)]
+
+        # Invalid operations, nothing is done
+        operations = _operations([
+            {'op': 'delete', 'repo': TEST_REPO, 'rpm': 'fake.rpm'},
+            {'op': 'add', 'repo': TEST_REPO2,
+             'rpm': os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm')},
+            {'op': 'add', 'repo': TEST_REPO2, 'rpm': rebuilt},
+            {'op': 'install', 'repo': TEST_REPO2, 'rpm': rebuilt},
+            {'op': 'delete', 'repo': os.path.join(TEST_REPO, '.'),
+             'rpm': 'pkgdb2-0.5-1.el6.src.rpm'},
+        ])
+        self.assertFalse(batch.apply_operations(operations))
+        self.assertEqual(
+            [operation.status for operation in operations],
+            [batch.NOT_RUN] * 4 + [repomgr.ALREADY_PRESENT]
+            + [batch.INVALID] * 5)
+        self.assertEqual(operations[2].folder, TEST_REPO)
+        self.assertEqual(
+            operations[-1].error,
+            '%s is also changed by operation 3' % os.path.join(
+                TEST_REPO, 'pkgdb2-0.5-1.el6.src.rpm'))
+        self.assertEqual(_content(), before)
+
+        # Dry run
+        self.assertTrue(batch.apply_operations(_operations(), dry_run=True))
+
+        # A failure is rolled back
+        copy_to_temp = repomgr.copy_to_temp
+
+        def _failing_copy(rpm, folder, digest=None):
+            if rpm == rebuilt:
+                raise IOError('No space left on device')
+            return copy_to_temp(rpm, folder, digest)
+
+        repomgr.copy_to_temp = _failing_copy
+        try:
+            operations = _operations()
+            self.assertFalse(
+                batch.apply_operations(operations, rollback=True))
+        finally:
+            repomgr.copy_to_temp = copy_to_temp
+        self.assertEqual(
+            [operation.status for operation in operations],
+            [batch.ROLLED_BACK] * 3 + [batch.FAILED,
+                                       repomgr.ALREADY_PRESENT])
+        self.assertEqual(_content(), before)
+
+        # Actual run
+        records = []
+        operations = _operations()
+        self.assertTrue(batch.apply_operations(
+            operations, workers=2, trash=True, report=records.append))
+        self.assertEqual(
+            [record['status'] for record in records],
+            ['added', 'upgraded', 'deleted', 'replaced',
+             repomgr.ALREADY_PRESENT])
+        self.assertEqual(
+            sorted(_listdir(TEST_REPO)),
+            ['fedocal-0.5.0-1.el6.src.rpm',
+             'fedocal-0.5.1-1.el6.src.rpm', 'fedocal-0.6.0-1.el6.src.rpm',
+             'fedocal-0.6.1-1.el6.src.rpm', 'pkgdb2-0.6-1.el6.src.rpm',
+             'pkgdb2-0.7-1.el6.src.rpm', 'repodata'])
+        self.assertEqual(
+            repomgr.file_checksum(
+                os.path.join(TEST_REPO, 'fedocal-0.6.0-1.el6.src.rpm')),
+            repomgr.file_checksum(rebuilt))
+        self.assertEqual(len(_listdir(TEST_REPO2)), 10)
+        batches = os.listdir(os.path.join(TEST_REPO, repomgr.TRASH_DIR))
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(
+                TEST_REPO, repomgr.TRASH_DIR, batches[0]))),
+            ['fedocal-0.6.0-1.el6.src.rpm.trashed',
+             'pkgdb2-0.5-1.el6.src.rpm.trashed',
+             'pkgdb2-0.8-1.el6.src.rpm.trashed'])
+
+    def test_mirror_repo(self):
+        """ Test the repo_manager.mirror.mirror_repo function. """
+        target = os.path.join(TEST_REPO2, 'mirror')
+        self.assertEqual(mirror.mirror_repo('fakefolder', target), None)
+        os.mkdir(os.path.join(TEST_REPO, 'repodata'))
+        stream = open(os.path.join(TEST_REPO, 'repodata', 'repomd.xml'), 'w')
+        stream.write('<repomd/>')
+        stream.close()
+
+        stats = mirror.mirror_repo(TEST_REPO, target, dry_run=True)
+        self.assertEqual(stats['copied'], 8)
+        self.assertTrue(stats['repodata'])
+        self.assertFalse(os.path.exists(target))
+
+        stats = mirror.mirror_repo(TEST_REPO, target, workers=2)
+        self.assertEqual(
+            (stats['copied'], stats['unchanged'], stats['removed']),
+            (8, 0, 0))
+        self.assertTrue(stats['repodata'])
+        self.assertEqual(
+            sorted(os.listdir(target)),
+            sorted(os.listdir(REPO) + ['repodata']))
+        for filename in os.listdir(REPO):
+            self.assertEqual(
+                int(os.stat(os.path.join(target, filename)).st_mtime),
+                int(os.stat(os.path.join(TEST_REPO, filename)).st_mtime))
+
+        # Nothing changed
+        stats = mirror.mirror_repo(TEST_REPO, target)
+        self.assertEqual(
+            (stats['copied'], stats['unchanged'], stats['removed']),
+            (0, 8, 0))
+        self.assertFalse(stats['repodata'])
+
+        # One RPM rebuilt, one removed and new repodata
+        rpmfile = os.path.join(TEST_REPO, 'fedocal-0.6.1-1.el6.src.rpm')
+        stream = open(rpmfile, 'ab')
+        stream.write(b'rebuilt')
+        stream.close()
+        os.unlink(os.path.join(TEST_REPO, 'pkgdb2-0.5-1.el6.src.rpm'))
+        stream = open(os.path.join(TEST_REPO, 'repodata', 'repomd.xml'), 'w')
+        stream.write('<repomd></repomd>')
+        stream.close()
+        # The mirror has a repodata at any time while it is published
+        repodata = os.path.join(target, 'repodata')
+        found = []
+        functions = [(os, 'rename'), (os, 'unlink'), (shutil, 'rmtree')]
+        originals = [getattr(module, name) for module, name in functions]
+
+        def _checking(func):
+            def _call(*args, **kwargs):
+                found.append(os.path.isdir(repodata))
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    found.append(os.path.isdir(repodata))
+            return _call
+
+        for (module, name), func in zip(functions, originals):
+            setattr(module, name, _checking(func))
+        try:
+            stats = mirror.mirror_repo(TEST_REPO, target, hardlink=True)
+        finally:
+            for (module, name), func in zip(functions, originals):
+                setattr(module, name, func)
+        self.assertTrue(found)
+        if repomgr.exchange_paths(repodata, repodata):
+            self.assertTrue(all(found))
+        self.assertEqual(
+            (stats['linked'], stats['unchanged'], stats['removed']),
+            (1, 6, 1))
+        self.assertTrue(stats['repodata'])
+        self.assertTrue(os.path.samefile(
+            rpmfile, os.path.join(target, 'fedocal-0.6.1-1.el6.src.rpm')))
+        self.assertEqual(
+            sorted(os.listdir(target)),
+            sorted(_listdir(TEST_REPO)))
+        self.assertEqual(
+            os.listdir(os.path.join(target, 'repodata')), ['repomd.xml'])
+        stream = open(os.path.join(target, 'repodata', 'repomd.xml'))
+        self.assertEqual(stream.read(), '<repomd></repomd>')
+        stream.close()
+
     def test_run_createrepo(self):
         """ Test the repo_manager.run_createrepo function. """
 
@@ -373,6 +1405,150 @@ class RepoManagertests(unittest.TestCase):
                 os.path.join(REPO, 'fedocal-0.6.1-1.el6.src.rpm')),
             None)
 
+    def test_run_createrepo_manifest(self):
+        """ Test that createrepo is only run if the repo changed. """
+        cnt, digest = repomgr.repo_manifest(TEST_REPO, 'true')
+        self.assertEqual(cnt, 8)
+        self.assertNotEqual(
+            repomgr.repo_manifest(TEST_REPO, 'createrepo')[1], digest)
+
+        # No repodata yet
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, 'true'))
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, 'true'))
+        os.mkdir(os.path.join(TEST_REPO, 'repodata'))
+        open(os.path.join(TEST_REPO, 'repodata', 'repomd.xml'), 'w').close()
+
+        # Nothing changed since the last run
+        self.assertFalse(repomgr.run_createrepo(TEST_REPO, 'true'))
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, 'true', force=True))
+
+        # A createrepo failing is run again
+        os.unlink(os.path.join(TEST_REPO, 'fedocal-0.5.0-1.el6.src.rpm'))
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, 'false'))
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, 'false'))
+        self.assertEqual(repomgr.repo_manifest(TEST_REPO, 'true')[0], 7)
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, 'true'))
+        self.assertFalse(repomgr.run_createrepo(TEST_REPO, 'true'))
+
+        # An RPM removed while createrepo runs is not marked as indexed
+        cmd = 'rm -f fedocal-0.5.1-1.el6.src.rpm; true'
+        manifest = repomgr.read_manifest(TEST_REPO)
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, cmd))
+        self.assertEqual(repomgr.read_manifest(TEST_REPO), manifest)
+        self.assertTrue(repomgr.run_createrepo(TEST_REPO, cmd))
+        self.assertFalse(repomgr.run_createrepo(TEST_REPO, cmd))
+
+    @unittest.skipIf(sys.version_info < (3, 5), 'asyncio API is Python 3')
+    def test_aio(self):
+        """ Test the asyncio API of repo_manager.aio. """
+        import asyncio
+        import repo_manager.aio as aio
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+        rpmfile = 'fedocal-0.6.1-1.el6.src.rpm'
+
+        self.assertTrue(loop.run_until_complete(
+            aio.delete_rpm(rpmfile, TEST_REPO, createrepo_cmd='true')))
+        self.assertFalse(os.path.exists(os.path.join(TEST_REPO, rpmfile)))
+        self.assertEqual(
+            loop.run_until_complete(aio.delete_rpm('fake.rpm', TEST_REPO)),
+            None)
+
+        # Operations on different repos run concurrently
+        statuses = loop.run_until_complete(asyncio.gather(
+            aio.add_rpm(os.path.join(REPO, rpmfile), TEST_REPO,
+                        createrepo_cmd='true'),
+            aio.add_rpm(os.path.join(REPO, rpmfile), TEST_REPO2,
+                        createrepo_cmd='true'),
+        ))
+        self.assertEqual(
+            statuses, [repomgr.ADDED, repomgr.ALREADY_PRESENT])
+        self.assertTrue(os.path.exists(os.path.join(TEST_REPO, rpmfile)))
+
+        # createrepo is killed when it times out, the manifest is not
+        # written so that it is run again
+        os.mkdir(os.path.join(TEST_REPO, 'repodata'))
+        open(os.path.join(TEST_REPO, 'repodata', 'repomd.xml'), 'w').close()
+        self.assertFalse(loop.run_until_complete(
+            aio.run_createrepo(TEST_REPO, 'true')))
+        os.unlink(os.path.join(TEST_REPO, rpmfile))
+        self.assertTrue(loop.run_until_complete(
+            aio.run_createrepo(TEST_REPO, 'sleep 10 &&', timeout=0.2)))
+        self.assertTrue(loop.run_until_complete(
+            aio.run_createrepo(TEST_REPO, 'true')))
+
+        info = loop.run_until_complete(aio.info_repo(TEST_REPO))
+        self.assertEqual(info, repomgr.info_repo(TEST_REPO))
+
+        # An RPM removed while createrepo runs is not marked as indexed
+        cmd = 'rm -f fedocal-0.5.1-1.el6.src.rpm; true'
+        self.assertTrue(loop.run_until_complete(
+            aio.run_createrepo(TEST_REPO, cmd)))
+        self.assertTrue(loop.run_until_complete(
+            aio.run_createrepo(TEST_REPO, cmd)))
+        self.assertFalse(loop.run_until_complete(
+            aio.run_createrepo(TEST_REPO, cmd)))
+
+        # Executor recording when each call starts and ends, the calls
+        # being made slow enough to overlap if they are not serialized
+        import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        class RecordingExecutor(ThreadPoolExecutor):
+            ''' Executor recording the (start, end) of its calls. '''
+            calls = []
+
+            def submit(self, func, *args, **kwargs):
+                def _call():
+                    start = time.time()
+                    time.sleep(0.2)
+                    try:
+                        return func(*args, **kwargs)
+                    finally:
+                        self.calls.append((start, time.time()))
+                return ThreadPoolExecutor.submit(self, _call)
+
+        executor = RecordingExecutor(4)
+        self.addCleanup(executor.shutdown)
+
+        # Calls on different folders overlap
+        loop.run_until_complete(asyncio.gather(
+            aio.delete_rpm('pkgdb2-0.5-1.el6.src.rpm', TEST_REPO,
+                           no_createrepo=True, executor=executor),
+            aio.delete_rpm('pkgdb2-0.5-1.el6.src.rpm', TEST_REPO2,
+                           no_createrepo=True, executor=executor),
+        ))
+        (start1, end1), (start2, end2) = executor.calls
+        self.assertTrue(max(start1, start2) < min(end1, end2))
+
+        # Calls on the same folder are serialized
+        del executor.calls[:]
+        loop.run_until_complete(asyncio.gather(
+            aio.delete_rpm('pkgdb2-0.6-1.el6.src.rpm', TEST_REPO,
+                           no_createrepo=True, executor=executor),
+            aio.delete_rpm('pkgdb2-0.7-1.el6.src.rpm', TEST_REPO + '/',
+                           no_createrepo=True, executor=executor),
+        ))
+        (start1, end1), (start2, end2) = sorted(executor.calls)
+        self.assertTrue(end1 <= start2)
+
+        # ugrade_rpm is a deprecated alias of upgrade_rpm
+        import warnings
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertEqual(
+                loop.run_until_complete(aio.ugrade_rpm(
+                    'pkgdb2-0.6-1.el6.src.rpm', TEST_REPO2, TEST_REPO,
+                    no_createrepo=True)),
+                repomgr.ADDED)
+        self.assertEqual(
+            [warning.category for warning in caught], [DeprecationWarning])
+        self.assertTrue(os.path.exists(
+            os.path.join(TEST_REPO, 'pkgdb2-0.6-1.el6.src.rpm')))
+
 
 if __name__ == '__main__':
     SUITE = unittest.TestLoader().loadTestsFromTestCase(RepoManagertests)